@@ -0,0 +1,85 @@
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def run_once(args: argparse.Namespace) -> None:
+  """Start from nothing in a fresh process and print the seconds to import, load the model and infer one frame."""
+  start = time.perf_counter()
+  import torch
+  import src.camera_collection
+  from src.model_wrapper import Model
+  imported = time.perf_counter()
+
+  if args.mode == "artifact":
+    model = Model("", False, args.block_size, device="cpu", artifact_path=args.artifact).get_model()
+  elif args.mode == "source" and args.model_path:
+    model = Model(args.model_path, False, args.block_size, device="cpu").get_model()
+  else:
+    from stub_model import StubDensityModel
+    model = StubDensityModel()
+    model.load_state_dict(torch.load(args.stub_weights))
+    model.eval()
+  loaded = time.perf_counter()
+
+  with torch.inference_mode():
+    model(torch.rand(1, 3, args.height, args.width).contiguous(memory_format=torch.channels_last))
+  inferred = time.perf_counter()
+  print(f"{imported - start} {loaded - imported} {inferred - loaded}")
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description="Cold start of building the model from source against loading "
+                                               "an exported TorchScript artifact, each in a fresh process.")
+  parser.add_argument("--model-path", help="SASNet weights; needs the CrowdCounting-SASNet submodule. "
+                                           "Without it the stub model of stub_model.py is measured")
+  parser.add_argument("--artifact", help="TorchScript export of --model-path, see export_model.py")
+  parser.add_argument("--block-size", type=int, default=32)
+  parser.add_argument("--size", type=int, nargs=2, default=[1920, 1080], metavar=("WIDTH", "HEIGHT"))
+  parser.add_argument("--repeats", type=int, default=3)
+  parser.add_argument("--mode", choices=["source", "artifact"], help=argparse.SUPPRESS)
+  parser.add_argument("--stub-weights", help=argparse.SUPPRESS)
+  args = parser.parse_args()
+  args.width, args.height = args.size
+
+  if args.mode:
+    run_once(args)
+    return
+
+  import torch
+  from src.model_wrapper import export_torchscript
+  from stub_model import StubDensityModel
+
+  with tempfile.TemporaryDirectory() as directory:
+    stub_weights = os.path.join(directory, "stub.pth")
+    artifact = args.artifact
+    if args.model_path is None:
+      stub = StubDensityModel().to(memory_format=torch.channels_last)
+      torch.save(stub.state_dict(), stub_weights)
+      artifact = os.path.join(directory, "stub.pt")
+      export_torchscript(stub, artifact, (3, args.height, args.width))
+
+    print(f"{'model':>10}{'import s':>10}{'load s':>9}{'first frame s':>15}{'total s':>9}")
+    for mode in ("source", "artifact"):
+      if mode == "artifact" and artifact is None:
+        continue
+      command = [sys.executable, os.path.abspath(__file__), "--mode", mode, "--block-size", str(args.block_size),
+                 "--size", str(args.width), str(args.height), "--stub-weights", stub_weights]
+      if args.model_path:
+        command += ["--model-path", args.model_path]
+      if artifact:
+        command += ["--artifact", artifact]
+
+      runs = [list(map(float, subprocess.run(command, capture_output=True, text=True, check=True).stdout.split()))
+              for _ in range(args.repeats)]
+      import_s, load_s, infer_s = (sorted(column)[len(column) // 2] for column in zip(*runs))
+      print(f"{mode:>10}{import_s:>10.2f}{load_s:>9.2f}{infer_s:>15.2f}{import_s + load_s + infer_s:>9.2f}")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,61 @@
+import argparse
+import os
+import sys
+import time
+from typing import Callable
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Needs the CrowdCounting-SASNet submodule; weights do not affect speed, so the network is randomly initialised
+from src.model_wrapper import model as sasnet
+
+
+def build_sasnet(block_size: int) -> torch.nn.Module:
+  class ArgsWrapper:
+    pass
+
+  args = ArgsWrapper()
+  args.block_size = block_size
+  return sasnet.SASNet(False, args).eval()
+
+
+def frames_per_second(run: Callable[[], None], batches: int, batch_size: int) -> float:
+  run()  # warm-up, lets oneDNN pick its kernels
+  start = time.perf_counter()
+  for _ in range(batches):
+    run()
+  return batches * batch_size / (time.perf_counter() - start)
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description="SASNet CPU throughput at the 1920x1080 input size.")
+  parser.add_argument("--threads", type=int, nargs="+", default=[torch.get_num_threads()])
+  parser.add_argument("--batch-size", type=int, default=1)
+  parser.add_argument("--batches", type=int, default=3)
+  parser.add_argument("--block-size", type=int, default=32)
+  args = parser.parse_args()
+
+  network = build_sasnet(args.block_size)
+  frames = torch.randn(args.batch_size, 3, 1080, 1920)
+
+  print(f"{'threads':>8}{'mode':>16}{'layout':>15}{'frames/s':>10}")
+  for threads in args.threads:
+    torch.set_num_threads(threads)
+    for channels_last in (False, True):
+      memory_format = torch.channels_last if channels_last else torch.contiguous_format
+      network.to(memory_format=memory_format)
+      inputs = frames.to(memory_format=memory_format)
+
+      for mode_name, mode in (("no_grad", torch.no_grad), ("inference_mode", torch.inference_mode)):
+        def run() -> None:
+          with mode():
+            network(inputs)
+
+        fps = frames_per_second(run, args.batches, args.batch_size)
+        print(f"{threads:>8}{mode_name:>16}{'channels_last' if channels_last else 'contiguous':>15}{fps:>10.3f}")
+
+
+if __name__ == "__main__":
+  main()
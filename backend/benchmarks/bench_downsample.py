@@ -0,0 +1,64 @@
+import os
+import sys
+import time
+from typing import Callable, List, Tuple
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.camera_utils import CameraUtils
+
+
+def downsample_image_loop(matrix: np.ndarray, scale_factor: int) -> np.ndarray:
+  """The original per-block loop, kept as the reference implementation."""
+  new_height = matrix.shape[0] // scale_factor + (matrix.shape[0] % scale_factor > 0)
+  new_width = matrix.shape[1] // scale_factor + (matrix.shape[1] % scale_factor > 0)
+
+  downscaled_array = np.zeros((new_height, new_width), dtype=matrix.dtype)
+
+  for i in range(new_height):
+    for j in range(new_width):
+      row_start = i * scale_factor
+      row_end = min((i + 1) * scale_factor, matrix.shape[0])
+      col_start = j * scale_factor
+      col_end = min((j + 1) * scale_factor, matrix.shape[1])
+      downscaled_array[i, j] = np.sum(matrix[row_start:row_end, col_start:col_end])
+
+  return downscaled_array
+
+
+def time_call(function: Callable[[], np.ndarray], repeats: int) -> float:
+  best = float("inf")
+  for _ in range(repeats):
+    start = time.perf_counter()
+    function()
+    best = min(best, time.perf_counter() - start)
+  return best
+
+
+def main() -> None:
+  camera_utils = CameraUtils(50, "", 1, None)
+  rng = np.random.default_rng(0)
+
+  # Map sizes are what correct_perspective produces; scale factors map them onto metre cells
+  map_sizes: List[Tuple[int, int]] = [(270, 480), (540, 960), (1080, 1920), (1079, 1437)]
+  scale_factors: List[int] = [2, 7, 14, 19, 32, 100]
+
+  print(f"{'dtype':<8}{'map size':>12}{'scale':>7}{'loop ms':>11}{'vector ms':>11}{'speedup':>9}  identical")
+  for dtype in (np.float32, np.float64):
+    for height, width in map_sizes:
+      matrix = rng.random((height, width)).astype(dtype)
+      for scale_factor in scale_factors:
+        expected = downsample_image_loop(matrix, scale_factor)
+        actual = camera_utils.downsample_image(matrix, scale_factor)
+        identical = actual.dtype == expected.dtype and np.array_equal(actual.view(np.uint8), expected.view(np.uint8))
+
+        loop_time = time_call(lambda: downsample_image_loop(matrix, scale_factor), 3)
+        vector_time = time_call(lambda: camera_utils.downsample_image(matrix, scale_factor), 20)
+        print(f"{np.dtype(dtype).name:<8}{f'{height}x{width}':>12}{scale_factor:>7}"
+              f"{loop_time * 1000:>11.2f}{vector_time * 1000:>11.3f}{loop_time / vector_time:>8.1f}x  {identical}")
+
+
+if __name__ == "__main__":
+  main()
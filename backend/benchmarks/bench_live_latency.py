@@ -0,0 +1,89 @@
+import argparse
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+
+import cv2
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.camera import Camera
+from src.camera_utils import CameraUtils
+from synthetic_video import write_synthetic_video
+
+
+class SlowModel(torch.nn.Module):
+  """Stands in for SASNet with a fixed inference time, so that the benchmark needs no weights."""
+
+  def __init__(self, inference_seconds: float) -> None:
+    super().__init__()
+    self.inference_seconds: float = inference_seconds
+
+  def forward(self, img: torch.Tensor) -> torch.Tensor:
+    time.sleep(self.inference_seconds * len(img))
+    return img.mean(1, keepdim=True).abs()
+
+
+def write_raw_frames(video_path: str, pipe_path: str, fps: float) -> None:
+  """Write the video's frames as raw bgr24 to a named pipe at its frame rate, like `ffmpeg -re ... -f rawvideo`."""
+  cap = cv2.VideoCapture(video_path)
+  frame_time = 1 / fps
+  next_time = time.perf_counter()
+  with open(pipe_path, "wb") as pipe:
+    while True:
+      ret, frame = cap.read()
+      if not ret:
+        break
+      next_time += frame_time
+      time.sleep(max(next_time - time.perf_counter(), 0))
+      try:
+        pipe.write(frame.tobytes())
+      except BrokenPipeError:
+        break
+  cap.release()
+
+
+def run(camera: Camera) -> None:
+  """Consume the results from a queue; the camera prints the frames it read, dropped and the mean latency."""
+  results: queue.Queue = queue.Queue()
+  start = time.perf_counter()
+  camera.predict_live(result_queue=results)
+  print(f"  {results.qsize()} results over {time.perf_counter() - start:.1f} s")
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description="Latency and frame dropping of live sources replayed in real time.")
+  parser.add_argument("--seconds", type=float, default=10.0)
+  parser.add_argument("--inference-ms", type=float, default=300.0, help="simulated inference time per frame")
+  parser.add_argument("--target-fps", type=float, default=2.0)
+  args = parser.parse_args()
+
+  fps = 25.0
+  resolution = (640, 360)
+  with tempfile.TemporaryDirectory() as directory:
+    video_path = write_synthetic_video(os.path.join(directory, "live.mp4"), int(args.seconds * fps), resolution, fps)
+    camera_utils = CameraUtils(50, directory + "/", 1, None)
+    model = SlowModel(args.inference_ms / 1000)
+
+    def make_camera(source: str, **live_options) -> Camera:
+      return Camera(source, [(0, 0), (0, 1079), (1919, 1079), (1919, 0)], [(0, 0), (0, 54), (96, 54), (96, 0)],
+                    model, 1, 1, 1000, camera_utils, device="cpu", live=True, live_fps=args.target_fps, **live_options)
+
+    print(f"File replayed at {fps:.0f} frames/sec, inferred at up to {args.target_fps} frames/sec")
+    run(make_camera(video_path, live_replay=True))
+
+    print(f"Raw bgr24 frames through a named pipe at {fps:.0f} frames/sec")
+    pipe_path = os.path.join(directory, "frames.pipe")
+    os.mkfifo(pipe_path)
+    writer = threading.Thread(target=write_raw_frames, args=(video_path, pipe_path, fps), daemon=True)
+    writer.start()
+    run(make_camera(pipe_path, live_frame_size=resolution))
+    writer.join()
+
+
+if __name__ == "__main__":
+  main()
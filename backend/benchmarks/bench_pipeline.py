@@ -0,0 +1,218 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import cv2
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.camera import Camera
+from src.camera_collection import CameraCollection
+from src.camera_utils import CameraUtils
+from src.profiler import profiler
+from src.sequential_video_frame_dataset import SequentialVideoFrameDataset
+from src.video_frame_dataset import VideoFrameDataset
+from stub_model import StubDensityModel
+from synthetic_video import write_synthetic_video
+
+LOCAL_COORDINATES = [(797, 293), (287, 653), (1761, 1040), (1734, 411)]
+
+
+def global_coordinates(camera_index: int) -> List[tuple]:
+  """Cameras side by side, each covering 100 x 80 metres."""
+  x = camera_index * 100
+  return [(x, 0), (x, 80), (x + 100, 80), (x + 100, 0)]
+
+
+def median_seconds(function: Callable[[], Any], repeats: int) -> float:
+  durations = []
+  for _ in range(repeats):
+    start = time.perf_counter()
+    function()
+    durations.append(time.perf_counter() - start)
+  return statistics.median(durations)
+
+
+def result(name: str, value: float, unit: str, higher_is_better: bool, **details: Any) -> Dict[str, Any]:
+  return {"name": name, "value": round(value, 4), "unit": unit, "higher_is_better": higher_is_better, **details}
+
+
+def bench_sampling(video_path: str, frame_interval: int, repeats: int) -> List[Dict[str, Any]]:
+  datasets = {
+    "seek": lambda: VideoFrameDataset(video_path, transform=torch.from_numpy, frame_interval=frame_interval),
+    "sequential": lambda: SequentialVideoFrameDataset(video_path, transform=torch.from_numpy, frame_interval=frame_interval),
+  }
+  results = []
+  for name, make_dataset in datasets.items():
+    frame_count = len(make_dataset())
+    seconds = median_seconds(lambda: sum(1 for _ in make_dataset()), repeats)
+    results.append(result(f"sampling/{name}", frame_count / seconds, "frames/s", True, frame_interval=frame_interval))
+  return results
+
+
+def make_cameras(camera_count: int, video_path: str, model: torch.nn.Module, camera_utils: CameraUtils,
+                 args: argparse.Namespace, **options: Any) -> List[Camera]:
+  return [Camera(video_path, LOCAL_COORDINATES, global_coordinates(camera_index), model, args.frame_interval,
+                 args.batch_size, 1000, camera_utils, device="cpu", **options)
+          for camera_index in range(camera_count)]
+
+
+def bench_postprocessing(pred_map: np.ndarray, camera_utils: CameraUtils, model: torch.nn.Module,
+                         video_path: str, cache_dir: str, args: argparse.Namespace) -> List[Dict[str, Any]]:
+  results = []
+  frame_indices = list(range(len(pred_map)))
+  for projection in ("warp", "sparse"):
+    camera = make_cameras(1, video_path, model, camera_utils, args, projection=projection,
+                          projection_cache_dir=cache_dir)[0]
+    # The first call builds the geometry and the projection matrix, which happens once per run
+    camera.postprocess(frame_indices, pred_map)
+    seconds = median_seconds(lambda: camera.postprocess(frame_indices, pred_map), args.repeats)
+    results.append(result(f"postprocess/{projection}", seconds / len(pred_map) * 1000, "ms/frame", False))
+  return results
+
+
+def bench_compositing(pred_map: np.ndarray, camera_utils: CameraUtils, model: torch.nn.Module, video_path: str,
+                      cache_dir: str, args: argparse.Namespace) -> List[Dict[str, Any]]:
+  results = []
+  for camera_count in range(1, args.cameras + 1):
+    cameras = make_cameras(camera_count, video_path, model, camera_utils, args, projection="sparse",
+                           projection_cache_dir=cache_dir)
+    frames = [cam.postprocess([0], pred_map[:1])[0] for cam in cameras]
+    collection = CameraCollection(cameras, camera_utils)
+    density_maps = [frame.density for frame in frames]
+    global_map = collection.compose_density(density_maps)
+
+    seconds = median_seconds(lambda: collection.compose_frame(global_map), args.repeats)
+    results.append(result("composite/heatmap", seconds * 1000, "ms/frame", False, cameras=camera_count))
+    seconds = median_seconds(lambda: collection.compose_density(density_maps), args.repeats)
+    results.append(result("composite/density", seconds * 1000, "ms/frame", False, cameras=camera_count))
+    batch = [np.repeat(density_map[None], collection.fusion_batch_size, axis=0) for density_map in density_maps]
+    seconds = median_seconds(lambda: collection.compose_densities(batch), args.repeats)
+    results.append(result("composite/density_batch", seconds / collection.fusion_batch_size * 1000, "ms/frame", False,
+                          cameras=camera_count))
+  return results
+
+
+def bench_report(model: torch.nn.Module, video_path: str, directory: str, args: argparse.Namespace) -> List[Dict[str, Any]]:
+  results = []
+  for camera_count in range(1, args.cameras + 1):
+    camera_utils = CameraUtils(50, os.path.join(directory, f"report_{camera_count}") + "/", 1, cv2.COLORMAP_JET)
+    os.makedirs(camera_utils.output_dir, exist_ok=True)
+    cameras = make_cameras(camera_count, video_path, model, camera_utils, args, projection="sparse",
+                           projection_cache_dir=os.path.join(directory, "projections"), sequential_decode=True)
+    collection = CameraCollection(cameras, camera_utils, streaming=True, write_density_maps=True)
+
+    profiler.configure(enabled=True)
+    profiler.start()
+    # Counts are printed per frame, keep them out of the benchmark output
+    with contextlib.redirect_stdout(io.StringIO()):
+      collection.generate_report()
+    profiler.finish()
+    summary = profiler.summary()
+    results.append(result("report/streaming", summary["frames"] / summary["wall_time_s"], "camera frames/s", True,
+                          cameras=camera_count,
+                          stages={stage: timings["total_s"] for stage, timings in summary["stages"].items()}))
+  return results
+
+
+def get_environment() -> Dict[str, Any]:
+  try:
+    commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    commit = None
+  return {
+    "commit": commit,
+    "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    "python": platform.python_version(),
+    "torch": torch.__version__,
+    "opencv": cv2.__version__,
+    "numpy": np.__version__,
+    "machine": platform.machine(),
+    "cpu_count": os.cpu_count(),
+    "torch_threads": torch.get_num_threads(),
+  }
+
+
+def compare(results: List[Dict[str, Any]], baseline_path: str, tolerance: float) -> bool:
+  """Print each result against the baseline run and return whether none regressed by more than tolerance."""
+  with open(baseline_path) as baseline_file:
+    baseline = json.load(baseline_file)
+  key = lambda entry: (entry["name"], entry.get("cameras"), entry.get("frame_interval"))
+  baseline_results = {key(entry): entry for entry in baseline["results"]}
+
+  passed = True
+  print(f"\nCompared with {baseline_path} (commit {baseline['environment'].get('commit')})")
+  for entry in results:
+    reference = baseline_results.get(key(entry))
+    if reference is None or reference["value"] == 0:
+      continue
+    change = entry["value"] / reference["value"] - 1
+    regression = -change if entry["higher_is_better"] else change
+    status = "REGRESSION" if regression > tolerance else ""
+    passed = passed and not status
+    print(f"{entry['name']:>24} {str(entry.get('cameras') or ''):>3} {reference['value']:>10.3f} -> "
+          f"{entry['value']:>10.3f} {entry['unit']:<16}{change:>+8.1%} {status}")
+  return passed
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description="End-to-end pipeline benchmark on synthetic video with a stub model.")
+  parser.add_argument("--resolution", type=int, nargs=2, default=[1280, 720], metavar=("WIDTH", "HEIGHT"))
+  parser.add_argument("--frames", type=int, default=300, help="length of the synthetic video in frames")
+  parser.add_argument("--fps", type=float, default=30.0)
+  parser.add_argument("--gop-size", type=int, help="keyframe interval of the synthetic video, needs ffmpeg")
+  parser.add_argument("--video", help="benchmark on this video instead of a synthetic one")
+  parser.add_argument("--frame-interval", type=int, default=30)
+  parser.add_argument("--batch-size", type=int, default=2)
+  parser.add_argument("--cameras", type=int, default=2, help="run the report for 1 up to this many cameras")
+  parser.add_argument("--repeats", type=int, default=3)
+  parser.add_argument("--threads", type=int, help="torch intra-op threads")
+  parser.add_argument("--output", default="benchmark_results.json")
+  parser.add_argument("--compare", help="results file of an earlier run to compare against")
+  parser.add_argument("--tolerance", type=float, default=0.1, help="relative slowdown reported as a regression")
+  args = parser.parse_args()
+
+  if args.threads:
+    torch.set_num_threads(args.threads)
+  torch.manual_seed(0)
+  model = StubDensityModel().eval()
+
+  with tempfile.TemporaryDirectory() as directory:
+    video_path = args.video or write_synthetic_video(os.path.join(directory, "synthetic.mp4"), args.frames,
+                                                     tuple(args.resolution), args.fps, gop_size=args.gop_size)
+    camera_utils = CameraUtils(50, directory + "/", 1, cv2.COLORMAP_JET)
+    cache_dir = os.path.join(directory, "projections")
+    with torch.inference_mode():
+      pred_map = model(torch.randn(args.batch_size, 3, 1080, 1920)).numpy()
+
+    results = bench_sampling(video_path, args.frame_interval, args.repeats)
+    results += bench_postprocessing(pred_map, camera_utils, model, video_path, cache_dir, args)
+    results += bench_compositing(pred_map, camera_utils, model, video_path, cache_dir, args)
+    results += bench_report(model, video_path, directory, args)
+
+  for entry in results:
+    print(f"{entry['name']:>24} {str(entry.get('cameras') or ''):>3} {entry['value']:>10.3f} {entry['unit']}")
+
+  configuration = {name: value for name, value in vars(args).items() if name not in ("output", "compare", "tolerance")}
+  with open(args.output, "w") as output_file:
+    json.dump({"environment": get_environment(), "configuration": configuration, "results": results}, output_file, indent=2)
+  print(f"Wrote {args.output}")
+
+  if args.compare and not compare(results, args.compare, args.tolerance):
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
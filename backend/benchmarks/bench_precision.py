@@ -0,0 +1,111 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.camera import Camera
+from src.camera_utils import CameraUtils
+from src.precision import PRECISIONS, apply_precision, get_calibration_frames
+from stub_model import StubDensityModel
+from synthetic_video import write_synthetic_video
+
+LOCAL_COORDINATES = [(797, 293), (287, 653), (1761, 1040), (1734, 411)]
+GLOBAL_COORDINATES = [(0, 0), (0, 80), (100, 80), (100, 0)]
+
+
+def build_model(precision: str, args: argparse.Namespace, calibration_video: str) -> torch.nn.Module:
+  calibration_frames = get_calibration_frames(calibration_video, args.calibration_frames) if precision == "int8" else None
+  if args.model_path:
+    from src.model_wrapper import Model
+    return Model(args.model_path, False, args.block_size, device="cpu", precision=precision,
+                 calibration_frames=calibration_frames).get_model()
+
+  model = StubDensityModel().eval().to(memory_format=torch.channels_last)
+  return apply_precision(model, precision, torch.device("cpu"), calibration_frames)
+
+
+def run(model: torch.nn.Module, video_path: str, directory: str, args: argparse.Namespace) -> Dict[str, Any]:
+  camera_utils = CameraUtils(50, directory + "/", 1, None)
+  camera = Camera(video_path, LOCAL_COORDINATES, GLOBAL_COORDINATES, model, args.frame_interval, args.batch_size,
+                  args.log_parameter, camera_utils, projection="sparse",
+                  projection_cache_dir=os.path.join(directory, "projections"), sequential_decode=True, device="cpu")
+  start = time.perf_counter()
+  with contextlib.redirect_stdout(io.StringIO()):
+    results = list(camera.predict_frames())
+  return {
+    "frames_per_sec": len(results) / (time.perf_counter() - start),
+    "counts": np.array([result.count for result in results]),
+    "densities": np.stack([result.density for result in results]),
+  }
+
+
+def compare(run_result: Dict[str, Any], reference: Dict[str, Any]) -> Dict[str, float]:
+  """Errors of the total counts relative to fp32, and of the people per cell of the global grid."""
+  count_error = np.abs(run_result["counts"] - reference["counts"]) / np.maximum(np.abs(reference["counts"]), 1e-9)
+  cell_error = np.abs(run_result["densities"] - reference["densities"])
+  return {
+    "frames_per_sec": round(run_result["frames_per_sec"], 3),
+    "speedup": round(run_result["frames_per_sec"] / reference["frames_per_sec"], 3),
+    "count_error_mean": float(count_error.mean()),
+    "count_error_max": float(count_error.max()),
+    "cell_error_mean": float(cell_error.mean()),
+    "cell_error_max": float(cell_error.max()),
+    "cell_error_relative": float(cell_error.sum() / max(np.abs(reference["densities"]).sum(), 1e-9)),
+  }
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description="Speed and accuracy of the inference precisions against fp32 on a "
+                                               "reference clip.")
+  parser.add_argument("--model-path", help="SASNet weights; needs the CrowdCounting-SASNet submodule. "
+                                           "Without it the stub model of stub_model.py is measured")
+  parser.add_argument("--video", help="reference clip; a synthetic clip is generated when omitted")
+  parser.add_argument("--calibration-video", help="video the int8 calibration frames are drawn from, by default --video")
+  parser.add_argument("--calibration-frames", type=int, default=16)
+  parser.add_argument("--precisions", nargs="+", default=list(PRECISIONS), choices=PRECISIONS)
+  parser.add_argument("--frame-interval", type=int, default=30)
+  parser.add_argument("--batch-size", type=int, default=1)
+  parser.add_argument("--block-size", type=int, default=32)
+  parser.add_argument("--log-parameter", type=int, default=1000)
+  parser.add_argument("--tolerance", type=float, default=0.02, help="largest acceptable relative count error")
+  parser.add_argument("--output", help="write the report as JSON")
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory() as directory:
+    video_path = args.video or write_synthetic_video(os.path.join(directory, "reference.mp4"), 300)
+    calibration_video = args.calibration_video or video_path
+
+    runs = {}
+    for precision in ["fp32"] + [precision for precision in args.precisions if precision != "fp32"]:
+      runs[precision] = run(build_model(precision, args, calibration_video), video_path, directory, args)
+
+  report: List[Dict[str, Any]] = [{"precision": precision, **compare(run_result, runs["fp32"])}
+                                  for precision, run_result in runs.items()]
+  print(f"{'precision':>10}{'frames/s':>10}{'speedup':>9}{'count err mean':>16}{'count err max':>15}"
+        f"{'cell err mean':>15}{'cell err max':>14}")
+  for entry in report:
+    print(f"{entry['precision']:>10}{entry['frames_per_sec']:>10.3f}{entry['speedup']:>9.2f}"
+          f"{entry['count_error_mean']:>16.3%}{entry['count_error_max']:>15.3%}"
+          f"{entry['cell_error_mean']:>15.2e}{entry['cell_error_max']:>14.2e}")
+
+  within_tolerance = [entry for entry in report if entry["count_error_max"] <= args.tolerance]
+  fastest = max(within_tolerance, key=lambda entry: entry["frames_per_sec"])
+  print(f"Fastest precision with counts within {args.tolerance:.1%} of fp32: {fastest['precision']}")
+
+  if args.output:
+    with open(args.output, "w") as output_file:
+      json.dump({"tolerance": args.tolerance, "recommended": fastest["precision"], "report": report}, output_file, indent=2)
+
+
+if __name__ == "__main__":
+  main()
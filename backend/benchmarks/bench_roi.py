@@ -0,0 +1,85 @@
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.camera import Camera
+from src.camera_geometry import CameraGeometry
+from src.camera_utils import CameraUtils
+from stub_model import StubDensityModel
+from synthetic_video import write_synthetic_video
+
+LOCAL_COORDINATES = [(797, 293), (287, 653), (1761, 1040), (1734, 411)]
+GLOBAL_COORDINATES = [(0, 0), (0, 80), (100, 80), (100, 0)]
+
+
+def build_model(args: argparse.Namespace) -> torch.nn.Module:
+  if args.model_path:
+    from src.model_wrapper import Model
+    return Model(args.model_path, False, args.block_size, device="cpu").get_model()
+  return StubDensityModel().eval().to(memory_format=torch.channels_last)
+
+
+def run(model: torch.nn.Module, video_path: str, directory: str, roi: Optional[Tuple[int, int, int, int]],
+        args: argparse.Namespace) -> Dict[str, Any]:
+  camera_utils = CameraUtils(50, directory + "/", 1, None)
+  camera = Camera(video_path, LOCAL_COORDINATES, GLOBAL_COORDINATES, model, args.frame_interval, args.batch_size,
+                  args.log_parameter, camera_utils, projection="sparse",
+                  projection_cache_dir=os.path.join(directory, "projections"), sequential_decode=True, device="cpu",
+                  roi=roi)
+  start = time.perf_counter()
+  with contextlib.redirect_stdout(io.StringIO()):
+    results = list(camera.predict_frames())
+  densities = np.stack([result.density for result in results])
+  return {
+    "frames_per_sec": len(results) / (time.perf_counter() - start),
+    "quad_counts": densities.sum(axis=(1, 2)),
+    "densities": densities,
+  }
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description="Full-frame inference against inference on the bounding box of the "
+                                               "camera's quadrilateral, for several margins.")
+  parser.add_argument("--model-path", help="SASNet weights; needs the CrowdCounting-SASNet submodule. "
+                                           "Without it the stub model of stub_model.py is measured")
+  parser.add_argument("--video", help="clip to run; a synthetic clip is generated when omitted")
+  parser.add_argument("--margins", type=int, nargs="+", default=[0, 32, 64, 128])
+  parser.add_argument("--frame-interval", type=int, default=30)
+  parser.add_argument("--batch-size", type=int, default=1)
+  parser.add_argument("--block-size", type=int, default=32)
+  parser.add_argument("--log-parameter", type=int, default=1000)
+  args = parser.parse_args()
+
+  model = build_model(args)
+  with tempfile.TemporaryDirectory() as directory:
+    video_path = args.video or write_synthetic_video(os.path.join(directory, "roi.mp4"), 300)
+    geometry = CameraGeometry(CameraUtils(50, directory + "/", 1, None), (1080, 1920),
+                              LOCAL_COORDINATES, GLOBAL_COORDINATES)
+
+    reference = run(model, video_path, directory, None, args)
+    print(f"{'margin':>8}{'roi':>24}{'pixels':>9}{'frames/s':>10}{'speedup':>9}{'quad count err max':>20}"
+          f"{'cell err max':>14}")
+    print(f"{'full':>8}{'':>24}{1:>9.1%}{reference['frames_per_sec']:>10.3f}{1:>9.2f}")
+    for margin in args.margins:
+      roi = geometry.get_roi(margin)
+      result = run(model, video_path, directory, roi, args)
+      count_error = (np.abs(result["quad_counts"] - reference["quad_counts"])
+                     / np.maximum(np.abs(reference["quad_counts"]), 1e-9))
+      cell_error = np.abs(result["densities"] - reference["densities"])
+      print(f"{margin:>8}{str(roi):>24}{roi[2] * roi[3] / (1920 * 1080):>9.1%}{result['frames_per_sec']:>10.3f}"
+            f"{result['frames_per_sec'] / reference['frames_per_sec']:>9.2f}{count_error.max():>20.3%}"
+            f"{cell_error.max():>14.2e}")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,65 @@
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.tiled_model import TiledModel
+from bench_cpu_inference import build_sasnet
+
+
+def run_once(args: argparse.Namespace) -> None:
+  """Run one configuration and print its count, time and peak RSS; called in a fresh process per configuration."""
+  torch.manual_seed(0)
+  network = build_sasnet(args.block_size).to(memory_format=torch.channels_last)
+  if args.tile_size:
+    network = TiledModel(network, tuple(args.tile_size), args.overlap, args.tiles_per_batch)
+  frames = torch.rand(args.batch_size, 3, 1080, 1920).contiguous(memory_format=torch.channels_last)
+
+  with torch.inference_mode():
+    start = time.perf_counter()
+    count = network(frames).sum().item()
+    elapsed = time.perf_counter() - start
+
+  peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+  print(f"{count} {args.batch_size / elapsed} {peak_rss_mb}")
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description="Full-frame against tiled SASNet inference at 1920x1080.")
+  parser.add_argument("--tile-size", type=int, nargs=2, metavar=("WIDTH", "HEIGHT"))
+  parser.add_argument("--overlap", type=int, default=64)
+  parser.add_argument("--tiles-per-batch", type=int, default=4)
+  parser.add_argument("--batch-size", type=int, default=1)
+  parser.add_argument("--block-size", type=int, default=32)
+  parser.add_argument("--single", action="store_true", help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.single:
+    run_once(args)
+    return
+
+  configurations = [[]]
+  for tile_size in ([512, 512], [768, 544], [1024, 1088]):
+    for tiles_per_batch in (1, 4):
+      configurations.append(["--tile-size", *map(str, tile_size), "--tiles-per-batch", str(tiles_per_batch)])
+
+  print(f"{'tiles':>12}{'per batch':>10}{'count error':>13}{'frames/s':>10}{'peak RSS MB':>13}")
+  full_count = None
+  for configuration in configurations:
+    command = [sys.executable, os.path.abspath(__file__), "--single", "--overlap", str(args.overlap),
+               "--batch-size", str(args.batch_size), "--block-size", str(args.block_size), *configuration]
+    count, fps, peak_rss_mb = map(float, subprocess.run(command, capture_output=True, text=True, check=True).stdout.split())
+    full_count = count if full_count is None else full_count
+    tiles = "x".join(configuration[1:3]) if configuration else "full frame"
+    tiles_per_batch = configuration[4] if configuration else "-"
+    print(f"{tiles:>12}{tiles_per_batch:>10}{(count - full_count) / full_count:>12.3%}{fps:>10.3f}{peak_rss_mb:>13.0f}")
+
+
+if __name__ == "__main__":
+  main()
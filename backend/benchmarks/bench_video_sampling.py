@@ -0,0 +1,55 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+from typing import Iterable, Tuple
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.video_frame_dataset import VideoFrameDataset
+from src.sequential_video_frame_dataset import SequentialVideoFrameDataset
+from synthetic_video import write_synthetic_video
+
+
+def to_tensor(frame) -> torch.Tensor:
+  return torch.from_numpy(frame)
+
+
+def measure(frames: Iterable[Tuple[int, torch.Tensor]]) -> float:
+  start = time.perf_counter()
+  count = sum(1 for _ in frames)
+  return count / (time.perf_counter() - start)
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description="Compare seek-based and sequential frame sampling.")
+  parser.add_argument("--video", help="Video to sample; a synthetic video is generated when omitted")
+  parser.add_argument("--frames", type=int, default=1800, help="Length of the synthetic video in frames")
+  parser.add_argument("--intervals", type=int, nargs="+", default=[10, 30, 300])
+  parser.add_argument("--seek-threshold", type=int, default=60,
+                      help="Seek threshold of the hybrid run, roughly the keyframe interval of the video")
+  args = parser.parse_args()
+
+  video_path = args.video
+  if video_path is None:
+    video_path = os.path.join(tempfile.mkdtemp(), "synthetic.mp4")
+    write_synthetic_video(video_path, args.frames)
+
+  print(f"{'interval':>9}{'samples':>9}{'seek fps':>11}{'sequential fps':>16}{'hybrid fps':>12}")
+  for interval in args.intervals:
+    seek_dataset = VideoFrameDataset(video_path, transform=to_tensor, frame_interval=interval)
+    sequential_dataset = SequentialVideoFrameDataset(video_path, transform=to_tensor, frame_interval=interval)
+    hybrid_dataset = SequentialVideoFrameDataset(video_path, transform=to_tensor, frame_interval=interval,
+                                                 seek_threshold=args.seek_threshold)
+
+    seek_fps = measure(seek_dataset[idx] for idx in range(len(seek_dataset)))
+    sequential_fps = measure(sequential_dataset)
+    hybrid_fps = measure(hybrid_dataset)
+    print(f"{interval:>9}{len(sequential_dataset):>9}{seek_fps:>11.1f}{sequential_fps:>16.1f}{hybrid_fps:>12.1f}")
+
+
+if __name__ == "__main__":
+  main()
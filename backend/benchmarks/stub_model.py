@@ -0,0 +1,24 @@
+import torch
+import torch.nn.functional
+
+
+class StubDensityModel(torch.nn.Module):
+  """Stands in for SASNet: a cheap fixed network that maps (N, 3, H, W) frames to (N, 1, H, W) density maps.
+
+  The frame is pooled to 1/8 of its size, where SASNet's decoder also works, passed through two small
+  convolutions and upsampled back, so the density maps have SASNet's shape and are smooth and non-negative.
+  """
+
+  def __init__(self, seed: int = 0) -> None:
+    super().__init__()
+    generator = torch.Generator().manual_seed(seed)
+    self.features = torch.nn.Conv2d(3, 16, 3, padding=1)
+    self.density = torch.nn.Conv2d(16, 1, 1)
+    with torch.no_grad():
+      for parameter in self.parameters():
+        parameter.copy_(torch.randn(parameter.shape, generator=generator) * 0.1)
+
+  def forward(self, img: torch.Tensor) -> torch.Tensor:
+    pooled = torch.nn.functional.avg_pool2d(img, 8)
+    density = torch.nn.functional.softplus(self.density(torch.relu(self.features(pooled))))
+    return torch.nn.functional.interpolate(density, size=img.shape[2:], mode="bilinear", align_corners=False) / 64
@@ -0,0 +1,65 @@
+from typing import Iterator, Optional, Tuple
+import shutil
+import subprocess
+import numpy as np
+import cv2
+
+
+def synthetic_frames(frame_count: int, resolution: Tuple[int, int], seed: int) -> Iterator[np.ndarray]:
+  """Moving blobs on a textured background, so that frames neither compress to nothing nor repeat."""
+  rng = np.random.default_rng(seed)
+  width, height = resolution
+  background = cv2.GaussianBlur(rng.integers(0, 255, (height, width, 3), dtype=np.uint8), (0, 0), 3)
+  positions = rng.random((200, 2)) * (width, height)
+  velocities = rng.normal(0, 2, (200, 2))
+
+  for _ in range(frame_count):
+    frame = background.copy()
+    positions = (positions + velocities) % (width, height)
+    for x, y in positions.astype(int):
+      cv2.circle(frame, (int(x), int(y)), 6, (20, 20, 20), -1)
+    yield frame
+
+
+def write_synthetic_video(
+  path: str,
+  frame_count: int,
+  resolution: Tuple[int, int] = (1280, 720),
+  fps: float = 30.0,
+  seed: int = 0,
+  gop_size: Optional[int] = None
+) -> str:
+  """Write a synthetic video. OpenCV's writer cannot set the keyframe interval, so a gop_size needs ffmpeg,
+  which encodes H.264 with a keyframe exactly every gop_size frames."""
+  if gop_size is not None:
+    return write_with_ffmpeg(path, synthetic_frames(frame_count, resolution, seed), resolution, fps, gop_size)
+
+  out = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, resolution)
+  if not out.isOpened():
+    raise ValueError(f"Unable to open a video writer for {path}")
+
+  for frame in synthetic_frames(frame_count, resolution, seed):
+    out.write(frame)
+
+  out.release()
+  return path
+
+
+def write_with_ffmpeg(path: str, frames: Iterator[np.ndarray], resolution: Tuple[int, int], fps: float, gop_size: int) -> str:
+  ffmpeg = shutil.which("ffmpeg")
+  if ffmpeg is None:
+    raise ValueError("Writing a video with a given GOP size needs ffmpeg on the PATH.")
+
+  command = [ffmpeg, "-loglevel", "error", "-y", "-f", "rawvideo", "-pix_fmt", "bgr24",
+             "-s", f"{resolution[0]}x{resolution[1]}", "-r", str(fps), "-i", "-",
+             "-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p",
+             "-g", str(gop_size), "-keyint_min", str(gop_size), "-sc_threshold", "0", path]
+  encoder = subprocess.Popen(command, stdin=subprocess.PIPE)
+  try:
+    for frame in frames:
+      encoder.stdin.write(frame.tobytes())
+  finally:
+    encoder.stdin.close()
+  if encoder.wait() != 0:
+    raise ValueError(f"ffmpeg failed to write {path}")
+  return path
@@ -0,0 +1,28 @@
+import argparse
+import time
+
+from src.inference_cache import hash_file_cached
+from src.model_wrapper import Model, export_torchscript
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description="Export SASNet with its weights to a single TorchScript file, "
+                                               "which main.py loads through MODEL_ARTIFACT.")
+  parser.add_argument("--model-path", default="/work/weights/SHHA.pth")
+  parser.add_argument("--block-size", type=int, default=32)
+  parser.add_argument("--output", default="/work/weights/SASNet_SHHA.pt")
+  parser.add_argument("--device", default="cpu", help="device the model is traced on, it can be loaded on any device")
+  parser.add_argument("--size", type=int, nargs=2, default=[1920, 1080], metavar=("WIDTH", "HEIGHT"),
+                      help="frame size the model is run at, the TILE_SIZE when tiling")
+  parser.add_argument("--no-channels-last", dest="channels_last", action="store_false")
+  args = parser.parse_args()
+
+  start = time.perf_counter()
+  model = Model(args.model_path, False, args.block_size, device=args.device, channels_last=args.channels_last).get_model()
+  export_torchscript(model, args.output, (3, args.size[1], args.size[0]), args.channels_last,
+                     weights_hash=hash_file_cached(args.model_path))
+  print(f"Exported {args.model_path} to {args.output} in {time.perf_counter() - start:.1f} s")
+
+
+if __name__ == "__main__":
+  main()
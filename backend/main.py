@@ -1,26 +1,112 @@
 from src.camera_collection import CameraCollection
 from src.camera_utils import CameraUtils
 from src.camera import Camera
+from src.camera_geometry import CameraGeometry
 from src.model_wrapper import Model
+from src.tiled_model import TiledModel
+from src.batch_size_tuner import BatchSizeTuner
+from src.inference_cache import InferenceCache
+from src.profiler import profiler
+from src.precision import get_calibration_frames
+from src.frame_transform import IMAGENET_MEAN, IMAGENET_STD
+from src.device import resolve_device
 from src.video_frame_dataset import VideoFrameDataset
+from typing import Optional, Tuple
+from datetime import datetime
 import cv2
 
 class GLOBAL_CONFIG:
   FRAME_INTERVAL: int = 300
+  # Sample every FRAME_INTERVAL_SECONDS seconds instead of every FRAME_INTERVAL frames when set
+  FRAME_INTERVAL_SECONDS: Optional[float] = None
+  # Sample when the scene changes or the counts drift, at least MIN_FRAME_INTERVAL and at most FRAME_INTERVAL
+  # frames apart. Needs NUM_WORKERS = 0 and is not checkpointed
+  ADAPTIVE_SAMPLING: bool = False
+  MIN_FRAME_INTERVAL: int = 30
+  # Mean absolute difference in grey levels of downscaled frames that counts as a scene change
+  CHANGE_THRESHOLD: float = 4.0
+  # Relative change between the last two counts that keeps sampling every MIN_FRAME_INTERVAL frames
+  DRIFT_THRESHOLD: float = 0.1
+  # Seconds of video between output frames, which show every camera's latest result. Required with adaptive
+  # sampling, None writes one output frame per sampled frame
+  TIMELINE_INTERVAL: Optional[float] = None
+  # Decode the video once from start to end instead of seeking to every sampled frame
+  SEQUENTIAL_DECODE: bool = True
+  # Seek instead of decoding through gaps longer than this many frames, roughly the video's keyframe interval.
+  # None only seeks to the start of each shard, which decodes every frame of the video
+  SEEK_THRESHOLD: Optional[int] = 60
+  # Worker processes decoding and resizing frames, each decoding its own contiguous shards of the video
+  NUM_WORKERS: int = 0
+  PREFETCH_FACTOR: Optional[int] = None
+  PERSISTENT_WORKERS: bool = False
+  # Sampled frames per shard, by default a few batches so that the workers decode close together in the video
+  SHARD_SIZE: Optional[int] = None
   BATCH_SIZE: int = 1
+  # Read a live source instead of the video file: an RTSP/HTTP URL, a webcam index such as "0", a named pipe
+  # or "-" for stdin. Raw bgr24 pipes need LIVE_FRAME_SIZE (width, height). LIVE_REPLAY plays a file in real time
+  LIVE_SOURCE: Optional[str] = None
+  LIVE_FPS: Optional[float] = 1.0
+  LIVE_FRAME_SIZE: Optional[Tuple[int, int]] = None
+  LIVE_REPLAY: bool = False
+  # Replace BATCH_SIZE with the largest batch, up to MAX_BATCH_SIZE, that fits MEMORY_BUDGET_MB on the device
+  AUTOTUNE_BATCH_SIZE: bool = False
+  MAX_BATCH_SIZE: int = 32
+  # None uses 80% of the memory currently available on the device
+  MEMORY_BUDGET_MB: Optional[int] = None
   MODEL_PATH: str = "/work/weights/SHHA.pth"
+  # TorchScript export of the model (see export_model.py), loaded instead of building SASNet when it exists and
+  # was exported from the weights at MODEL_PATH
+  MODEL_ARTIFACT: Optional[str] = "/work/weights/SASNet_SHHA.pt"
   OUTPUT_DIR: str = "/work/output/"
   USE_PRETRAINED: bool = True
+  # "cpu", "cuda" or "auto" to use CUDA when it is available
+  DEVICE: str = "auto"
+  # Intra-op threads for CPU inference, None keeps the torch default
+  NUM_THREADS: Optional[int] = None
+  CHANNELS_LAST: bool = True
+  # "fp32", "bf16" (autocast) or "int8" (CPU only, backbone quantized with CALIBRATION_FRAMES frames of
+  # CALIBRATION_VIDEO). Compare them on a reference clip with benchmarks/bench_precision.py before switching
+  PRECISION: str = "fp32"
+  CALIBRATION_VIDEO: str = "/work/input/DJI_0461_trimmed.MP4"
+  CALIBRATION_FRAMES: int = 16
+  # Run SASNet on overlapping (width, height) tiles instead of full frames to bound memory, None disables tiling
+  TILE_SIZE: Optional[Tuple[int, int]] = None
+  TILE_OVERLAP: int = 64
+  TILES_PER_BATCH: int = 4
+  # Infer only the bounding box of local_coords, widened by ROI_MARGIN pixels of context for the model, instead
+  # of the whole frame. Counts then cover the box, the global density map is unaffected. None disables it
+  ROI_MARGIN: Optional[int] = None
+  # (width, height) every frame is resized to after decoding, local_coords are in its pixels
+  FRAME_SIZE: Tuple[int, int] = (1920, 1080)
   BLOCK_SIZE: int = 32
   LOG_PARAMETER: int = 1000
   HEATMAP_ALPHA: int = 50
   UPSAMPLING_FACTOR: int = 1
   COLOR_MAP = None
   #COLOR_MAP = cv2.COLORMAP_JET
+  # "sparse" conserves the count of every pixel inside local_coords, "warp" is the original warpPerspective
+  PROJECTION: str = "sparse"
+  PROJECTION_CACHE_DIR: str = "/work/output/projections/"
+  # Checkpoint every frame's model output here and skip checkpointed frames on the next run, None disables it.
+  # Heatmap settings are not part of the checkpoint key, changing them re-renders without running the model
+  CHECKPOINT_DIR: Optional[str] = "/work/output/checkpoints/"
+  # Cache density maps by weights and decoded frame, so frames shared by overlapping clips are inferred once.
+  # None disables the cache
+  INFERENCE_CACHE_DIR: Optional[str] = "/work/output/inference_cache/"
+  INFERENCE_CACHE_SIZE_MB: int = 2048
+  # Write each output frame as soon as every camera has produced it instead of keeping all heatmaps in memory
+  STREAMING: bool = True
+  MAX_IN_FLIGHT_FRAMES: int = 4
+  # Gather frames from all cameras into shared inference batches of this many frames, None runs cameras separately
+  CROSS_CAMERA_BATCH_SIZE: Optional[int] = None
+  # Also write the float32 people-per-cell maps of the global grid, memory-mappable with DensityMapReader
+  WRITE_DENSITY_MAPS: bool = True
+  DENSITY_CHUNK_FRAMES: int = 256
+  # Time every pipeline stage and write p50/p95/p99 per stage, frames/sec and peak memory to OUTPUT_DIR
+  PROFILE: bool = False
+  # Also write a Chrome trace (chrome://tracing or Perfetto) of every stage call
+  PROFILE_TRACE: bool = False
 
-model = Model(GLOBAL_CONFIG.MODEL_PATH,
-              GLOBAL_CONFIG.USE_PRETRAINED,
-              GLOBAL_CONFIG.BLOCK_SIZE).get_model()
 local_coords = [(797, 293), (287, 653), (1761, 1040), (1734, 411)]
 global_coords = [(0, 0), (0, 80), (100, 80), (100, 0)]
 
@@ -29,15 +115,114 @@ camera_utils = CameraUtils(GLOBAL_CONFIG.HEATMAP_ALPHA,
                            GLOBAL_CONFIG.UPSAMPLING_FACTOR,
                            GLOBAL_CONFIG.COLOR_MAP)
 
-camera = Camera("/work/input/DJI_0461_trimmed.MP4",
+roi = None
+input_shape = (3, GLOBAL_CONFIG.FRAME_SIZE[1], GLOBAL_CONFIG.FRAME_SIZE[0])
+if GLOBAL_CONFIG.ROI_MARGIN is not None:
+  roi = CameraGeometry(camera_utils, input_shape[1:], local_coords, global_coords).get_roi(GLOBAL_CONFIG.ROI_MARGIN)
+  input_shape = (3, roi[3], roi[2])
+
+model = Model(GLOBAL_CONFIG.MODEL_PATH,
+              GLOBAL_CONFIG.USE_PRETRAINED,
+              GLOBAL_CONFIG.BLOCK_SIZE,
+              device=GLOBAL_CONFIG.DEVICE,
+              num_threads=GLOBAL_CONFIG.NUM_THREADS,
+              channels_last=GLOBAL_CONFIG.CHANNELS_LAST,
+              artifact_path=GLOBAL_CONFIG.MODEL_ARTIFACT,
+              precision=GLOBAL_CONFIG.PRECISION,
+              calibration_frames=get_calibration_frames(GLOBAL_CONFIG.CALIBRATION_VIDEO, GLOBAL_CONFIG.CALIBRATION_FRAMES,
+                                                        GLOBAL_CONFIG.FRAME_SIZE)
+                                 if GLOBAL_CONFIG.PRECISION == "int8" else None)
+frame_shape = input_shape
+if GLOBAL_CONFIG.TILE_SIZE:
+  frame_shape = (3, min(GLOBAL_CONFIG.TILE_SIZE[1], input_shape[1]), min(GLOBAL_CONFIG.TILE_SIZE[0], input_shape[2]))
+if model.input_shape is not None and model.input_shape != frame_shape:
+  raise ValueError(f"{GLOBAL_CONFIG.MODEL_ARTIFACT} was exported for {model.input_shape} frames, not {frame_shape}; "
+                   f"export it again with --size {frame_shape[2]} {frame_shape[1]}.")
+# Results are keyed on the weights of the model that was loaded, which is the export's when it was loaded
+weights_hash = model.weights_hash
+model = model.get_model()
+if GLOBAL_CONFIG.TILE_SIZE:
+  model = TiledModel(model, GLOBAL_CONFIG.TILE_SIZE, GLOBAL_CONFIG.TILE_OVERLAP, GLOBAL_CONFIG.TILES_PER_BATCH)
+
+batch_size = GLOBAL_CONFIG.BATCH_SIZE
+if GLOBAL_CONFIG.AUTOTUNE_BATCH_SIZE:
+  batch_size = BatchSizeTuner(model,
+                              resolve_device(GLOBAL_CONFIG.DEVICE),
+                              GLOBAL_CONFIG.MEMORY_BUDGET_MB,
+                              GLOBAL_CONFIG.MAX_BATCH_SIZE,
+                              input_shape=input_shape,
+                              channels_last=GLOBAL_CONFIG.CHANNELS_LAST).probe()
+
+inference_cache = None
+if GLOBAL_CONFIG.INFERENCE_CACHE_DIR:
+  inference_cache = InferenceCache(GLOBAL_CONFIG.INFERENCE_CACHE_DIR,
+                                   dict(weights=weights_hash,
+                                        use_pretrained=GLOBAL_CONFIG.USE_PRETRAINED,
+                                        block_size=GLOBAL_CONFIG.BLOCK_SIZE,
+                                        tile_size=GLOBAL_CONFIG.TILE_SIZE,
+                                        tile_overlap=GLOBAL_CONFIG.TILE_OVERLAP,
+                                        precision=GLOBAL_CONFIG.PRECISION,
+                                        frame_size=GLOBAL_CONFIG.FRAME_SIZE,
+                                        roi=roi,
+                                        mean=IMAGENET_MEAN,
+                                        std=IMAGENET_STD),
+                                   GLOBAL_CONFIG.INFERENCE_CACHE_SIZE_MB)
+
+camera = Camera(GLOBAL_CONFIG.LIVE_SOURCE or "/work/input/DJI_0461_trimmed.MP4",
                 local_coords,
                 global_coords,
                 model,
                 GLOBAL_CONFIG.FRAME_INTERVAL,
-                GLOBAL_CONFIG.BATCH_SIZE,
+                batch_size,
                 GLOBAL_CONFIG.LOG_PARAMETER,
-                camera_utils
+                camera_utils,
+                projection=GLOBAL_CONFIG.PROJECTION,
+                projection_cache_dir=GLOBAL_CONFIG.PROJECTION_CACHE_DIR,
+                sequential_decode=GLOBAL_CONFIG.SEQUENTIAL_DECODE,
+                time_interval=GLOBAL_CONFIG.FRAME_INTERVAL_SECONDS,
+                seek_threshold=GLOBAL_CONFIG.SEEK_THRESHOLD,
+                num_workers=GLOBAL_CONFIG.NUM_WORKERS,
+                prefetch_factor=GLOBAL_CONFIG.PREFETCH_FACTOR,
+                persistent_workers=GLOBAL_CONFIG.PERSISTENT_WORKERS,
+                shard_size=GLOBAL_CONFIG.SHARD_SIZE,
+                device=GLOBAL_CONFIG.DEVICE,
+                channels_last=GLOBAL_CONFIG.CHANNELS_LAST,
+                checkpoint_dir=None if GLOBAL_CONFIG.LIVE_SOURCE or GLOBAL_CONFIG.ADAPTIVE_SAMPLING else GLOBAL_CONFIG.CHECKPOINT_DIR,
+                checkpoint_config=dict(weights=weights_hash,
+                                       use_pretrained=GLOBAL_CONFIG.USE_PRETRAINED,
+                                       block_size=GLOBAL_CONFIG.BLOCK_SIZE,
+                                       tile_size=GLOBAL_CONFIG.TILE_SIZE,
+                                       tile_overlap=GLOBAL_CONFIG.TILE_OVERLAP,
+                                       precision=GLOBAL_CONFIG.PRECISION),
+                inference_cache=inference_cache,
+                live=GLOBAL_CONFIG.LIVE_SOURCE is not None,
+                live_fps=GLOBAL_CONFIG.LIVE_FPS,
+                live_frame_size=GLOBAL_CONFIG.LIVE_FRAME_SIZE,
+                live_replay=GLOBAL_CONFIG.LIVE_REPLAY,
+                adaptive_sampling=GLOBAL_CONFIG.ADAPTIVE_SAMPLING,
+                min_frame_interval=GLOBAL_CONFIG.MIN_FRAME_INTERVAL,
+                change_threshold=GLOBAL_CONFIG.CHANGE_THRESHOLD,
+                drift_threshold=GLOBAL_CONFIG.DRIFT_THRESHOLD,
+                roi=roi,
+                frame_size=GLOBAL_CONFIG.FRAME_SIZE
                 )
 
-camera_collection = CameraCollection([camera], camera_utils)
-camera_collection.generate_report()
\ No newline at end of file
+camera_collection = CameraCollection([camera],
+                                     camera_utils,
+                                     streaming=GLOBAL_CONFIG.STREAMING,
+                                     max_in_flight_frames=GLOBAL_CONFIG.MAX_IN_FLIGHT_FRAMES,
+                                     batch_size=GLOBAL_CONFIG.CROSS_CAMERA_BATCH_SIZE,
+                                     write_density_maps=GLOBAL_CONFIG.WRITE_DENSITY_MAPS,
+                                     density_chunk_frames=GLOBAL_CONFIG.DENSITY_CHUNK_FRAMES,
+                                     timeline_interval=GLOBAL_CONFIG.TIMELINE_INTERVAL)
+profiler.configure(enabled=GLOBAL_CONFIG.PROFILE, trace=GLOBAL_CONFIG.PROFILE_TRACE)
+profiler.start()
+try:
+  camera_collection.generate_report()
+finally:
+  profiler.finish()
+  if GLOBAL_CONFIG.PROFILE:
+    time_str = datetime.now().strftime('%H:%M')
+    profiler.write_summary(f"{GLOBAL_CONFIG.OUTPUT_DIR}profile_{time_str}.json")
+    if GLOBAL_CONFIG.PROFILE_TRACE:
+      profiler.write_trace(f"{GLOBAL_CONFIG.OUTPUT_DIR}trace_{time_str}.json")
\ No newline at end of file
@@ -0,0 +1,129 @@
+from torch.utils.data import IterableDataset, get_worker_info
+from typing import Optional, Tuple, Callable, Iterator, List, Dict
+import numpy as np
+import torch
+import cv2
+
+from src.profiler import profiler
+
+class AdaptiveVideoFrameDataset(IterableDataset):
+  """Samples frames when the scene changes or the counts drift, instead of at a fixed stride.
+
+  The video is decoded sequentially. Every check_interval frames, a downscaled grayscale copy of the frame is
+  compared with that of the last sampled frame, and the frame is sampled when their mean absolute difference
+  exceeds change_threshold (in grey levels). While the last two counts reported with report_count differ by
+  more than drift_threshold, frames are sampled every min_interval frames. Samples are never closer than
+  min_interval frames and never further apart than max_interval frames.
+
+  Sampling depends on the counts of earlier samples, so the dataset must be read in the process that runs
+  the model (num_workers=0). Counts arrive one batch late, so smaller batches react faster. The timestamp
+  of every sampled frame is read from the video's presentation timestamps, which also holds for videos
+  with a variable frame rate.
+  """
+
+  def __init__(
+    self,
+    video_path: str,
+    transform: Optional[Callable] = None,
+    target_resolution: Tuple[int, int] = (1920, 1080),
+    min_interval: int = 30,
+    max_interval: int = 300,
+    change_threshold: float = 4.0,
+    drift_threshold: float = 0.1,
+    check_interval: int = 1,
+    detector_size: Tuple[int, int] = (64, 36)
+  ) -> None:
+    self.video_path: str = video_path
+    self.transform: Optional[Callable] = transform
+    self.target_resolution: Tuple[int, int] = target_resolution
+    self.min_interval: int = min_interval
+    self.max_interval: int = max_interval
+    self.change_threshold: float = change_threshold
+    self.drift_threshold: float = drift_threshold
+    self.check_interval: int = check_interval
+    self.detector_size: Tuple[int, int] = detector_size
+    self.cap: Optional[cv2.VideoCapture] = None
+
+    cap = cv2.VideoCapture(video_path)
+    self.total_frames: int = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    self.fps: float = cap.get(cv2.CAP_PROP_FPS)
+    cap.release()
+
+    # Filled while the video is read: the sampled frames, their timestamps in seconds and their counts
+    self.frame_indices: List[int] = []
+    self.timestamps: Dict[int, float] = {}
+    self.counts: List[float] = []
+
+  def open(self) -> None:
+    if self.cap is None:
+      self.cap = cv2.VideoCapture(self.video_path)
+
+  def report_count(self, count: float) -> None:
+    self.counts.append(count)
+
+  def is_drifting(self) -> bool:
+    if len(self.counts) < 2:
+      return False
+    previous, last = self.counts[-2:]
+    return abs(last - previous) > self.drift_threshold * max(abs(previous), 1e-9)
+
+  def get_detector_frame(self, frame: np.ndarray) -> np.ndarray:
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, self.detector_size, interpolation=cv2.INTER_AREA).astype(np.float32)
+
+  def prepare_frame(self, frame: np.ndarray) -> torch.Tensor:
+    with profiler.stage("resize"):
+      frame = cv2.resize(frame, self.target_resolution, interpolation=cv2.INTER_LINEAR)
+
+    if self.transform:
+      with profiler.stage("normalize"):
+        frame = self.transform(frame)
+
+    return frame
+
+  def __iter__(self) -> Iterator[Tuple[int, torch.Tensor]]:
+    if get_worker_info() is not None:
+      raise ValueError("Adaptive sampling depends on the counts, it cannot run in DataLoader worker processes.")
+
+    self.frame_indices = []
+    self.timestamps = {}
+    self.counts = []
+    self.open()
+    cap = self.cap
+    try:
+      reference: Optional[np.ndarray] = None
+      last_sample = -1
+      frame_index = -1
+      while True:
+        with profiler.stage("decode"):
+          if not cap.grab():
+            return
+        frame_index += 1
+        since_sample = frame_index - last_sample
+
+        if reference is not None:
+          if since_sample < self.min_interval:
+            continue
+          due = since_sample >= self.max_interval or self.is_drifting()
+          if not due and since_sample % self.check_interval:
+            continue
+
+        with profiler.stage("decode"):
+          ret, frame = cap.retrieve()
+        if not ret:
+          raise ValueError("Failed to read frame from the video.")
+
+        with profiler.stage("change_detection"):
+          detector_frame = self.get_detector_frame(frame)
+          if reference is not None and not due:
+            if np.mean(np.abs(detector_frame - reference)) <= self.change_threshold:
+              continue
+
+        reference = detector_frame
+        last_sample = frame_index
+        self.frame_indices.append(frame_index)
+        self.timestamps[frame_index] = cap.get(cv2.CAP_PROP_POS_MSEC) / 1000
+        yield frame_index, self.prepare_frame(frame)
+    finally:
+      cap.release()
+      self.cap = None
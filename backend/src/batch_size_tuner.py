@@ -0,0 +1,121 @@
+from typing import List, Optional, Tuple
+import os
+import threading
+import time
+import torch
+import torch.nn
+
+from src.memory import get_current_rss, get_peak_rss
+
+def is_out_of_memory(error: BaseException) -> bool:
+  if isinstance(error, torch.cuda.OutOfMemoryError):
+    return True
+  message = str(error)
+  return isinstance(error, RuntimeError) and ("out of memory" in message or "can't allocate memory" in message)
+
+def get_available_memory(device: torch.device) -> int:
+  """Memory in bytes that inference on the device may still use."""
+  if device.type == "cuda":
+    free, _ = torch.cuda.mem_get_info(device)
+    return free
+  try:
+    with open("/proc/meminfo") as meminfo:
+      for line in meminfo:
+        if line.startswith("MemAvailable:"):
+          return int(line.split()[1]) * 1024
+  except OSError:
+    pass
+  return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+class BatchSizeTuner:
+  """Finds the largest inference batch that fits a memory budget on the model's device.
+
+  Batch sizes are probed by doubling from 1. On CUDA the peak allocated memory of each probe is measured,
+  on the CPU the peak RSS during the probe over the RSS before it. The process's lifetime peak RSS only
+  shows a probe's peak when the probe raised it, as earlier peaks such as loading the model may be higher,
+  so the RSS is also sampled while the probe runs. Probing stops at the first batch size that exceeds the
+  budget or runs out of memory. Without an explicit budget, budget_fraction of the memory that is
+  currently available on the device is used.
+  """
+
+  def __init__(
+    self,
+    model: torch.nn.Module,
+    device: torch.device,
+    memory_budget_mb: Optional[int] = None,
+    max_batch_size: int = 32,
+    input_shape: Tuple[int, int, int] = (3, 1080, 1920),
+    channels_last: bool = True,
+    budget_fraction: float = 0.8
+  ) -> None:
+    self.model: torch.nn.Module = model
+    self.device: torch.device = device
+    self.max_batch_size: int = max_batch_size
+    self.input_shape: Tuple[int, int, int] = input_shape
+    self.memory_format: torch.memory_format = torch.channels_last if channels_last else torch.contiguous_format
+    if memory_budget_mb is None:
+      self.memory_budget: int = int(get_available_memory(device) * budget_fraction)
+    else:
+      self.memory_budget = memory_budget_mb * 1024 * 1024
+
+  def measure(self, batch_size: int) -> Tuple[int, float]:
+    """Run one batch and return the memory it needed in bytes and its throughput in frames/sec."""
+    img = torch.zeros(batch_size, *self.input_shape).to(self.device, memory_format=self.memory_format)
+    if self.device.type == "cuda":
+      torch.cuda.synchronize(self.device)
+      torch.cuda.reset_peak_memory_stats(self.device)
+      baseline = torch.cuda.memory_allocated(self.device)
+    else:
+      baseline = get_current_rss()
+      peak_before = get_peak_rss()
+      sampled_peak = [baseline]
+      done = threading.Event()
+      sampler = threading.Thread(target=self.sample_rss, args=(done, sampled_peak), daemon=True)
+      sampler.start()
+
+    start = time.perf_counter()
+    try:
+      with torch.inference_mode():
+        self.model.eval()
+        self.model(img)
+    finally:
+      if self.device.type != "cuda":
+        done.set()
+        sampler.join()
+
+    if self.device.type == "cuda":
+      torch.cuda.synchronize(self.device)
+      used = torch.cuda.max_memory_allocated(self.device) - baseline
+    else:
+      peak = get_peak_rss()
+      used = max(sampled_peak[0], peak if peak > peak_before else 0) - baseline
+    return used, batch_size / (time.perf_counter() - start)
+
+  @staticmethod
+  def sample_rss(done: threading.Event, peak: List[int], interval: float = 0.001) -> None:
+    """Record the highest RSS in peak[0] until done is set."""
+    while not done.wait(interval):
+      peak[0] = max(peak[0], get_current_rss())
+
+  def probe(self) -> int:
+    best_batch_size = 1
+    batch_size = 1
+    while batch_size <= self.max_batch_size:
+      try:
+        used, fps = self.measure(batch_size)
+      except RuntimeError as error:
+        if not is_out_of_memory(error):
+          raise
+        break
+      finally:
+        if self.device.type == "cuda":
+          torch.cuda.empty_cache()
+
+      print(f"Batch size {batch_size}: {used / 1024 ** 2:.0f} MB, {fps:.2f} frames/sec")
+      if used > self.memory_budget:
+        break
+      best_batch_size = batch_size
+      batch_size *= 2
+
+    print(f"Chosen batch size: {best_batch_size} (budget {self.memory_budget / 1024 ** 2:.0f} MB)")
+    return best_batch_size
@@ -1,13 +1,37 @@
-from typing import List, Tuple, Optional
+from typing import List, Tuple, Optional, Dict, Iterator, NamedTuple, Set, Any, Callable
 import torch
 import torch.nn
 import numpy as np
-import torchvision.transforms as standard_transforms
 from torch.utils.data import DataLoader
 import gc
+import time
+import itertools
+import queue
 
 from src.camera_utils import CameraUtils 
-from src.video_frame_dataset import VideoFrameDataset  
+from src.device import resolve_device
+from src.batch_size_tuner import is_out_of_memory
+from src.camera_geometry import CameraGeometry
+from src.frame_transform import FrameTransform, IMAGENET_MEAN, IMAGENET_STD
+from src.frame_checkpoint import FrameCheckpoint
+from src.inference_cache import InferenceCache
+from src.video_frame_dataset import VideoFrameDataset, worker_init_fn
+from src.sequential_video_frame_dataset import SequentialVideoFrameDataset
+from src.adaptive_video_frame_dataset import AdaptiveVideoFrameDataset
+from src.live_frame_source import LiveFrameSource
+from src.profiler import profiler
+
+# Batches per shard of the decoding workers when no shard size is given, see Camera.get_shard_size
+SHARD_BATCHES: int = 4
+
+class FrameResult(NamedTuple):
+  frame_index: int
+  # Seconds since the start of the video
+  timestamp: float
+  count: float
+  heatmap: np.ndarray
+  # People per cell of the camera's projected grid
+  density: np.ndarray
 
 class Camera:
   def __init__(
@@ -20,7 +44,31 @@ class Camera:
     batch_size: int,
     log_parameter: int,
     camera_utils: CameraUtils,
-    distortion_parameters: Optional[float] = None
+    distortion_parameters: Optional[float] = None,
+    projection: str = "warp",
+    projection_cache_dir: Optional[str] = None,
+    sequential_decode: bool = False,
+    time_interval: Optional[float] = None,
+    seek_threshold: Optional[int] = None,
+    num_workers: int = 0,
+    prefetch_factor: Optional[int] = None,
+    persistent_workers: bool = False,
+    shard_size: Optional[int] = None,
+    device: str = "auto",
+    channels_last: bool = True,
+    checkpoint_dir: Optional[str] = None,
+    checkpoint_config: Optional[Dict[str, Any]] = None,
+    inference_cache: Optional[InferenceCache] = None,
+    live: bool = False,
+    live_fps: Optional[float] = 1.0,
+    live_frame_size: Optional[Tuple[int, int]] = None,
+    live_replay: bool = False,
+    adaptive_sampling: bool = False,
+    min_frame_interval: int = 30,
+    change_threshold: float = 4.0,
+    drift_threshold: float = 0.1,
+    roi: Optional[Tuple[int, int, int, int]] = None,
+    frame_size: Tuple[int, int] = (1920, 1080)
   ) -> None:
     self.video_path: str = video_path
     self.frame_interval: int = frame_interval
@@ -31,66 +79,378 @@ class Camera:
     self.model: torch.nn.Model = model
     self.log_parameter: int = log_parameter
     self.camera_utils: CameraUtils = camera_utils
+    self.projection: str = projection
+    self.projection_cache_dir: Optional[str] = projection_cache_dir
+    self.sequential_decode: bool = sequential_decode
+    self.time_interval: Optional[float] = time_interval
+    self.seek_threshold: Optional[int] = seek_threshold
+    self.num_workers: int = num_workers
+    self.prefetch_factor: Optional[int] = prefetch_factor
+    self.persistent_workers: bool = persistent_workers
+    self.shard_size: Optional[int] = shard_size
+    self.device: torch.device = resolve_device(device)
+    self.channels_last: bool = channels_last
+    self.geometry: Optional[CameraGeometry] = None
+    # (width, height) every frame is resized to after decoding; the coordinates and the roi are in its pixels
+    self.frame_size: Tuple[int, int] = tuple(frame_size)
+    # (x, y, width, height) of the frame that is inferred, see CameraGeometry.get_roi. None infers the whole frame
+    self.roi: Optional[Tuple[int, int, int, int]] = tuple(roi) if roi else None
+    if self.roi and (self.roi[0] + self.roi[2] > self.frame_size[0] or self.roi[1] + self.roi[3] > self.frame_size[1]):
+      raise ValueError(f"The region of interest {self.roi} does not fit in {self.frame_size[0]}x{self.frame_size[1]} frames.")
+    # Per-frame model output, so that an interrupted run resumes where it stopped. checkpoint_config holds the
+    # settings outside the camera that the output depends on, such as the weights and block size
+    self.checkpoint: Optional[FrameCheckpoint] = None
+    if checkpoint_dir and live:
+      raise ValueError("Live sources cannot be checkpointed, their frames cannot be read again.")
+    if checkpoint_dir:
+      self.checkpoint = FrameCheckpoint(checkpoint_dir, video_path, self.get_checkpoint_config(checkpoint_config or {}))
+
+    self.inference_cache: Optional[InferenceCache] = inference_cache
+    # Treat video_path as a live source and infer its latest frame at most live_fps times a second, see LiveFrameSource
+    self.live: bool = live
+    self.live_fps: Optional[float] = live_fps
+    self.live_frame_size: Optional[Tuple[int, int]] = live_frame_size
+    self.live_replay: bool = live_replay
+
+    # Sample frames on scene changes and count drift, frame_interval is then the longest gap between samples.
+    # See AdaptiveVideoFrameDataset
+    if adaptive_sampling and (num_workers > 0 or checkpoint_dir or live):
+      raise ValueError("Adaptive sampling cannot decode in worker processes, be checkpointed or run on a live source.")
+    self.adaptive_sampling: bool = adaptive_sampling
+    self.min_frame_interval: int = min_frame_interval
+    self.change_threshold: float = change_threshold
+    self.drift_threshold: float = drift_threshold
+    self.dataset: Optional[AdaptiveVideoFrameDataset] = None
+
+    # Largest batch the model is run on, lowered when a batch runs out of memory
+    self.max_infer_batch_size: Optional[int] = None
+
+    self.fps: float = 0.0
+    # Every sampled frame, None while adaptive sampling picks them as the video is read, and those of them whose results are loaded from the checkpoint instead of inferred
+    self.frame_indices: Optional[List[int]] = []
+    self.checkpointed_frames: Set[int] = set()
 
     self.predicted_counts: List[float] = []
     self.images: List[np.ndarray] = []
+    self.density_maps: List[np.ndarray] = []
+    # (frame_index, timestamp) of every entry of images and density_maps
+    self.frame_times: List[Tuple[int, float]] = []
+
+  def get_transform(self) -> FrameTransform:
+    # With an inference cache the frames are keyed by their uint8 pixels and only those that miss are normalised,
+    # on the device, see run_model_on_device
+    return FrameTransform(mean=IMAGENET_MEAN, std=IMAGENET_STD, crop=self.roi, normalize=self.inference_cache is None)
 
   def get_video_dataloader(self) -> DataLoader:
-    transform = standard_transforms.Compose([
-        standard_transforms.ToTensor(),
-        standard_transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                                      std=[0.229, 0.224, 0.225]),
-    ])
-    dataset = VideoFrameDataset(self.video_path, transform=transform, frame_interval=self.frame_interval)
+    transform = self.get_transform()
+    if self.adaptive_sampling:
+      self.dataset = AdaptiveVideoFrameDataset(self.video_path,
+                                               transform=transform,
+                                               target_resolution=self.frame_size,
+                                               min_interval=self.min_frame_interval,
+                                               max_interval=self.frame_interval,
+                                               change_threshold=self.change_threshold,
+                                               drift_threshold=self.drift_threshold)
+      self.fps = self.dataset.fps
+      self.frame_indices = None
+      return DataLoader(dataset=self.dataset,
+                        batch_size=self.batch_size,
+                        num_workers=0,
+                        pin_memory=self.device.type == "cuda")
+
+    if self.sequential_decode or self.time_interval is not None:
+      dataset = SequentialVideoFrameDataset(self.video_path,
+                                            transform=transform,
+                                            target_resolution=self.frame_size,
+                                            frame_interval=self.frame_interval,
+                                            time_interval=self.time_interval,
+                                            seek_threshold=self.seek_threshold,
+                                            shard_size=self.get_shard_size())
+    else:
+      dataset = VideoFrameDataset(self.video_path,
+                                  transform=transform,
+                                  frame_interval=self.frame_interval,
+                                  target_resolution=self.frame_size)
+    self.fps = dataset.fps
+    self.frame_indices = list(dataset.frame_indices)
+    if self.checkpoint is not None:
+      self.checkpointed_frames = self.checkpoint.completed_frames().intersection(self.frame_indices)
+      dataset.frame_indices = [frame_index for frame_index in dataset.frame_indices if frame_index not in self.checkpointed_frames]
+      if self.checkpointed_frames:
+        print(f"Resuming {self.video_path}: {len(self.checkpointed_frames)} of {len(self.frame_indices)} frames are checkpointed")
+
+    # The DataLoader only accepts these when frames are decoded in worker processes
+    worker_options = {}
+    if self.num_workers > 0:
+      worker_options = dict(worker_init_fn=worker_init_fn,
+                            prefetch_factor=self.prefetch_factor,
+                            persistent_workers=self.persistent_workers)
+
     dataloader = DataLoader(dataset=dataset,
                             batch_size=self.batch_size,
-                            num_workers=0,
+                            num_workers=self.num_workers,
                             shuffle=False,
                             drop_last=False,
-                            pin_memory=True)
+                            pin_memory=self.device.type == "cuda",
+                            **worker_options)
     return dataloader
 
-  def predict(self) -> None:
-    torch.cuda.empty_cache()
-    gc.collect()
+  def get_shard_size(self) -> Optional[int]:
+    """Sampled frames per shard of the decoding workers.
 
-    dataloader = self.get_video_dataloader()
+    Results are released in frame order, so a worker that runs ahead has its results held until the workers
+    before it catch up. Shards of a few batches keep the workers close together in the video, where one
+    contiguous shard per worker would hold most of the video's results.
+    """
+    if self.shard_size or self.num_workers == 0:
+      return self.shard_size
+    return SHARD_BATCHES * self.batch_size
+
+  def get_checkpoint_config(self, config: Dict[str, Any]) -> Dict[str, Any]:
+    return dict(config,
+                local_coordinates=self.local_coordinates,
+                global_coordinates=self.global_coordinates,
+                distortion_parameters=self.distortion_parameters,
+                projection=self.projection,
+                roi=self.roi,
+                frame_size=self.frame_size)
+
+  def get_distortion_parameter(self) -> Optional[float]:
+    if self.distortion_parameters and len(self.distortion_parameters) > 0:
+      return self.distortion_parameters[0]
+    return None
+
+  def get_geometry(self, input_shape: Tuple[int, int]) -> CameraGeometry:
+    """Return the cached geometry, rebuilding it if the coordinates or distortion parameters have changed."""
+    distortion_parameter = self.get_distortion_parameter()
+    # Density maps of a cropped frame are positioned within the full frame
+    frame_shape = (self.frame_size[1], self.frame_size[0]) if self.roi else None
+    offset = self.roi[:2] if self.roi else (0, 0)
+    if self.geometry is None or not self.geometry.matches(input_shape,
+                                                          self.local_coordinates,
+                                                          self.global_coordinates,
+                                                          distortion_parameter,
+                                                          frame_shape,
+                                                          offset):
+      self.geometry = CameraGeometry(self.camera_utils,
+                                     input_shape,
+                                     self.local_coordinates,
+                                     self.global_coordinates,
+                                     distortion_parameter,
+                                     frame_shape=frame_shape,
+                                     offset=offset)
+    return self.geometry
+
+  @profiler.timed("projection")
+  def project(self, density_maps: np.ndarray) -> np.ndarray:
+    """Project a (batch, height, width) stack of density maps onto the camera's global metre cells."""
+    geometry = self.get_geometry(density_maps.shape[1:])
+    if self.projection == "sparse":
+      return geometry.project_batch(density_maps, self.projection_cache_dir)
+    if self.projection == "warp":
+      return np.stack([geometry.project(density_map) for density_map in density_maps])
+    raise ValueError(f"Unknown projection: {self.projection}")
+
+  def infer(self, img: torch.Tensor) -> np.ndarray:
+    """Run the model on a batch of frames and return the density maps as a numpy array.
+
+    A batch that runs out of memory is retried in halves, and later batches are split to the reduced size.
+    """
+    if self.max_infer_batch_size and len(img) > self.max_infer_batch_size:
+      return np.concatenate([self.infer(chunk) for chunk in torch.split(img, self.max_infer_batch_size)])
+
+    try:
+      return self.run_model(img)
+    except RuntimeError as error:
+      if not is_out_of_memory(error) or len(img) == 1:
+        raise
+      if self.device.type == "cuda":
+        torch.cuda.empty_cache()
+      self.max_infer_batch_size = len(img) // 2
+      profiler.count("oom_retries")
+      print(f"Out of memory with a batch of {len(img)} frames, retrying with {self.max_infer_batch_size}")
+      return self.infer(img)
 
-    for img in dataloader:
-      img = img.cuda()
+  def run_model(self, img: torch.Tensor) -> np.ndarray:
+    """Run the model on the frames of the batch that are not in the inference cache.
 
-      with torch.no_grad():
-        self.model.eval()
-        pred_map = self.model(img)
-      pred_map = pred_map.data.cpu().numpy()
+    With an inference cache the batch holds uint8 frames, which are hashed as decoded; frames that hit are
+    neither normalised nor copied to the device.
+    """
+    if self.inference_cache is None:
+      return self.run_model_on_device(img)
 
-      for i_img in range(pred_map.shape[0]):
-        pred_cnt = np.sum(pred_map[i_img]) / self.log_parameter
-        self.predicted_counts.append(pred_cnt)
-        print(f'Predicted Count: {pred_cnt}')
+    with profiler.stage("cache_lookup"):
+      keys = [self.inference_cache.get_key(frame) for frame in img]
+      pred_maps = [self.inference_cache.load(key) for key in keys]
+    missing = [i_img for i_img, pred_map in enumerate(pred_maps) if pred_map is None]
+    profiler.count("cache_hits", len(img) - len(missing))
+    profiler.count("cache_misses", len(missing))
+    if missing:
+      for i_img, pred_map in zip(missing, self.run_model_on_device(img[missing])):
+        with profiler.stage("cache_store"):
+          self.inference_cache.save(keys[i_img], pred_map)
+        pred_maps[i_img] = pred_map
 
-        # Extract the first channel (grayscale) from the density map
-        grayscale_map = pred_map[i_img][0]
+    return np.stack(pred_maps)
 
-        if self.distortion_parameters and len(self.distortion_parameters) > 0:
-          undistorted_map = self.camera_utils.correct_fisheye_distortion(grayscale_map, self.distortion_parameters[0])
+  def run_model_on_device(self, img: torch.Tensor) -> np.ndarray:
+    memory_format = torch.channels_last if self.channels_last else torch.contiguous_format
+    with profiler.stage("host_to_device"):
+      img = img.to(self.device, memory_format=memory_format, non_blocking=True)
+    if img.dtype == torch.uint8:
+      with profiler.stage("normalize"):
+        img = self.get_transform().normalize_frames(img)
+
+    with profiler.stage("model_forward"), torch.inference_mode():
+      self.model.eval()
+      pred_map = self.model(img)
+      if self.device.type == "cuda":
+        # Kernels run asynchronously, wait for them so that the forward pass is not counted as the copy back
+        torch.cuda.synchronize(self.device)
+    with profiler.stage("device_to_host"):
+      pred_map = pred_map.cpu().contiguous().numpy()
+    profiler.count("batches")
+
+    if self.device.type == "cuda":
+      torch.cuda.empty_cache()
+
+    return pred_map
+
+  def make_result(self, frame_index: int, pred_sum: float, projected_map: np.ndarray) -> FrameResult:
+    # Nearest-neighbour upsampling commutes with colour mapping, so the smaller map is coloured
+    heatmap = self.camera_utils.upsample_image(self.camera_utils.make_heatmap(projected_map))
+
+    if self.dataset is not None:
+      timestamp = self.dataset.timestamps[frame_index]
+    else:
+      timestamp = frame_index / self.fps if self.fps > 0 else 0.0
+
+    return FrameResult(frame_index,
+                       timestamp,
+                       pred_sum / self.log_parameter,
+                       heatmap,
+                       (projected_map / self.log_parameter).astype(np.float32))
+
+  def postprocess(self, frame_indices: List[int], pred_map: np.ndarray) -> List[FrameResult]:
+    """Turn a batch of density maps into per-frame results."""
+    # Extract the first channel (grayscale) from the density maps and project them onto the global grid
+    projected_maps = self.project(pred_map[:, 0])
+
+    results = []
+    for i_img in range(pred_map.shape[0]):
+      frame_index = int(frame_indices[i_img])
+      pred_sum = np.sum(pred_map[i_img])
+      if self.checkpoint is not None:
+        with profiler.stage("checkpoint_write"):
+          self.checkpoint.save(frame_index, pred_sum, projected_maps[i_img])
+
+      results.append(self.make_result(frame_index, pred_sum, projected_maps[i_img]))
+
+    return results
+
+  def order_results(
+    self,
+    frame_indices: Optional[List[int]],
+    batches: Iterator[List[FrameResult]]
+  ) -> Iterator[FrameResult]:
+    """Yield the results of the batches in frame order, recording the counts as they are released.
+
+    frame_indices is None when the frames are only known as they are decoded, they are then read by a single
+    process and every batch is released as it arrives.
+    """
+    # Batches from different decoding workers arrive interleaved, results are buffered until they are next in order
+    frame_order = iter(frame_indices or [])
+    next_frame_index = next(frame_order, None)
+    pending: Dict[int, FrameResult] = {}
+    start = time.perf_counter()
+    frame_count = 0
+
+    # The leading empty batch releases the checkpointed frames before the first inferred frame
+    for results in itertools.chain([[]], batches):
+      for result in results:
+        pending[result.frame_index] = result
+      if frame_indices is None:
+        next_frame_index = min(pending, default=None)
+        frame_order = iter(sorted(pending)[1:])
+
+      while next_frame_index in pending or next_frame_index in self.checkpointed_frames:
+        if next_frame_index in pending:
+          result = pending.pop(next_frame_index)
         else:
-          undistorted_map = grayscale_map
+          result = self.make_result(next_frame_index, *self.checkpoint.load(next_frame_index))
+        self.predicted_counts.append(result.count)
+        if self.dataset is not None:
+          self.dataset.report_count(result.count)
+        print(f'Predicted Count: {result.count}')
+        profiler.count("frames")
+        yield result
+        next_frame_index = next(frame_order, None)
+        frame_count += 1
 
-        corrected_map = self.camera_utils.correct_perspective(undistorted_map, self.local_coordinates)
+    batch_size = min(self.batch_size, self.max_infer_batch_size or self.batch_size)
+    print(f"Processed {frame_count} frames of {self.video_path} at "
+          f"{frame_count / (time.perf_counter() - start):.2f} frames/sec with batch size {batch_size}")
 
-        width_after = self.global_coordinates[3][0] - self.global_coordinates[0][0]
-        scale_factor = int(corrected_map.shape[1] / width_after)
+  def read_batches(self, dataloader: DataLoader) -> Iterator[Tuple[List[int], torch.Tensor]]:
+    """Iterate over the dataloader, recording how long every batch is waited for."""
+    batches = iter(dataloader)
+    while True:
+      with profiler.stage("dataloader_wait"):
+        batch = next(batches, None)
+      if batch is None:
+        return
+      yield batch
 
-        downsampled_map = self.camera_utils.downsample_image(corrected_map, scale_factor)
+  def predict_stream(self) -> Iterator[FrameResult]:
+    """Yield the result of the latest frame of the live source, frame by frame, until the source ends."""
+    source = LiveFrameSource(self.video_path,
+                             transform=self.get_transform(),
+                             target_resolution=self.frame_size,
+                             frame_size=self.live_frame_size,
+                             replay=self.live_replay)
+    frame_count = 0
+    latency = 0.0
+    try:
+      for frame_number, timestamp, img in source.frames(self.live_fps):
+        # Live frames are numbered as they are read, their timestamp is when they were read
+        result = self.postprocess([frame_number], self.infer(img[None]))[0]._replace(timestamp=timestamp)
+        self.predicted_counts.append(result.count)
+        print(f'Predicted Count: {result.count}')
+        profiler.count("frames")
+        latency += time.perf_counter() - source.start_time - timestamp
+        frame_count += 1
+        yield result
+    finally:
+      source.close()
+      profiler.count("frames_dropped", source.frames_dropped)
+      print(f"Processed {frame_count} of {source.frames_read} frames of {self.video_path}, dropped "
+            f"{source.frames_dropped}, mean latency {latency / max(frame_count, 1):.3f} s")
 
-        upsampled_map = self.camera_utils.upsample_image(downsampled_map)
+  def predict_frames(self) -> Iterator[FrameResult]:
+    """Yield the result of every sampled frame, in frame order, as soon as it is ready."""
+    if self.device.type == "cuda":
+      torch.cuda.empty_cache()
+    gc.collect()
+
+    if self.live:
+      return self.predict_stream()
 
-        heatmap = self.camera_utils.make_heatmap(upsampled_map)
+    dataloader = self.get_video_dataloader()
+    batches = (self.postprocess(frame_indices, self.infer(img)) for frame_indices, img in self.read_batches(dataloader))
 
-        self.images.append(heatmap)
+    return self.order_results(self.frame_indices, batches)
 
-      del pred_map
-      del heatmap
-      del pred_cnt
-      torch.cuda.empty_cache()
\ No newline at end of file
+  def predict_live(self, on_result: Optional[Callable[[FrameResult], None]] = None, result_queue: Optional[queue.Queue] = None) -> None:
+    """Hand every result to on_result and/or result_queue as soon as it is ready, until the source ends."""
+    for result in self.predict_frames():
+      if on_result is not None:
+        on_result(result)
+      if result_queue is not None:
+        result_queue.put(result)
+
+  def predict(self) -> None:
+    for result in self.predict_frames():
+      self.images.append(result.heatmap)
+      self.density_maps.append(result.density)
+      self.frame_times.append((result.frame_index, result.timestamp))
@@ -1,61 +1,225 @@
-from typing import List, Tuple
+from typing import List, Tuple, Optional, Iterator
 import numpy as np
 import cv2
+import itertools
 from datetime import datetime
 
-from src.camera import Camera  
-from src.camera_utils import CameraUtils  
+from src.camera import Camera, FrameResult
+from src.camera_utils import CameraUtils
+from src.camera_scheduler import CameraScheduler
+from src.density_map_store import DensityMapWriter
+from src.density_fusion import DensityFusion
+from src.profiler import profiler
 
 
 class CameraCollection:
-  def __init__(self, cameras: List[Camera], camera_utils: CameraUtils) -> None:
+  def __init__(
+    self,
+    cameras: List[Camera],
+    camera_utils: CameraUtils,
+    streaming: bool = False,
+    max_in_flight_frames: int = 4,
+    batch_size: Optional[int] = None,
+    write_density_maps: bool = False,
+    density_chunk_frames: int = 256,
+    timeline_interval: Optional[float] = None,
+    fusion_batch_size: int = 32
+  ) -> None:
     self.cameras: List[Camera] = cameras
     self.camera_utils: CameraUtils = camera_utils
+    self.streaming: bool = streaming
+    self.max_in_flight_frames: int = max_in_flight_frames
+    # Frames per cross-camera inference batch, None runs every camera with its own dataloader batches
+    self.batch_size: Optional[int] = batch_size
+    self.write_density_maps: bool = write_density_maps
+    self.density_chunk_frames: int = density_chunk_frames
+    # Seconds of video between output frames. Each output frame shows every camera's latest result at that
+    # time, which keeps cameras that sample different frames in sync. None pairs the cameras' n-th results
+    self.timeline_interval: Optional[float] = timeline_interval
+    # Adaptively sampled frames are unevenly spaced, while the output video has a fixed frame rate that the frontend
+    # maps back to time, so even a single adaptive camera needs a timeline
+    if timeline_interval is None and any(cam.adaptive_sampling for cam in cameras):
+      raise ValueError("Cameras with adaptive sampling sample unevenly spaced frames, a timeline interval is required.")
+    # Output frames fused per matrix product when the results are composed after prediction
+    self.fusion_batch_size: int = fusion_batch_size
+    self.fusion: Optional[DensityFusion] = None
+
+  def get_output_frame_size(self) -> Tuple[int, int]:
+    """Calculate the size of the output frame based on the global coordinates."""
+    max_width = 0
+    max_height = 0
+
+    for cam in self.cameras:
+        for coord in cam.global_coordinates:
+            max_width = max(max_width, coord[0])
+            max_height = max(max_height, coord[1])
+
+    return max_width * self.camera_utils.upsampling_factor, max_height * self.camera_utils.upsampling_factor
+
+  def get_fusion(self, map_shapes: List[Tuple[int, int]]) -> DensityFusion:
+    """Return the cached fusion, rebuilding it if the cameras' coordinates or map shapes have changed."""
+    global_coordinates = [cam.global_coordinates for cam in self.cameras]
+    grid_size = self.get_density_grid_size()
+    if self.fusion is None or not self.fusion.matches(global_coordinates, map_shapes, grid_size):
+      self.fusion = DensityFusion(global_coordinates, map_shapes, grid_size)
+    return self.fusion
+
+  def get_density_grid_size(self) -> Tuple[int, int]:
+    """Size of the global density grid in metre cells, before upsampling."""
+    max_width = max(coord[0] for cam in self.cameras for coord in cam.global_coordinates)
+    max_height = max(coord[1] for cam in self.cameras for coord in cam.global_coordinates)
+    return max_width, max_height
+
+  def compose_densities(self, density_maps: List[np.ndarray]) -> np.ndarray:
+    """Fuse one (batch, height, width) stack of density maps per camera into a stack of global grids."""
+    return self.get_fusion([maps.shape[1:] for maps in density_maps]).fuse(density_maps)
+
+  def compose_density(self, density_maps: List[np.ndarray]) -> np.ndarray:
+    """Fuse one density map per camera into the global grid, see DensityFusion."""
+    return self.compose_densities([density_map[None] for density_map in density_maps])[0]
+
+  @profiler.timed("compose")
+  def compose_frames(self, global_maps: np.ndarray) -> List[np.ndarray]:
+    """Render a (batch, height, width) stack of global density grids as output frames."""
+    # Heatmaps are scaled for the model's output, which is log_parameter times the people per cell. They are
+    # coloured before the nearest-neighbour upsampling, which gives the same frames from fewer pixels
+    heatmaps = self.camera_utils.make_heatmap(global_maps * self.cameras[0].log_parameter)
+    return [self.camera_utils.upsample_image(heatmap) for heatmap in heatmaps]
+
+  def compose_frame(self, global_map: np.ndarray) -> np.ndarray:
+    """Render a global density grid as an output frame."""
+    return self.compose_frames(global_map[None])[0]
+
+  def align_by_time(self, streams: List[Iterator[FrameResult]]) -> Iterator[Tuple[float, List[FrameResult]]]:
+    """Yield (time, latest result of every camera) every timeline_interval seconds until all streams end."""
+    upcoming: List[Optional[FrameResult]] = [next(stream, None) for stream in streams]
+    latest: List[Optional[FrameResult]] = [None] * len(streams)
+    step = 0
+    while any(result is not None for result in upcoming):
+      time = step * self.timeline_interval
+      for camera_index, stream in enumerate(streams):
+        while upcoming[camera_index] is not None and (upcoming[camera_index].timestamp <= time or latest[camera_index] is None):
+          latest[camera_index] = upcoming[camera_index]
+          upcoming[camera_index] = next(stream, None)
+      yield time, list(latest)
+      step += 1
+
+  def stored_results(self, cam: Camera) -> Iterator[FrameResult]:
+    for frame_time, count, image, density_map in zip(cam.frame_times, cam.predicted_counts, cam.images, cam.density_maps):
+      yield FrameResult(*frame_time, count, image, density_map)
+
+  def stored_frames(self) -> Iterator[Tuple[float, List[FrameResult]]]:
+    """Yield (time, result of every camera) for every output frame of the cameras' stored results."""
+    streams = [self.stored_results(cam) for cam in self.cameras]
+    if self.timeline_interval is not None:
+      yield from self.align_by_time(streams)
+      return
+    for results in zip(*streams):
+      yield results[0].timestamp, list(results)
+
+  def stored_batches(self) -> Iterator[Tuple[List[Tuple[int, float]], np.ndarray]]:
+    """Yield the (frame_index, time) and the fused global grids of up to fusion_batch_size stored output frames."""
+    frames = self.stored_frames()
+    while True:
+      batch = list(itertools.islice(frames, self.fusion_batch_size))
+      if not batch:
+        return
+      density_maps = [np.stack([results[camera_index].density for _, results in batch])
+                      for camera_index in range(len(self.cameras))]
+      yield [(results[0].frame_index, time) for time, results in batch], self.compose_densities(density_maps)
+
+  def open_density_writer(self) -> DensityMapWriter:
+    time_str = datetime.now().strftime('%H:%M')
+    width, height = self.get_density_grid_size()
+    return DensityMapWriter(f"{self.camera_utils.output_dir}density_{time_str}/", (height, width),
+                            chunk_frames=self.density_chunk_frames)
 
-  def combine_images_to_video(self, fps: int = 30) -> None:
-    def get_output_frame_size(cameras: List[Camera]) -> Tuple[int, int]:
-      """Calculate the size of the output frame based on the global coordinates."""
-      max_width = 0
-      max_height = 0
-
-      for cam in cameras:
-          for coord in cam.global_coordinates:
-              max_width = max(max_width, coord[0])
-              max_height = max(max_height, coord[1])
-
-      return max_width * self.camera_utils.upsampling_factor, max_height * self.camera_utils.upsampling_factor
-
-    def overlay_image(large_image: np.ndarray, small_image: np.ndarray, coordinates: List[Tuple[int, int]]) -> np.ndarray:
-      """Overlay small_image onto large_image at the given coordinates."""
-      x_coords = [c[0] for c in coordinates]
-      y_coords = [c[1] for c in coordinates]
-      x_min, x_max = min(x_coords) * self.camera_utils.upsampling_factor, max(x_coords) * self.camera_utils.upsampling_factor
-      y_min, y_max = min(y_coords) * self.camera_utils.upsampling_factor, max(y_coords) * self.camera_utils.upsampling_factor
-
-      large_image[y_min:y_max, x_min:x_max] = cv2.resize(small_image, (x_max - x_min, y_max - y_min))
-
-      return large_image
+  @profiler.timed("density_write")
+  def write_density(self, writer: DensityMapWriter, global_map: np.ndarray, frame_index: int, timestamp: float) -> None:
+    writer.write(global_map, frame_index, timestamp)
 
-    frame_size = get_output_frame_size(self.cameras)
+  def open_video_writer(self, fps: int) -> Tuple[cv2.VideoWriter, str, Tuple[int, int]]:
+    frame_size = self.get_output_frame_size()
     time_str = datetime.now().strftime('%H:%M')
     fourcc = cv2.VideoWriter_fourcc(*'XVID')
     file_path = f"{self.camera_utils.output_dir}output_video_{time_str}.avi"
     out = cv2.VideoWriter(file_path, fourcc, fps, frame_size)
+    return out, file_path, frame_size
 
-    for frame_idx in range(len(self.cameras[0].images)):
-        base_frame = np.zeros((frame_size[1], frame_size[0], 3), dtype=np.uint8)
-
-        for cam in self.cameras:
-            image = cam.images[frame_idx]
-            base_frame = overlay_image(base_frame, image, cam.global_coordinates)
+  def combine_images_to_video(self, fps: int = 30) -> None:
+    out, file_path, _ = self.open_video_writer(fps)
 
-        out.write(base_frame)
+    for _, global_maps in self.stored_batches():
+        for frame in self.compose_frames(global_maps):
+          with profiler.stage("video_write"):
+            out.write(frame)
 
     out.release()
     print("Finished writing to ", file_path)
 
-  def generate_report(self) -> None:
-    for camera in self.cameras:
-      camera.predict()
+  def combine_density_maps(self) -> None:
+    writer = self.open_density_writer()
+    for frame_times, global_maps in self.stored_batches():
+        for (frame_index, time), global_map in zip(frame_times, global_maps):
+          self.write_density(writer, global_map, frame_index, time)
+
+    writer.close()
+    print("Finished writing density maps to ", writer.directory)
+
+  def stream_frames_to_video(self, fps: int = 30) -> None:
+    """Write each output frame as soon as all cameras have produced it.
+
+    Memory stays bounded by max_in_flight_frames per camera however long the video is. Without a timeline
+    interval the video ends with the camera that samples the fewest frames, with one it ends with the last
+    sampled frame of any camera.
+    """
+    scheduler = CameraScheduler(self.cameras, self.max_in_flight_frames, self.batch_size)
+    out, file_path, _ = self.open_video_writer(fps)
+    density_writer = self.open_density_writer() if self.write_density_maps else None
+    if self.timeline_interval is not None:
+      frames = self.align_by_time(scheduler.streams())
+    else:
+      frames = ((results[0].timestamp, results) for results in itertools.takewhile(
+        lambda results: all(result is not None for result in results), scheduler.frames()))
+    try:
+      for time, results in frames:
+        global_map = self.compose_density([result.density for result in results])
+        frame = self.compose_frame(global_map)
+        with profiler.stage("video_write"):
+          out.write(frame)
+        if density_writer is not None:
+          self.write_density(density_writer, global_map, results[0].frame_index, time)
+    finally:
+      scheduler.close()
+      out.release()
+      if density_writer is not None:
+        density_writer.close()
 
-    self.combine_images_to_video()
\ No newline at end of file
+    print("Finished writing to ", file_path)
+    if density_writer is not None:
+      print("Finished writing density maps to ", density_writer.directory)
+
+  def predict_concurrently(self) -> None:
+    """Fill every camera's images, running the cameras concurrently."""
+    scheduler = CameraScheduler(self.cameras, self.max_in_flight_frames, self.batch_size)
+    for results in scheduler.frames():
+      for cam, result in zip(self.cameras, results):
+        if result is not None:
+          cam.images.append(result.heatmap)
+          cam.density_maps.append(result.density)
+          cam.frame_times.append((result.frame_index, result.timestamp))
+
+  def generate_report(self) -> None:
+    if self.streaming:
+      self.stream_frames_to_video()
+      return
+
+    if self.batch_size:
+      self.predict_concurrently()
+    else:
+      for camera in self.cameras:
+        camera.predict()
+
+    self.combine_images_to_video()
+    if self.write_density_maps:
+      self.combine_density_maps()
@@ -0,0 +1,226 @@
+from typing import List, Tuple, Optional
+import hashlib
+import os
+import numpy as np
+import scipy.sparse
+import cv2
+
+from src.camera_utils import CameraUtils
+from src.profiler import profiler
+
+
+class CameraGeometry:
+  """Fused undistortion, perspective correction and downsampling for one camera.
+
+  The camera geometry is fixed for a whole video, so the mapping from density map pixels to the
+  perspective corrected map is built once and every density map is projected with a single warp
+  followed by the block sum into global metre cells. Without lens distortion the warp is a plain
+  warpPerspective with the cached homography; with distortion it is one cv2.remap through a map that
+  fuses the undistortion and the homography.
+
+  Alternatively the whole projection can be expressed as a sparse matrix from density map pixels to
+  global cells, weighted by how much of each pixel lands in each cell. Projecting with that matrix
+  conserves the count of every pixel inside the quadrilateral and handles a whole batch in one product.
+
+  The density map may cover only part of the frame, see get_roi: offset is the position of its top-left
+  pixel in the frame of frame_shape, and the homography is shifted to match.
+  """
+
+  def __init__(
+    self,
+    camera_utils: CameraUtils,
+    input_shape: Tuple[int, int],
+    local_coordinates: List[Tuple[int, int]],
+    global_coordinates: List[Tuple[int, int]],
+    distortion_parameter: Optional[float] = None,
+    supersampling: int = 4,
+    frame_shape: Optional[Tuple[int, int]] = None,
+    offset: Tuple[int, int] = (0, 0)
+  ) -> None:
+    self.camera_utils: CameraUtils = camera_utils
+    self.input_shape: Tuple[int, int] = tuple(input_shape[:2])
+    self.frame_shape: Tuple[int, int] = tuple(frame_shape[:2]) if frame_shape else self.input_shape
+    self.offset: Tuple[int, int] = tuple(offset)
+    self.local_coordinates: Tuple[Tuple[int, int], ...] = tuple(tuple(c) for c in local_coordinates)
+    self.global_coordinates: Tuple[Tuple[int, int], ...] = tuple(tuple(c) for c in global_coordinates)
+    self.distortion_parameter: Optional[float] = distortion_parameter
+    self.supersampling: int = supersampling
+
+    # The homography of the frame, and of the density map, whose pixels are offset from the frame's
+    self.frame_perspective_matrix, self.corrected_size = camera_utils.perspective_transform(local_coordinates)
+    translation = np.array([[1, 0, self.offset[0]], [0, 1, self.offset[1]], [0, 0, 1]], dtype=np.float64)
+    self.perspective_matrix: np.ndarray = self.frame_perspective_matrix @ translation
+
+    width_after = global_coordinates[3][0] - global_coordinates[0][0]
+    self.scale_factor: int = int(self.corrected_size[0] / width_after)
+    self.grid_shape: Tuple[int, int] = (-(-self.corrected_size[1] // self.scale_factor),
+                                        -(-self.corrected_size[0] // self.scale_factor))
+    self.projection_matrix: Optional[scipy.sparse.csr_matrix] = None
+
+    self.map_1: Optional[np.ndarray] = None
+    self.map_2: Optional[np.ndarray] = None
+    if self.distortion_parameter:
+      map_x, map_y = self.build_maps(self.frame_perspective_matrix)
+      # Fixed-point maps are what warpPerspective uses internally and make remap considerably faster
+      self.map_1, self.map_2 = cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+
+  def build_maps(self, perspective_matrix: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Map every corrected pixel back to its source pixel in the (distorted) density map.
+
+    perspective_matrix is the homography of the frame, the maps are shifted by the offset of the density map.
+    """
+    width, height = self.corrected_size
+    grid_x, grid_y = np.meshgrid(np.arange(width, dtype=np.float64), np.arange(height, dtype=np.float64))
+
+    # Invert the homography to find the undistorted coordinates of each corrected pixel
+    inverse = np.linalg.inv(perspective_matrix)
+    denominator = inverse[2, 0] * grid_x + inverse[2, 1] * grid_y + inverse[2, 2]
+    map_x = (inverse[0, 0] * grid_x + inverse[0, 1] * grid_y + inverse[0, 2]) / denominator
+    map_y = (inverse[1, 0] * grid_x + inverse[1, 1] * grid_y + inverse[1, 2]) / denominator
+
+    if self.distortion_parameter:
+      map_x, map_y = self.distort_points(map_x, map_y)
+
+    return (map_x - self.offset[0]).astype(np.float32), (map_y - self.offset[1]).astype(np.float32)
+
+  def distort_points(self, x: np.ndarray, y: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Apply the radial distortion model of correct_fisheye_distortion, exactly as initUndistortRectifyMap does."""
+    camera_matrix, dist_coeffs = self.camera_utils.fisheye_camera_matrices(self.frame_shape, self.distortion_parameter)
+    focal_x, focal_y = camera_matrix[0, 0], camera_matrix[1, 1]
+    center_x, center_y = camera_matrix[0, 2], camera_matrix[1, 2]
+    normalized_x = (x - center_x) / focal_x
+    normalized_y = (y - center_y) / focal_y
+    radial = 1 + dist_coeffs[0] * (normalized_x ** 2 + normalized_y ** 2)
+    return normalized_x * radial * focal_x + center_x, normalized_y * radial * focal_y + center_y
+
+  def get_roi(self, margin: int, alignment: int = 32) -> Tuple[int, int, int, int]:
+    """Return the (x, y, width, height) box of the frame that holds the quadrilateral, widened by margin pixels.
+
+    The box covers every pixel the projection keeps, so cropping frames to it before inference leaves the
+    projected density unchanged apart from the context the model sees; margin restores that context. The
+    box is widened to a multiple of alignment pixels, which the model's downsampling needs, and kept inside
+    the frame.
+    """
+    # The edges of the quadrilateral, distorted back into the frame when the lens is
+    corners = np.array(self.local_coordinates + self.local_coordinates[:1], dtype=np.float64)
+    steps = np.linspace(0, 1, 256)[:, None]
+    points = np.concatenate([start + steps * (end - start) for start, end in zip(corners[:-1], corners[1:])])
+    x, y = points[:, 0], points[:, 1]
+    if self.distortion_parameter:
+      x, y = self.distort_points(x, y)
+
+    frame_height, frame_width = self.frame_shape
+    box = []
+    for low, high, length in ((x.min(), x.max(), frame_width), (y.min(), y.max(), frame_height)):
+      start = max(int(np.floor(low)) - 1 - margin, 0)
+      end = min(int(np.ceil(high)) + 2 + margin, length)
+      size = min(-(-(end - start) // alignment) * alignment, length)
+      box.append((min(start, length - size), size))
+
+    (x, width), (y, height) = box
+    return x, y, width, height
+
+  def matches(
+    self,
+    input_shape: Tuple[int, int],
+    local_coordinates: List[Tuple[int, int]],
+    global_coordinates: List[Tuple[int, int]],
+    distortion_parameter: Optional[float],
+    frame_shape: Optional[Tuple[int, int]] = None,
+    offset: Tuple[int, int] = (0, 0)
+  ) -> bool:
+    return (self.input_shape == tuple(input_shape[:2])
+            and self.frame_shape == (tuple(frame_shape[:2]) if frame_shape else self.input_shape)
+            and self.offset == tuple(offset)
+            and self.local_coordinates == tuple(tuple(c) for c in local_coordinates)
+            and self.global_coordinates == tuple(tuple(c) for c in global_coordinates)
+            and self.distortion_parameter == distortion_parameter)
+
+  @profiler.timed("warp")
+  def correct(self, density_map: np.ndarray) -> np.ndarray:
+    if self.map_1 is None:
+      return cv2.warpPerspective(density_map, self.perspective_matrix, self.corrected_size, flags=cv2.INTER_LINEAR)
+    return cv2.remap(density_map, self.map_1, self.map_2, cv2.INTER_LINEAR,
+                     borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+  def project(self, density_map: np.ndarray) -> np.ndarray:
+    return self.camera_utils.downsample_image(self.correct(density_map), self.scale_factor)
+
+  def cache_key(self) -> str:
+    description = repr((self.input_shape, self.local_coordinates, self.global_coordinates,
+                        self.distortion_parameter, self.supersampling, self.frame_shape, self.offset))
+    return hashlib.sha1(description.encode()).hexdigest()[:16]
+
+  def map_points(self, x: np.ndarray, y: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Map points in the density map to the perspective corrected map."""
+    x, y = x + self.offset[0], y + self.offset[1]
+    if self.distortion_parameter:
+      camera_matrix, dist_coeffs = self.camera_utils.fisheye_camera_matrices(self.frame_shape, self.distortion_parameter)
+      points = np.stack((x, y), axis=-1).reshape(-1, 1, 2)
+      undistorted = cv2.undistortPoints(points, camera_matrix, dist_coeffs, P=camera_matrix).reshape(-1, 2)
+      x, y = undistorted[:, 0].astype(np.float64), undistorted[:, 1].astype(np.float64)
+
+    M = self.frame_perspective_matrix
+    denominator = M[2, 0] * x + M[2, 1] * y + M[2, 2]
+    return (M[0, 0] * x + M[0, 1] * y + M[0, 2]) / denominator, (M[1, 0] * x + M[1, 1] * y + M[1, 2]) / denominator
+
+  def build_projection_matrix(self, chunk_points: int = 2_000_000) -> scipy.sparse.csr_matrix:
+    """Build the (cells x pixels) matrix that distributes every density map pixel over the global cells.
+
+    Each pixel is sampled on a supersampling x supersampling grid and every sample carries an equal share
+    of the pixel, so a pixel that lands entirely inside the quadrilateral keeps all of its count.
+    """
+    height, width = self.input_shape
+    corrected_width, corrected_height = self.corrected_size
+    samples = self.supersampling ** 2
+    offsets = (np.arange(self.supersampling) + 0.5) / self.supersampling - 0.5
+    offset_x, offset_y = [o.ravel() for o in np.meshgrid(offsets, offsets)]
+    rows_per_chunk = max(chunk_points // (width * samples), 1)
+    cell_count = self.grid_shape[0] * self.grid_shape[1]
+
+    rows, cols, weights = [], [], []
+    for row_start in range(0, height, rows_per_chunk):
+      pixel_y, pixel_x = np.mgrid[row_start:min(row_start + rows_per_chunk, height), 0:width]
+      pixel_index = (pixel_y * width + pixel_x).ravel().repeat(samples)
+      sample_x = (pixel_x.reshape(-1, 1) + offset_x).ravel().astype(np.float64)
+      sample_y = (pixel_y.reshape(-1, 1) + offset_y).ravel().astype(np.float64)
+
+      corrected_x, corrected_y = self.map_points(sample_x, sample_y)
+      inside = ((corrected_x >= -0.5) & (corrected_x < corrected_width - 0.5)
+                & (corrected_y >= -0.5) & (corrected_y < corrected_height - 0.5))
+      cell_x = np.floor((corrected_x[inside] + 0.5) / self.scale_factor).astype(np.int64)
+      cell_y = np.floor((corrected_y[inside] + 0.5) / self.scale_factor).astype(np.int64)
+
+      # Collapse the samples of each pixel that fall into the same cell into one weighted entry
+      keys, counts = np.unique(pixel_index[inside] * cell_count + cell_y * self.grid_shape[1] + cell_x,
+                               return_counts=True)
+      rows.append(keys % cell_count)
+      cols.append(keys // cell_count)
+      weights.append((counts / samples).astype(np.float32))
+
+    return scipy.sparse.csr_matrix((np.concatenate(weights), (np.concatenate(rows), np.concatenate(cols))),
+                                   shape=(cell_count, height * width))
+
+  def get_projection_matrix(self, cache_dir: Optional[str] = None) -> scipy.sparse.csr_matrix:
+    """Return the projection matrix, loading it from or saving it to cache_dir when given."""
+    if self.projection_matrix is not None:
+      return self.projection_matrix
+
+    cache_path = os.path.join(cache_dir, f"projection_{self.cache_key()}.npz") if cache_dir else None
+    if cache_path and os.path.isfile(cache_path):
+      self.projection_matrix = scipy.sparse.load_npz(cache_path).tocsr()
+    else:
+      self.projection_matrix = self.build_projection_matrix()
+      if cache_path:
+        os.makedirs(cache_dir, exist_ok=True)
+        scipy.sparse.save_npz(cache_path, self.projection_matrix)
+
+    return self.projection_matrix
+
+  @profiler.timed("sparse_projection")
+  def project_batch(self, density_maps: np.ndarray, cache_dir: Optional[str] = None) -> np.ndarray:
+    """Project a (batch, height, width) stack of density maps onto the global grid in one product."""
+    projection_matrix = self.get_projection_matrix(cache_dir)
+    flattened = density_maps.reshape(density_maps.shape[0], -1)
+    projected = (projection_matrix @ flattened.T).T
+    return np.ascontiguousarray(projected).reshape(density_maps.shape[0], *self.grid_shape)
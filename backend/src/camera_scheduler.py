@@ -0,0 +1,211 @@
+from typing import List, Optional, Any, Iterator, Callable, Set, Tuple
+import queue
+import threading
+import torch
+from torch.utils.data import DataLoader
+
+from src.camera import Camera, FrameResult
+
+FINISHED = object()
+
+
+class CameraScheduler:
+  """Runs several cameras at once and hands their results over per frame.
+
+  Without a batch size every camera runs its own predict_frames in a thread. With a batch size the cameras
+  must share one model: every camera decodes in its own thread, a single inference thread gathers the
+  decoded frames of all cameras into batches of up to batch_size frames, and the density maps are routed
+  back to per-camera threads that post-process them in frame order. Decoding, post-processing and
+  inference of different cameras therefore overlap, while each camera's results are the same as when it
+  runs alone.
+
+  Every camera has its own queue of decoded batches, and a batch is only taken from a camera while its
+  predictions queue has room. A camera that runs ahead of the others therefore waits for its results to be
+  consumed without holding back the decoded batches of the slower cameras.
+
+  Each camera's results are handed over through a queue of at most max_in_flight_frames frames.
+  """
+
+  def __init__(self, cameras: List[Camera], max_in_flight_frames: int, batch_size: Optional[int] = None) -> None:
+    self.cameras: List[Camera] = cameras
+    self.max_in_flight_frames: int = max_in_flight_frames
+    self.batch_size: Optional[int] = batch_size
+    self.stop: threading.Event = threading.Event()
+    self.threads: List[threading.Thread] = []
+    self.result_queues: List[queue.Queue] = [queue.Queue(maxsize=max_in_flight_frames) for _ in cameras]
+    # Set when a camera has decoded a batch, so the inference thread does not poll
+    self.decoded_ready: threading.Event = threading.Event()
+
+    if batch_size and any(cam.model is not cameras[0].model for cam in cameras):
+      raise ValueError("Cross-camera batching requires all cameras to share the same model.")
+    if batch_size and any(cam.live for cam in cameras):
+      raise ValueError("Cross-camera batching does not support live cameras.")
+
+  def put(self, target: queue.Queue, item: Any) -> bool:
+    """Put item on the queue unless the scheduler is stopped first."""
+    while not self.stop.is_set():
+      try:
+        target.put(item, timeout=0.1)
+        return True
+      except queue.Full:
+        continue
+    return False
+
+  def take(self, source: queue.Queue) -> Any:
+    """Take the next item from the queue, or FINISHED if the scheduler is stopped first."""
+    while not self.stop.is_set():
+      try:
+        return source.get(timeout=0.1)
+      except queue.Empty:
+        continue
+    return FINISHED
+
+  def get(self, source: queue.Queue) -> Iterator[Any]:
+    """Yield items from the queue until FINISHED, re-raising errors forwarded by the producing thread."""
+    while True:
+      item = self.take(source)
+      if item is FINISHED:
+        return
+      if isinstance(item, Exception):
+        raise item
+      yield item
+
+  def start_thread(self, target: Callable[..., None], *args: Any) -> None:
+    thread = threading.Thread(target=target, args=args, daemon=True)
+    thread.start()
+    self.threads.append(thread)
+
+  def forward(self, results: Iterator[Any], target: queue.Queue) -> None:
+    """Put every item of results on target, followed by FINISHED, or by the error that ended results."""
+    try:
+      for result in results:
+        if not self.put(target, result):
+          return
+      self.put(target, FINISHED)
+    except Exception as error:
+      self.put(target, error)
+    finally:
+      if hasattr(results, "close"):
+        results.close()
+
+  def decode(self, camera_index: int, dataloader: DataLoader, decoded: queue.Queue) -> None:
+    try:
+      for frame_indices, img in self.cameras[camera_index].read_batches(dataloader):
+        if not self.put(decoded, (frame_indices, img)):
+          return
+        self.decoded_ready.set()
+      self.put(decoded, (None, None))
+    except Exception as error:
+      self.put(decoded, (None, error))
+    self.decoded_ready.set()
+
+  def gather(self, decoded: List[queue.Queue], predictions: List[queue.Queue], running: Set[int],
+             first_camera: int) -> List[Tuple[int, Optional[List[int]], Any]]:
+    """Take decoded batches of the running cameras round-robin, starting at first_camera, until batch_size frames.
+
+    Every batch taken from a camera, and its end, takes one place in the camera's predictions queue, so no
+    more are taken than the queue has room for and routing the density maps back never blocks.
+    """
+    room = {camera_index: predictions[camera_index].maxsize - predictions[camera_index].qsize() for camera_index in running}
+    order = [(first_camera + offset) % len(self.cameras) for offset in range(len(self.cameras))]
+    batch = []
+    frame_count = 0
+    taken = True
+    while taken and frame_count < self.batch_size:
+      taken = False
+      for camera_index in order:
+        if frame_count >= self.batch_size or camera_index not in running or room[camera_index] == 0:
+          continue
+        try:
+          frame_indices, img = decoded[camera_index].get_nowait()
+        except queue.Empty:
+          continue
+        taken = True
+        room[camera_index] -= 1
+        batch.append((camera_index, frame_indices, img))
+        if frame_indices is None:
+          running.discard(camera_index)
+        else:
+          frame_count += len(frame_indices)
+    return batch
+
+  def infer(self, decoded: List[queue.Queue], predictions: List[queue.Queue]) -> None:
+    """Run the shared model on batches gathered from all cameras and route the density maps back."""
+    running = set(range(len(self.cameras)))
+    first_camera = 0
+    try:
+      while running and not self.stop.is_set():
+        self.decoded_ready.clear()
+        batch = self.gather(decoded, predictions, running, first_camera)
+        if not batch:
+          # Wait for a decoded batch, or for a predictions queue to make room
+          self.decoded_ready.wait(timeout=0.01)
+          continue
+        first_camera = (batch[0][0] + 1) % len(self.cameras)
+
+        frames = [(camera_index, frame_indices, img) for camera_index, frame_indices, img in batch if frame_indices is not None]
+        if frames:
+          pred_map = self.cameras[0].infer(torch.cat([img for _, _, img in frames]))
+          offset = 0
+          for camera_index, frame_indices, img in frames:
+            self.put(predictions[camera_index], (frame_indices, pred_map[offset:offset + len(img)]))
+            offset += len(img)
+
+        for camera_index, frame_indices, error in batch:
+          if frame_indices is None:
+            self.put(predictions[camera_index], FINISHED if error is None else error)
+    except Exception as error:
+      for prediction_queue in predictions:
+        self.put(prediction_queue, error)
+
+  def postprocess(self, camera_index: int, frame_indices: List[int], predictions: queue.Queue) -> None:
+    cam = self.cameras[camera_index]
+    batches = (cam.postprocess(indices, pred_map) for indices, pred_map in self.get(predictions))
+    self.forward(cam.order_results(frame_indices, batches), self.result_queues[camera_index])
+
+  def start(self) -> None:
+    if not self.batch_size:
+      for cam, result_queue in zip(self.cameras, self.result_queues):
+        self.start_thread(self.forward, cam.predict_frames(), result_queue)
+      return
+
+    decoded: List[queue.Queue] = [queue.Queue(maxsize=2) for _ in self.cameras]
+    predictions: List[queue.Queue] = [queue.Queue(maxsize=self.max_in_flight_frames) for _ in self.cameras]
+    for camera_index, cam in enumerate(self.cameras):
+      dataloader = cam.get_video_dataloader()
+      self.start_thread(self.decode, camera_index, dataloader, decoded[camera_index])
+      self.start_thread(self.postprocess, camera_index, cam.frame_indices, predictions[camera_index])
+    self.start_thread(self.infer, decoded, predictions)
+
+  def frames(self) -> Iterator[List[Optional[FrameResult]]]:
+    """Yield one result per camera for every frame, None for cameras that have run out of frames."""
+    self.start()
+    finished = [False] * len(self.cameras)
+    try:
+      while not all(finished):
+        results: List[Optional[FrameResult]] = []
+        for camera_index, result_queue in enumerate(self.result_queues):
+          result = None
+          if not finished[camera_index]:
+            result = result_queue.get()
+            if isinstance(result, Exception):
+              raise result
+            if result is FINISHED:
+              finished[camera_index] = True
+              result = None
+          results.append(result)
+
+        if not all(finished):
+          yield results
+    finally:
+      self.close()
+
+  def streams(self) -> List[Iterator[FrameResult]]:
+    """Start the cameras and return every camera's results as a separate iterator, call close when done."""
+    self.start()
+    return [self.get(result_queue) for result_queue in self.result_queues]
+
+  def close(self) -> None:
+    self.stop.set()
+    for thread in self.threads:
+      thread.join()
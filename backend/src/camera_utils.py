@@ -1,15 +1,48 @@
+from typing import Tuple, Optional
 import numpy as np
 import cv2
 
+from src.profiler import profiler
+from src.heatmap_renderer import HeatmapRenderer
+
+
+def block_sum(matrix: np.ndarray, block_height: int, block_width: int) -> np.ndarray:
+  """Sum each block_height x block_width block of matrix, whose shape must be a multiple of the block shape.
+
+  The sums are bit for bit identical to calling np.sum on every block: numpy reduces a strided block in
+  buffered chunks of whole rows, so the same row chunks are summed here and accumulated in the same order.
+  """
+  rows = matrix.shape[0] // block_height
+  cols = matrix.shape[1] // block_width
+  blocks = matrix.reshape(rows, block_height, cols, block_width).swapaxes(1, 2)
+  chunk_rows = max(np.getbufsize() // block_width, 1)
+
+  result = None
+  for chunk_start in range(0, block_height, chunk_rows):
+    chunk = blocks[:, :, chunk_start:chunk_start + chunk_rows]
+    chunk_sum = chunk.reshape(rows, cols, -1).sum(axis=2)
+    result = chunk_sum if result is None else result + chunk_sum
+
+  return result
+
+
 class CameraUtils:
   def __init__(self, heatmap_alpha: int, output_dir: str, upsampling_factor: int, color_map: int) -> None:
     self.heatmap_alpha: int = heatmap_alpha
     self.output_dir: str = output_dir
     self.upsampling_factor: int = upsampling_factor
     self.color_map: int = color_map
+    self.heatmap_renderer: Optional[HeatmapRenderer] = None
 
-  def correct_fisheye_distortion(self, image: np.ndarray, distortionParameter: float) -> np.ndarray:
-    h, w = image.shape[:2]
+  def get_heatmap_renderer(self) -> HeatmapRenderer:
+    """Return the cached renderer, rebuilding it if the colour map or heatmap alpha have changed."""
+    renderer = self.heatmap_renderer
+    if renderer is None or renderer.color_map != self.color_map or renderer.heatmap_alpha != self.heatmap_alpha:
+      renderer = self.heatmap_renderer = HeatmapRenderer(self.color_map, self.heatmap_alpha)
+    return renderer
+
+  def fisheye_camera_matrices(self, image_shape: Tuple[int, int], distortionParameter: float) -> Tuple[np.ndarray, np.ndarray]:
+    h, w = image_shape[:2]
 
     camera_matrix = np.array([[w / 2.0, 0, w / 2.0],
                               [0, w / 2.0, h / 2.0],
@@ -17,11 +50,17 @@ class CameraUtils:
 
     dist_coeffs = np.array([distortionParameter, 0, 0, 0, 0], dtype=np.float32)
 
+    return camera_matrix, dist_coeffs
+
+  @profiler.timed("undistort")
+  def correct_fisheye_distortion(self, image: np.ndarray, distortionParameter: float) -> np.ndarray:
+    camera_matrix, dist_coeffs = self.fisheye_camera_matrices(image.shape, distortionParameter)
+
     corrected_image = cv2.undistort(image, camera_matrix, dist_coeffs)
 
     return corrected_image
 
-  def correct_perspective(self, matrix: np.ndarray, corner_matrix: np.ndarray) -> np.ndarray:
+  def perspective_transform(self, corner_matrix: np.ndarray) -> Tuple[np.ndarray, Tuple[int, int]]:
     pt_A = corner_matrix[0]
     pt_B = corner_matrix[1]
     pt_C = corner_matrix[2]
@@ -45,31 +84,46 @@ class CameraUtils:
     # Compute the perspective transform M
     M = cv2.getPerspectiveTransform(input_pts,output_pts)
 
-    out = cv2.warpPerspective(matrix,M,(maxWidth, maxHeight),flags=cv2.INTER_LINEAR)
+    return M, (maxWidth, maxHeight)
+
+  @profiler.timed("warp")
+  def correct_perspective(self, matrix: np.ndarray, corner_matrix: np.ndarray) -> np.ndarray:
+    M, output_size = self.perspective_transform(corner_matrix)
+
+    out = cv2.warpPerspective(matrix,M,output_size,flags=cv2.INTER_LINEAR)
 
     return out
 
+  @profiler.timed("downsample")
   def downsample_image(self, matrix: np.ndarray, scale_factor: int) -> np.ndarray:
+    height, width = matrix.shape
+    full_height = height - height % scale_factor
+    full_width = width - width % scale_factor
+
     # Calculate the dimensions of the downscaled array with padding
-    new_height = matrix.shape[0] // scale_factor + (matrix.shape[0] % scale_factor > 0)
-    new_width = matrix.shape[1] // scale_factor + (matrix.shape[1] % scale_factor > 0)
+    new_height = height // scale_factor + (height % scale_factor > 0)
+    new_width = width // scale_factor + (width % scale_factor > 0)
 
     # Initialize the downscaled array with zeros
     downscaled_array = np.zeros((new_height, new_width), dtype=matrix.dtype)
 
-    # Iterate through the downscaled array and calculate the sum of the pixels
-    for i in range(new_height):
-      for j in range(new_width):
-        row_start = i * scale_factor
-        row_end = min((i + 1) * scale_factor, matrix.shape[0])
-        col_start = j * scale_factor
-        col_end = min((j + 1) * scale_factor, matrix.shape[1])
-        downscaled_array[i, j] = np.sum(matrix[row_start:row_end, col_start:col_end])
+    # Sum the full blocks and the smaller blocks along the bottom and right edges separately
+    row_parts = [(0, full_height, scale_factor), (full_height, height, height - full_height)]
+    col_parts = [(0, full_width, scale_factor), (full_width, width, width - full_width)]
+    for row_start, row_end, block_height in row_parts:
+      for col_start, col_end, block_width in col_parts:
+        if row_end == row_start or col_end == col_start:
+          continue
+        summed = block_sum(matrix[row_start:row_end, col_start:col_end], block_height, block_width)
+        row_offset = row_start // scale_factor
+        col_offset = col_start // scale_factor
+        downscaled_array[row_offset:row_offset + summed.shape[0], col_offset:col_offset + summed.shape[1]] = summed
 
     return downscaled_array
 
+  @profiler.timed("upsample")
   def upsample_image(self, matrix: np.ndarray) -> np.ndarray:
-    height, width = matrix.shape
+    height, width = matrix.shape[:2]
 
     new_height = int(height * self.upsampling_factor)
     new_width = int(width * self.upsampling_factor)
@@ -78,13 +132,10 @@ class CameraUtils:
 
     return upscaled_image
 
+  @profiler.timed("heatmap")
   def make_heatmap(self, matrix: np.ndarray) -> np.ndarray:
-    scaled_map = np.uint8(cv2.convertScaleAbs(matrix, alpha=self.heatmap_alpha / 1000))
-    if not self.color_map:
-      final_map = np.stack((scaled_map,)*3, axis=-1)
-      return final_map
-
-    return cv2.applyColorMap(scaled_map, self.color_map)
+    """Render a map, or a (batch, height, width) stack of maps, as BGR heatmaps, see HeatmapRenderer."""
+    return self.get_heatmap_renderer().render(matrix)
 
   def add_graphics(self, picture: np.ndarray, count: int) -> np.ndarray:
     cv2.putText(picture, f'Predicted Count: {count}', (50, 50),
@@ -94,43 +145,4 @@ class CameraUtils:
     if not self.color_map:
       return picture
 
-    # Number of discrete colors and colorbar dimensions
-    num_colors = 256
-    bar_width = 50
-    bar_height = picture.shape[0]  # This can be equal to num_colors if you want a one-to-one ratio
-
-    # Create an image with a vertical gradient
-    gradient = np.linspace(1, 0, num_colors).reshape(num_colors, 1)
-    gradient = np.repeat(gradient, bar_width, axis=1)  # bar_width is the width of the colorbar
-    gradient = cv2.resize(gradient, (bar_width, bar_height), interpolation=cv2.INTER_LINEAR)
-    gradient = (255 * gradient).astype(np.uint8)
-
-    colorbar_img = cv2.applyColorMap(gradient, self.color_map)
-
-    # Create a white canvas for the labels
-    label_width = 100  # Width of the area for the labels
-    full_img = 255 * np.ones((bar_height, bar_width + label_width, 3), dtype=np.uint8)
-    full_img[:, :bar_width, :] = colorbar_img  # Place the colorbar on the canvas
-
-    # Define the step and range for the labels
-    step = int(bar_height / 10)  # Adjust step for the number of labels you want
-    value_range = np.linspace(255 / self.heatmap_alpha, 0, bar_height)
-
-    # Add labels
-    for i in range(0, bar_height, step):
-      value = value_range[i]
-      text = f"{value:.2f}"
-      cv2.putText(
-        full_img,
-        text,
-        (bar_width + 10, i + 5),
-        cv2.FONT_HERSHEY_DUPLEX,
-        0.5,
-        (0, 0, 0),
-        1,
-        cv2.LINE_AA,
-      )
-
-    combined_image = np.concatenate((picture, full_img), axis=1)
-
-    return combined_image
\ No newline at end of file
+    return np.concatenate((picture, self.get_heatmap_renderer().colorbar(picture.shape[0])), axis=1)
@@ -0,0 +1,96 @@
+from typing import List, Tuple
+import numpy as np
+import scipy.sparse
+import cv2
+
+from src.profiler import profiler
+
+
+class DensityFusion:
+  """Fuses the density maps of several cameras into one global grid with a single sparse product.
+
+  Every camera's map is placed on its global_coordinates quadrilateral through the homography from the map's
+  corners to the quadrilateral's, so quadrilaterals that are not axis-aligned rectangles are placed
+  correctly. Each map cell is sampled on a supersampling x supersampling grid and every sample carries an
+  equal share of the cell, so a camera's people are kept wherever its quadrilateral lies inside the grid.
+
+  Where cameras overlap, the global cell is the weighted average of the cameras, weighted by the distance
+  to the edge of each camera's quadrilateral so that seams are feathered. The placement and the weights
+  are fixed for the cameras, so they are built once into a (cells x all camera cells) matrix and a batch
+  of frames of all cameras is fused by one matrix product.
+  """
+
+  def __init__(
+    self,
+    global_coordinates: List[List[Tuple[int, int]]],
+    map_shapes: List[Tuple[int, int]],
+    grid_size: Tuple[int, int],
+    supersampling: int = 4
+  ) -> None:
+    self.global_coordinates: Tuple[Tuple[Tuple[int, int], ...], ...] = tuple(
+      tuple(tuple(c) for c in coordinates) for coordinates in global_coordinates)
+    self.map_shapes: Tuple[Tuple[int, int], ...] = tuple(tuple(shape[:2]) for shape in map_shapes)
+    # (width, height) of the global grid in cells
+    self.grid_size: Tuple[int, int] = tuple(grid_size)
+    self.supersampling: int = supersampling
+
+    placements = [self.build_placement(coordinates, shape)
+                  for coordinates, shape in zip(self.global_coordinates, self.map_shapes)]
+    weights = self.build_weights(placements)
+    self.fusion_matrix: scipy.sparse.csr_matrix = scipy.sparse.hstack(
+      [scipy.sparse.diags(weight.ravel()) @ placement for weight, placement in zip(weights, placements)]).tocsr()
+
+  def matches(self, global_coordinates: List[List[Tuple[int, int]]], map_shapes: List[Tuple[int, int]],
+              grid_size: Tuple[int, int]) -> bool:
+    return (self.global_coordinates == tuple(tuple(tuple(c) for c in coordinates) for coordinates in global_coordinates)
+            and self.map_shapes == tuple(tuple(shape[:2]) for shape in map_shapes)
+            and self.grid_size == tuple(grid_size))
+
+  def build_placement(self, coordinates: Tuple[Tuple[int, int], ...], map_shape: Tuple[int, int]) -> scipy.sparse.csr_matrix:
+    """Build the (cells x map cells) matrix that distributes every cell of a camera's map over the global cells."""
+    height, width = map_shape
+    grid_width, grid_height = self.grid_size
+    # The map's corners in the order of local_coordinates, which perspective_transform maps onto the global ones
+    corners = np.float32([(0, 0), (0, height), (width, height), (width, 0)])
+    homography = cv2.getPerspectiveTransform(corners, np.float32(coordinates)).astype(np.float64)
+
+    samples = self.supersampling ** 2
+    offsets = (np.arange(self.supersampling) + 0.5) / self.supersampling
+    offset_x, offset_y = [o.ravel() for o in np.meshgrid(offsets, offsets)]
+    cell_y, cell_x = np.mgrid[0:height, 0:width]
+    cell_index = (cell_y * width + cell_x).ravel().repeat(samples)
+    sample_x = (cell_x.reshape(-1, 1) + offset_x).ravel()
+    sample_y = (cell_y.reshape(-1, 1) + offset_y).ravel()
+
+    denominator = homography[2, 0] * sample_x + homography[2, 1] * sample_y + homography[2, 2]
+    global_x = np.floor((homography[0, 0] * sample_x + homography[0, 1] * sample_y + homography[0, 2]) / denominator)
+    global_y = np.floor((homography[1, 0] * sample_x + homography[1, 1] * sample_y + homography[1, 2]) / denominator)
+    inside = (global_x >= 0) & (global_x < grid_width) & (global_y >= 0) & (global_y < grid_height)
+    global_index = global_y[inside].astype(np.int64) * grid_width + global_x[inside].astype(np.int64)
+
+    placement = scipy.sparse.csr_matrix(
+      (np.full(global_index.size, 1 / samples, dtype=np.float32), (global_index, cell_index[inside])),
+      shape=(grid_width * grid_height, height * width))
+    placement.sum_duplicates()
+    return placement
+
+  def build_weights(self, placements: List[scipy.sparse.csr_matrix]) -> List[np.ndarray]:
+    """Per camera, the share of every global cell taken from that camera; the shares of a covered cell add up to one."""
+    grid_width, grid_height = self.grid_size
+    feathers = []
+    for placement in placements:
+      # Cells that receive part of the camera's map, padded so the grid border does not count as an edge
+      mask = (np.asarray(placement.sum(axis=1)).reshape(grid_height, grid_width) > 0).astype(np.uint8)
+      distance = cv2.distanceTransform(cv2.copyMakeBorder(mask, 1, 1, 1, 1, cv2.BORDER_REPLICATE), cv2.DIST_L2, 3)
+      # A camera that covers the whole grid has no edge, its distances are unbounded
+      feathers.append(np.minimum(distance[1:-1, 1:-1], max(grid_width, grid_height)) * mask)
+
+    total = np.sum(feathers, axis=0)
+    return [np.divide(feather, total, out=np.zeros_like(feather), where=total > 0) for feather in feathers]
+
+  @profiler.timed("fusion")
+  def fuse(self, density_maps: List[np.ndarray]) -> np.ndarray:
+    """Fuse one (batch, height, width) stack of maps per camera into a (batch, grid height, grid width) stack."""
+    flattened = np.concatenate([maps.reshape(maps.shape[0], -1) for maps in density_maps], axis=1)
+    fused = (self.fusion_matrix @ flattened.T).T
+    return np.ascontiguousarray(fused, dtype=np.float32).reshape(-1, self.grid_size[1], self.grid_size[0])
@@ -0,0 +1,107 @@
+from typing import List, Tuple, Optional, Dict
+import json
+import os
+import numpy as np
+
+SIDECAR_NAME = "density.json"
+
+
+class DensityMapWriter:
+  """Writes the global-grid density maps of a run as float32 arrays on disk.
+
+  Frames are appended to .npy chunks of chunk_frames frames each, so the number of frames does not have to be
+  known in advance and no chunk is ever held in memory. A JSON sidecar records the grid size, metres per
+  cell, the frame indices and timestamps of the frames and the chunk files. Values are people per cell.
+  """
+
+  def __init__(self, directory: str, grid_shape: Tuple[int, int], metres_per_cell: float = 1.0, chunk_frames: int = 256) -> None:
+    self.directory: str = directory
+    self.grid_shape: Tuple[int, int] = grid_shape
+    self.metres_per_cell: float = metres_per_cell
+    self.chunk_frames: int = chunk_frames
+    self.chunks: List[str] = []
+    self.frame_indices: List[int] = []
+    self.timestamps: List[float] = []
+    self.chunk: Optional[np.memmap] = None
+
+    os.makedirs(directory, exist_ok=True)
+
+  def write(self, density_map: np.ndarray, frame_index: int, timestamp: float) -> None:
+    position = len(self.frame_indices) % self.chunk_frames
+    if position == 0:
+      self.close_chunk()
+      name = f"density_{len(self.chunks):05d}.npy"
+      self.chunks.append(name)
+      self.chunk = np.lib.format.open_memmap(os.path.join(self.directory, name), mode="w+", dtype=np.float32,
+                                             shape=(self.chunk_frames, *self.grid_shape))
+
+    self.chunk[position] = density_map
+    self.frame_indices.append(int(frame_index))
+    self.timestamps.append(float(timestamp))
+
+  def close_chunk(self) -> None:
+    if self.chunk is None:
+      return
+
+    filled = len(self.frame_indices) - (len(self.chunks) - 1) * self.chunk_frames
+    self.chunk.flush()
+    if filled < self.chunk_frames:
+      # Shrink the last chunk to the frames that were written
+      path = os.path.join(self.directory, self.chunks[-1])
+      frames = np.array(self.chunk[:filled])
+      del self.chunk
+      np.save(path, frames)
+    self.chunk = None
+
+  def close(self) -> None:
+    self.close_chunk()
+    sidecar = {
+      "frame_count": len(self.frame_indices),
+      "grid_height": self.grid_shape[0],
+      "grid_width": self.grid_shape[1],
+      "metres_per_cell": self.metres_per_cell,
+      "dtype": "float32",
+      "units": "people per cell",
+      "chunk_frames": self.chunk_frames,
+      "chunks": self.chunks,
+      "frame_indices": self.frame_indices,
+      "timestamps": self.timestamps,
+    }
+    with open(os.path.join(self.directory, SIDECAR_NAME), "w") as sidecar_file:
+      json.dump(sidecar, sidecar_file, indent=2)
+
+
+class DensityMapReader:
+  """Memory-maps the density maps written by DensityMapWriter; only the frames and regions read are loaded."""
+
+  def __init__(self, directory: str) -> None:
+    self.directory: str = directory
+    with open(os.path.join(directory, SIDECAR_NAME)) as sidecar_file:
+      self.metadata: dict = json.load(sidecar_file)
+    self.chunk_frames: int = self.metadata["chunk_frames"]
+    self.grid_shape: Tuple[int, int] = (self.metadata["grid_height"], self.metadata["grid_width"])
+    self.metres_per_cell: float = self.metadata["metres_per_cell"]
+    self.frame_indices: List[int] = self.metadata["frame_indices"]
+    self.timestamps: List[float] = self.metadata["timestamps"]
+    self.chunks: Dict[int, np.ndarray] = {}
+
+  def __len__(self) -> int:
+    return self.metadata["frame_count"]
+
+  def get_chunk(self, chunk_index: int) -> np.ndarray:
+    if chunk_index not in self.chunks:
+      path = os.path.join(self.directory, self.metadata["chunks"][chunk_index])
+      self.chunks[chunk_index] = np.load(path, mmap_mode="r")
+    return self.chunks[chunk_index]
+
+  def frame(self, position: int) -> np.ndarray:
+    """The density map of the position-th written frame, as a read-only memory-mapped view."""
+    if not 0 <= position < len(self):
+      raise IndexError(f"Frame {position} is out of range for {len(self)} frames.")
+    return self.get_chunk(position // self.chunk_frames)[position % self.chunk_frames]
+
+  def region(self, position: int, rows: slice, cols: slice) -> np.ndarray:
+    return self.frame(position)[rows, cols]
+
+  def total(self, position: int) -> float:
+    return float(self.frame(position).sum())
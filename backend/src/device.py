@@ -0,0 +1,7 @@
+import torch
+
+def resolve_device(device: str) -> torch.device:
+  """Turn a configured device ("cpu", "cuda", "cuda:1" or "auto") into a torch.device."""
+  if device == "auto":
+    return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+  return torch.device(device)
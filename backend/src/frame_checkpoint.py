@@ -0,0 +1,59 @@
+from typing import Set, Tuple, Any, Dict
+import hashlib
+import json
+import os
+import numpy as np
+
+def hash_video(video_path: str, sample_count: int = 64, sample_size: int = 1024 * 1024) -> str:
+  """Fingerprint of a video file's contents from its size and sample_count evenly spaced blocks.
+
+  Reading a multi-hour video in full would take longer than is worth it at every start, while any
+  re-encode or edit changes the size or the sampled bytes.
+  """
+  file_size = os.path.getsize(video_path)
+  digest = hashlib.sha1(str(file_size).encode())
+  with open(video_path, "rb") as video_file:
+    for sample in range(sample_count):
+      video_file.seek(max(file_size - sample_size, 0) * sample // max(sample_count - 1, 1))
+      digest.update(video_file.read(sample_size))
+  return digest.hexdigest()[:16]
+
+def hash_config(config: Dict[str, Any]) -> str:
+  return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+class FrameCheckpoint:
+  """Stores the model output of every processed frame so that an interrupted run can resume.
+
+  Per frame the raw sum of the density map and the projected density map are written, before they are
+  divided by the log parameter or rendered, to frame_{index}.npz in a directory named after the video's
+  content hash and the hash of config, which holds every setting the model output depends on. Heatmaps can
+  therefore be rendered again from the checkpoint with a different alpha, colormap or log parameter.
+  """
+
+  def __init__(self, checkpoint_dir: str, video_path: str, config: Dict[str, Any]) -> None:
+    self.directory: str = os.path.join(checkpoint_dir, f"{hash_video(video_path)}_{hash_config(config)}")
+    os.makedirs(self.directory, exist_ok=True)
+
+    config_path = os.path.join(self.directory, "config.json")
+    if not os.path.isfile(config_path):
+      with open(config_path, "w") as config_file:
+        json.dump(dict(config, video_path=video_path), config_file, indent=2, default=str)
+
+  def get_path(self, frame_index: int) -> str:
+    return os.path.join(self.directory, f"frame_{frame_index:08d}.npz")
+
+  def completed_frames(self) -> Set[int]:
+    return {int(name[len("frame_"):-len(".npz")]) for name in os.listdir(self.directory)
+            if name.startswith("frame_") and name.endswith(".npz")}
+
+  def save(self, frame_index: int, pred_sum: float, projected_map: np.ndarray) -> None:
+    path = self.get_path(frame_index)
+    # Write under a temporary name first so a crash never leaves a truncated checkpoint behind
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as checkpoint_file:
+      np.savez(checkpoint_file, pred_sum=pred_sum, projected_map=projected_map)
+    os.replace(temp_path, path)
+
+  def load(self, frame_index: int) -> Tuple[float, np.ndarray]:
+    with np.load(self.get_path(frame_index)) as checkpoint:
+      return checkpoint["pred_sum"][()], checkpoint["projected_map"]
@@ -0,0 +1,40 @@
+from typing import Sequence, Optional, Tuple
+import numpy as np
+import torch
+
+# Normalisation SASNet's VGG-16 backbone was trained with
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
+
+class FrameTransform:
+  """torchvision's ToTensor followed by Normalize for HWC uint8 frames, without importing torchvision.
+
+  Importing torchvision.transforms imports all of torchvision's models and ops, which takes seconds at start-up.
+  The arithmetic is the same as torchvision's, so the results are identical.
+
+  crop is an (x, y, width, height) region of interest; only that part of the frame is converted. Without
+  normalize the cropped frame is returned as a uint8 tensor, to be normalised later with normalize_frames.
+  """
+
+  def __init__(self, mean: Sequence[float], std: Sequence[float], crop: Optional[Tuple[int, int, int, int]] = None,
+               normalize: bool = True) -> None:
+    self.mean: torch.Tensor = torch.as_tensor(mean, dtype=torch.float32)[:, None, None]
+    self.std: torch.Tensor = torch.as_tensor(std, dtype=torch.float32)[:, None, None]
+    self.crop: Optional[Tuple[int, int, int, int]] = crop
+    self.normalize: bool = normalize
+
+  def __call__(self, frame: np.ndarray) -> torch.Tensor:
+    if self.crop is not None:
+      x, y, width, height = self.crop
+      if y + height > frame.shape[0] or x + width > frame.shape[1]:
+        raise ValueError(f"The crop {self.crop} does not fit in {frame.shape[1]}x{frame.shape[0]} frames.")
+      frame = frame[y:y + height, x:x + width]
+    img = torch.from_numpy(frame.transpose((2, 0, 1))).contiguous()
+    if not self.normalize:
+      return img
+    return self.normalize_frames(img)
+
+  def normalize_frames(self, img: torch.Tensor) -> torch.Tensor:
+    """Normalise a uint8 (3, height, width) frame or (batch, 3, height, width) stack on the device it is on."""
+    img = img.to(dtype=torch.float32).div(255)
+    return img.sub_(self.mean.to(img.device)).div_(self.std.to(img.device))
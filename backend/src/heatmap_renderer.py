@@ -0,0 +1,90 @@
+from typing import Dict, Optional
+import threading
+import numpy as np
+import cv2
+
+
+class HeatmapRenderer:
+  """Renders density maps as BGR heatmaps through a 256-entry lookup table, and caches the colour bar.
+
+  Maps are scaled to uint8 with convertScaleAbs by heatmap_alpha / 1000, and the table holds applyColorMap's
+  colour for every scaled value, so the heatmaps are identical to applying the colour map to each frame.
+  Looking up a prebuilt table skips rebuilding OpenCV's colour map on every call, and also replaces the
+  three-channel stack of the grey heatmap. A whole batch of maps is scaled and looked up at once, into
+  buffers that are reused while the batch shape stays the same. The buffers are per thread, as the cameras
+  share one renderer.
+  """
+
+  def __init__(self, color_map: Optional[int], heatmap_alpha: int) -> None:
+    self.color_map: Optional[int] = color_map
+    self.heatmap_alpha: int = heatmap_alpha
+
+    # (256, 1, 3), the shape applyColorMap takes as a user colour map
+    values = np.arange(256, dtype=np.uint8).reshape(256, 1)
+    if color_map:
+      self.lut: np.ndarray = cv2.applyColorMap(values, color_map)
+    else:
+      self.lut = np.repeat(values, 3, axis=1).reshape(256, 1, 3)
+
+    self.buffers: threading.local = threading.local()
+    self.colorbars: Dict[int, np.ndarray] = {}
+
+  def scale(self, density_maps: np.ndarray) -> np.ndarray:
+    """Scale maps to uint8 as (batch * height, width) rows, into a buffer reused for maps of the same shape."""
+    rows = density_maps.reshape(-1, density_maps.shape[-1])
+    scaled = getattr(self.buffers, "scaled", None)
+    if scaled is None or scaled.shape != rows.shape:
+      scaled = self.buffers.scaled = np.empty(rows.shape, dtype=np.uint8)
+    return cv2.convertScaleAbs(rows, dst=scaled, alpha=self.heatmap_alpha / 1000)
+
+  def render(self, density_maps: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """Render a (height, width) map or a (batch, height, width) stack of maps as BGR heatmaps."""
+    scaled = self.scale(density_maps)
+    if out is None:
+      out = np.empty(density_maps.shape + (3,), dtype=np.uint8)
+    cv2.applyColorMap(scaled, self.lut, dst=out.reshape(scaled.shape + (3,)))
+    return out
+
+  def colorbar(self, height: int) -> np.ndarray:
+    """The colour bar and value labels add_graphics places next to a picture of the given height."""
+    if height in self.colorbars:
+      return self.colorbars[height]
+
+    # Number of discrete colors and colorbar dimensions
+    num_colors = 256
+    bar_width = 50
+
+    # Create an image with a vertical gradient
+    gradient = np.linspace(1, 0, num_colors).reshape(num_colors, 1)
+    gradient = np.repeat(gradient, bar_width, axis=1)  # bar_width is the width of the colorbar
+    gradient = cv2.resize(gradient, (bar_width, height), interpolation=cv2.INTER_LINEAR)
+    gradient = (255 * gradient).astype(np.uint8)
+
+    colorbar_img = cv2.applyColorMap(gradient, self.lut)
+
+    # Create a white canvas for the labels
+    label_width = 100  # Width of the area for the labels
+    full_img = 255 * np.ones((height, bar_width + label_width, 3), dtype=np.uint8)
+    full_img[:, :bar_width, :] = colorbar_img  # Place the colorbar on the canvas
+
+    # Define the step and range for the labels
+    step = int(height / 10)  # Adjust step for the number of labels you want
+    value_range = np.linspace(255 / self.heatmap_alpha, 0, height)
+
+    # Add labels
+    for i in range(0, height, step):
+      value = value_range[i]
+      text = f"{value:.2f}"
+      cv2.putText(
+        full_img,
+        text,
+        (bar_width + 10, i + 5),
+        cv2.FONT_HERSHEY_DUPLEX,
+        0.5,
+        (0, 0, 0),
+        1,
+        cv2.LINE_AA,
+      )
+
+    self.colorbars[height] = full_img
+    return full_img
@@ -0,0 +1,121 @@
+from typing import Optional, Dict, Any
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import threading
+import numpy as np
+import torch
+
+def hash_file(path: str, block_size: int = 1024 * 1024) -> str:
+  digest = hashlib.sha1()
+  with open(path, "rb") as weights_file:
+    for block in iter(lambda: weights_file.read(block_size), b""):
+      digest.update(block)
+  return digest.hexdigest()
+
+def hash_file_cached(path: str) -> str:
+  """hash_file of path, kept in a <path>.sha1 file and reused while the file's size and modification time are unchanged.
+
+  Hashing the weights takes a noticeable part of start-up, so it is only done again when they change. When the
+  directory is read-only the hash is not kept.
+  """
+  stat = os.stat(path)
+  file_stat = [stat.st_size, stat.st_mtime_ns]
+  cache_path = path + ".sha1"
+  try:
+    with open(cache_path) as cache_file:
+      cached = json.load(cache_file)
+    if cached["stat"] == file_stat:
+      return cached["sha1"]
+  except (OSError, ValueError, KeyError, TypeError):
+    pass
+
+  digest = hash_file(path)
+  try:
+    with open(cache_path, "w") as cache_file:
+      json.dump({"stat": file_stat, "sha1": digest}, cache_file)
+  except OSError:
+    pass
+  return digest
+
+class InferenceCache:
+  """On-disk cache of density maps, addressed by the decoded frame and the model that ran on it.
+
+  The key of a frame hashes model_key (the weights hash and every setting that changes the model output,
+  including the crop and normalisation of the frames), the frame's shape and its uint8 pixels as decoded, so
+  the same frame of overlapping clips is only inferred once. Density maps are stored as compressed float16. When the cache grows beyond
+  max_size_mb the least recently used entries are evicted; hits refresh an entry's modification time, which
+  orders the entries across runs.
+  """
+
+  def __init__(self, cache_dir: str, model_key: Dict[str, Any], max_size_mb: int = 2048) -> None:
+    self.cache_dir: str = cache_dir
+    self.model_key: str = json.dumps(model_key, sort_keys=True, default=str)
+    self.max_size: int = max_size_mb * 1024 * 1024
+    self.lock: threading.Lock = threading.Lock()
+    self.hits: int = 0
+    self.misses: int = 0
+
+    os.makedirs(cache_dir, exist_ok=True)
+    entries = sorted((entry.stat().st_mtime, entry.name, entry.stat().st_size) for entry in os.scandir(cache_dir)
+                     if entry.name.endswith(".npz"))
+    # Least recently used first
+    self.entries: OrderedDict = OrderedDict((name, size) for _, name, size in entries)
+    self.size: int = sum(self.entries.values())
+
+  def get_key(self, frame: torch.Tensor) -> str:
+    """Key of a decoded uint8 frame, before it is normalised and copied to the device."""
+    if frame.dtype != torch.uint8:
+      raise ValueError(f"Frames are keyed by their decoded uint8 pixels, not {frame.dtype}.")
+    digest = hashlib.blake2b(self.model_key.encode(), digest_size=20)
+    digest.update(str(tuple(frame.shape)).encode())
+    digest.update(frame.contiguous().numpy())
+    return digest.hexdigest()
+
+  def get_path(self, key: str) -> str:
+    return os.path.join(self.cache_dir, f"{key}.npz")
+
+  def load(self, key: str) -> Optional[np.ndarray]:
+    name = f"{key}.npz"
+    with self.lock:
+      if name not in self.entries:
+        self.misses += 1
+        return None
+      self.entries.move_to_end(name)
+      self.hits += 1
+
+    path = self.get_path(key)
+    try:
+      with np.load(path) as entry:
+        density_map = entry["density_map"].astype(np.float32)
+      os.utime(path)
+    except (OSError, ValueError, KeyError):
+      # Evicted by another process or left unreadable, infer the frame again
+      with self.lock:
+        self.size -= self.entries.pop(name, 0)
+      return None
+    return density_map
+
+  def save(self, key: str, density_map: np.ndarray) -> None:
+    path = self.get_path(key)
+    temp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(temp_path, "wb") as entry_file:
+      np.savez_compressed(entry_file, density_map=density_map.astype(np.float16))
+    os.replace(temp_path, path)
+
+    with self.lock:
+      name = os.path.basename(path)
+      self.size -= self.entries.pop(name, 0)
+      self.entries[name] = os.path.getsize(path)
+      self.size += self.entries[name]
+      self.evict()
+
+  def evict(self) -> None:
+    while self.size > self.max_size and len(self.entries) > 1:
+      name, size = self.entries.popitem(last=False)
+      self.size -= size
+      try:
+        os.remove(os.path.join(self.cache_dir, name))
+      except FileNotFoundError:
+        pass
@@ -0,0 +1,151 @@
+from typing import Optional, Tuple, Callable, Iterator
+import sys
+import threading
+import time
+import numpy as np
+import torch
+import cv2
+
+from src.profiler import profiler
+
+class LiveFrameSource:
+  """Reads a live video in a background thread and hands out only the most recent frame.
+
+  source is anything cv2.VideoCapture opens (an RTSP or HTTP URL, a file or named pipe in a container format,
+  or a webcam index such as "0"). With frame_size set, source is instead a file or named pipe of raw bgr24
+  frames of that (width, height), or "-" for stdin, e.g. the output of `ffmpeg -f rawvideo -pix_fmt bgr24 -`.
+
+  The reader thread replaces the latest frame with every new one, so a consumer that is slower than the
+  stream skips frames instead of falling behind. With replay set, a file is read at its own frame rate,
+  as a stand-in for a live stream.
+  """
+
+  def __init__(
+    self,
+    source: str,
+    transform: Optional[Callable] = None,
+    target_resolution: Tuple[int, int] = (1920, 1080),
+    frame_size: Optional[Tuple[int, int]] = None,
+    replay: bool = False
+  ) -> None:
+    self.source: str = source
+    self.transform: Optional[Callable] = transform
+    self.target_resolution: Tuple[int, int] = target_resolution
+    self.frame_size: Optional[Tuple[int, int]] = frame_size
+    self.replay: bool = replay
+
+    self.condition: threading.Condition = threading.Condition()
+    self.stop: threading.Event = threading.Event()
+    self.thread: Optional[threading.Thread] = None
+    # (frame number, seconds since the source was started, frame) of the newest frame nobody has taken yet
+    self.latest: Optional[Tuple[int, float, np.ndarray]] = None
+    self.finished: bool = False
+    self.error: Optional[Exception] = None
+    self.start_time: float = 0.0
+    self.frames_read: int = 0
+    self.frames_dropped: int = 0
+
+  def read_capture(self) -> Iterator[np.ndarray]:
+    cap = cv2.VideoCapture(int(self.source) if self.source.isdigit() else self.source)
+    if not cap.isOpened():
+      raise ValueError(f"Unable to open live source {self.source}")
+
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    frame_time = 1 / fps if self.replay and fps > 0 else 0.0
+    next_time = time.perf_counter()
+    try:
+      while not self.stop.is_set():
+        ret, frame = cap.read()
+        if not ret:
+          return
+        if frame_time:
+          # Hold the frame back until it would have arrived from a live stream
+          next_time += frame_time
+          time.sleep(max(next_time - time.perf_counter(), 0))
+        yield frame
+    finally:
+      cap.release()
+
+  def read_raw(self) -> Iterator[np.ndarray]:
+    width, height = self.frame_size
+    frame_bytes = width * height * 3
+    stream = sys.stdin.buffer if self.source == "-" else open(self.source, "rb")
+    try:
+      while not self.stop.is_set():
+        buffer = bytearray(frame_bytes)
+        view = memoryview(buffer)
+        filled = 0
+        while filled < frame_bytes:
+          read = stream.readinto(view[filled:])
+          if not read:
+            return
+          filled += read
+        yield np.frombuffer(buffer, dtype=np.uint8).reshape(height, width, 3)
+    finally:
+      if stream is not sys.stdin.buffer:
+        stream.close()
+
+  def read(self) -> None:
+    try:
+      frames = self.read_raw() if self.frame_size else self.read_capture()
+      for frame in frames:
+        with self.condition:
+          if self.latest is not None:
+            self.frames_dropped += 1
+          self.latest = (self.frames_read, time.perf_counter() - self.start_time, frame)
+          self.frames_read += 1
+          self.condition.notify_all()
+    except Exception as error:
+      self.error = error
+    finally:
+      with self.condition:
+        self.finished = True
+        self.condition.notify_all()
+
+  def start(self) -> None:
+    self.start_time = time.perf_counter()
+    self.thread = threading.Thread(target=self.read, daemon=True)
+    self.thread.start()
+
+  def close(self) -> None:
+    self.stop.set()
+    # A reader blocked on a pipe only notices the stop with its next frame; it is a daemon thread
+    if self.thread is not None:
+      self.thread.join(timeout=1)
+
+  def take(self) -> Optional[Tuple[int, float, np.ndarray]]:
+    """Wait for a frame newer than the last one taken, None once the source has ended."""
+    with self.condition:
+      while self.latest is None and not self.finished:
+        self.condition.wait(0.1)
+      if self.error is not None:
+        raise self.error
+      latest, self.latest = self.latest, None
+      return latest
+
+  def prepare_frame(self, frame: np.ndarray) -> torch.Tensor:
+    with profiler.stage("resize"):
+      frame = cv2.resize(frame, self.target_resolution, interpolation=cv2.INTER_LINEAR)
+
+    if self.transform:
+      with profiler.stage("normalize"):
+        frame = self.transform(frame)
+
+    return frame
+
+  def frames(self, target_fps: Optional[float] = None) -> Iterator[Tuple[int, float, torch.Tensor]]:
+    """Yield (frame number, seconds since start, frame) for the latest frame, at most target_fps times a second."""
+    self.start()
+    frame_time = 1 / target_fps if target_fps else 0.0
+    try:
+      while True:
+        latest = self.take()
+        if latest is None:
+          return
+        taken = time.perf_counter()
+        frame_number, timestamp, frame = latest
+        yield frame_number, timestamp, self.prepare_frame(frame)
+        # Frames that arrive while waiting for the next slot replace each other and are dropped
+        time.sleep(max(taken + frame_time - time.perf_counter(), 0))
+    finally:
+      self.close()
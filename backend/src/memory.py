@@ -0,0 +1,17 @@
+import os
+import resource
+import sys
+
+def get_current_rss() -> int:
+  """Resident set size of this process in bytes."""
+  try:
+    with open("/proc/self/statm") as statm:
+      return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+  except (OSError, ValueError):
+    return get_peak_rss()
+
+def get_peak_rss() -> int:
+  """Peak resident set size of this process in bytes."""
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # Linux reports kilobytes, macOS bytes
+  return peak if sys.platform == "darwin" else peak * 1024
@@ -1,30 +1,122 @@
 import torch
-import sys
 import os
+import json
+import functools
 import importlib.util
+from types import ModuleType
+from typing import Optional, Tuple, Iterable
+
+from src.device import resolve_device
+from src.inference_cache import hash_file_cached
+from src.precision import apply_precision
 
 model_wrapper_abs_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 model_py_path = os.path.join(model_wrapper_abs_path, 'CrowdCounting-SASNet', 'model.py')
 
-if not os.path.isfile(model_py_path):
+@functools.lru_cache(maxsize=None)
+def load_sasnet_module() -> ModuleType:
+  """Import CrowdCounting-SASNet/model.py. Only needed to build SASNet from source, not to load an exported model."""
+  if not os.path.isfile(model_py_path):
     raise ImportError("The specified path for model.py does not exist: {}".format(model_py_path))
 
-spec = importlib.util.spec_from_file_location("model", model_py_path)
-model = importlib.util.module_from_spec(spec)
+  spec = importlib.util.spec_from_file_location("model", model_py_path)
+  model = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(model)
+  return model
+
+def export_torchscript(
+  model: torch.nn.Module,
+  path: str,
+  input_shape: Tuple[int, int, int] = (3, 1080, 1920),
+  channels_last: bool = True,
+  weights_hash: Optional[str] = None
+) -> None:
+  """Trace and freeze model at input_shape and save it as a single TorchScript file.
+
+  The traced module is checked against the model on a batch of two frames, so a model whose forward pass
+  depends on the batch size is not exported silently wrong. weights_hash, the hash_file of the weights the
+  model was built from, is stored with it so that Model can tell whether the export is stale.
+  """
+  memory_format = torch.channels_last if channels_last else torch.contiguous_format
+  device = next(model.parameters()).device
+  example = torch.rand(2, *input_shape).to(device, memory_format=memory_format)
+
+  model.eval()
+  with torch.no_grad():
+    traced = torch.jit.freeze(torch.jit.trace(model, example[:1]))
+    expected = model(example)
+    actual = traced(example)
+  error = ((actual - expected).abs().max() / expected.abs().max().clamp_min(1e-12)).item()
+  if error > 1e-4:
+    raise ValueError(f"The traced model differs from the original by {error:.2e} on a batch of two frames.")
 
-spec.loader.exec_module(model)
+  metadata = {"input_shape": list(input_shape), "channels_last": channels_last, "weights_hash": weights_hash}
+  torch.jit.save(traced, path, _extra_files={"metadata.json": json.dumps(metadata)})
 
 class Model:
-  def __init__(self, model_path: str, use_pretrained: bool, block_size: int) -> None:
+  def __init__(
+    self,
+    model_path: str,
+    use_pretrained: bool,
+    block_size: int,
+    device: str = "auto",
+    num_threads: Optional[int] = None,
+    channels_last: bool = True,
+    artifact_path: Optional[str] = None,
+    precision: str = "fp32",
+    calibration_frames: Optional[Iterable[torch.Tensor]] = None
+  ) -> None:
     self.block_size: int = block_size
+    self.device: torch.device = resolve_device(device)
+    # (channels, height, width) the exported model was traced at, None for a model built from source
+    self.input_shape: Optional[Tuple[int, int, int]] = None
+    # Hash of the weights of the loaded model, which keys the inference cache and the checkpoints
+    self.weights_hash: Optional[str] = None
+
+    if num_threads:
+      torch.set_num_threads(num_threads)
+
+    # Quantization traces the blocks of the eager model with torch.fx, which a TorchScript module cannot be
+    self.model: Optional[torch.nn.Module] = None
+    if artifact_path and os.path.isfile(artifact_path) and precision != "int8":
+      # An exported model needs neither the SASNet source nor torchvision
+      extra_files = {"metadata.json": ""}
+      artifact = torch.jit.load(artifact_path, map_location=self.device, _extra_files=extra_files)
+      metadata = json.loads(extra_files["metadata.json"] or "{}")
+      # An export is only used while it was made from the weights at model_path, or when they are not deployed
+      if model_path and os.path.isfile(model_path) and metadata.get("weights_hash") != hash_file_cached(model_path):
+        print(f"{artifact_path} was not exported from {model_path}, building the model from the weights instead. "
+              f"Export it again with export_model.py to load it.")
+      else:
+        self.model = artifact
+        if "input_shape" in metadata:
+          self.input_shape = tuple(metadata["input_shape"])
+        # An export that does not record its weights is keyed on its own contents
+        self.weights_hash = metadata.get("weights_hash") or hash_file_cached(artifact_path)
+
+    if self.model is None:
+      self.model = self.build_model(model_path, use_pretrained, channels_last)
+      self.weights_hash = hash_file_cached(model_path)
+    self.model.eval()
+    # "fp32", "bf16" autocast or "int8" static quantization of the backbone, see src/precision.py
+    self.precision: str = precision
+    self.model = apply_precision(self.model, precision, self.device, calibration_frames, channels_last)
+
+  def build_model(self, model_path: str, use_pretrained: bool, channels_last: bool) -> torch.nn.Module:
+    """Build SASNet from source with the weights of model_path."""
     class ArgsWrapper:
         block_size: int = self.block_size
 
     args: ArgsWrapper = ArgsWrapper()
 
-    self.model: torch.nn.Module = model.SASNet(use_pretrained, args).cuda()
-    self.model.load_state_dict(torch.load(model_path))
+    # The weights of model_path replace the whole network, so the ImageNet backbone is never downloaded
+    model = load_sasnet_module().SASNet(use_pretrained and not model_path, args)
+    model.load_state_dict(torch.load(model_path, map_location=self.device))
+    model.to(self.device)
+    if channels_last:
+      model.to(memory_format=torch.channels_last)
+    return model
 
   def get_model(self) -> torch.nn.Module:
-    return self.model
\ No newline at end of file
+    return self.model
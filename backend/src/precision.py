@@ -0,0 +1,113 @@
+from typing import Iterable, Iterator, List, Optional
+import torch
+import torch.nn
+
+from src.frame_transform import FrameTransform, IMAGENET_MEAN, IMAGENET_STD
+from src.video_frame_dataset import VideoFrameDataset
+
+PRECISIONS = ("fp32", "bf16", "int8")
+
+class AutocastModel(torch.nn.Module):
+  """Runs the model under bfloat16 autocast and returns float32 density maps.
+
+  Convolutions and matrix products run in bfloat16, which recent x86 CPUs (AVX512-BF16, AMX) and CUDA
+  devices execute natively; reductions and the output stay in float32.
+  """
+
+  def __init__(self, model: torch.nn.Module, device_type: str) -> None:
+    super().__init__()
+    self.model: torch.nn.Module = model
+    self.device_type: str = device_type
+
+  def forward(self, img: torch.Tensor) -> torch.Tensor:
+    with torch.autocast(self.device_type, dtype=torch.bfloat16):
+      return self.model(img).float()
+
+def get_quantization_engine() -> str:
+  supported = torch.backends.quantized.supported_engines
+  for engine in ("x86", "fbgemm", "qnnpack"):
+    if engine in supported:
+      return engine
+  raise RuntimeError("This PyTorch build has no quantized CPU engine.")
+
+def get_calibration_frames(video_path: str, frame_count: int, target_resolution=(1920, 1080)) -> Iterator[torch.Tensor]:
+  """Yield frame_count frames spread evenly over the video, one (1, 3, height, width) batch at a time."""
+  transform = FrameTransform(mean=IMAGENET_MEAN, std=IMAGENET_STD)
+  dataset = VideoFrameDataset(video_path, transform=transform, target_resolution=target_resolution)
+  frame_interval = max(dataset.total_frames // frame_count, 1)
+  dataset = VideoFrameDataset(video_path, transform=transform, frame_interval=frame_interval,
+                              target_resolution=target_resolution)
+  for idx in range(min(frame_count, len(dataset))):
+    yield dataset[idx][1][None]
+
+def quantize_backbone(
+  model: torch.nn.Module,
+  calibration_frames: Iterable[torch.Tensor],
+  backbone_prefix: str = "features",
+  channels_last: bool = True
+) -> torch.nn.Module:
+  """Statically quantize the model's backbone to int8, in place, with activation ranges from calibration_frames.
+
+  Every child module whose name starts with backbone_prefix (SASNet's VGG-16 stages features1 to features5)
+  is traced with torch.fx, its convolutions, batch norms and ReLUs are fused and quantized to int8, and its
+  activations are observed on the calibration frames. The blocks take and return float tensors, so the
+  decoder and the confidence branches stay in float32. Runs on the CPU only.
+  """
+  from torch.ao.quantization import get_default_qconfig_mapping
+  from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+  names: List[str] = [name for name, _ in model.named_children() if name.startswith(backbone_prefix)]
+  if not names:
+    raise ValueError(f"The model has no modules starting with '{backbone_prefix}' to quantize.")
+
+  engine = get_quantization_engine()
+  torch.backends.quantized.engine = engine
+  qconfig_mapping = get_default_qconfig_mapping(engine)
+  memory_format = torch.channels_last if channels_last else torch.contiguous_format
+  model.eval()
+
+  frames = iter(calibration_frames)
+  first_frame: Optional[torch.Tensor] = next(frames, None)
+  if first_frame is None:
+    raise ValueError("Quantization needs at least one calibration frame.")
+  first_frame = first_frame.contiguous(memory_format=memory_format)
+
+  # Record the input of every block, prepare_fx needs an example of it
+  example_inputs = {}
+  hooks = [getattr(model, name).register_forward_pre_hook(
+             lambda module, inputs, name=name: example_inputs.setdefault(name, inputs)) for name in names]
+  with torch.no_grad():
+    model(first_frame)
+  for hook in hooks:
+    hook.remove()
+
+  for name in names:
+    setattr(model, name, prepare_fx(getattr(model, name), qconfig_mapping, example_inputs[name]))
+
+  with torch.no_grad():
+    model(first_frame)
+    for frame in frames:
+      model(frame.contiguous(memory_format=memory_format))
+
+  for name in names:
+    setattr(model, name, convert_fx(getattr(model, name)))
+  return model
+
+def apply_precision(
+  model: torch.nn.Module,
+  precision: str,
+  device: torch.device,
+  calibration_frames: Optional[Iterable[torch.Tensor]] = None,
+  channels_last: bool = True
+) -> torch.nn.Module:
+  if precision == "fp32":
+    return model
+  if precision == "bf16":
+    return AutocastModel(model, device.type)
+  if precision == "int8":
+    if device.type != "cpu":
+      raise ValueError("int8 inference is only supported on the CPU.")
+    if calibration_frames is None:
+      raise ValueError("int8 inference needs calibration frames.")
+    return quantize_backbone(model, calibration_frames, channels_last=channels_last)
+  raise ValueError(f"Unknown precision: {precision}, expected one of {PRECISIONS}")
@@ -0,0 +1,159 @@
+from typing import Dict, List, Optional, Tuple, Callable, Iterator, Any
+from array import array
+from contextlib import contextmanager
+import functools
+import json
+import os
+import threading
+import time
+import numpy as np
+import torch
+
+from src.memory import get_current_rss, get_peak_rss
+
+class Profiler:
+  """Per-stage timers, counters and memory samples for a run, cheap enough to leave on.
+
+  A stage costs two perf_counter calls and one append under a lock; durations are kept as packed doubles so
+  that a long run stays small. Chrome trace events are only kept when trace is enabled. Memory is sampled
+  from a background thread every memory_interval seconds.
+
+  Stages run in DataLoader worker processes are recorded in the worker's copy of the profiler and are lost;
+  the time the main process waits for those batches is recorded as dataloader_wait.
+  """
+
+  def __init__(self, enabled: bool = True, trace: bool = False, memory_interval: float = 0.5) -> None:
+    self.enabled: bool = enabled
+    self.trace: bool = trace
+    self.memory_interval: float = memory_interval
+    self.lock: threading.Lock = threading.Lock()
+    self.durations: Dict[str, array] = {}
+    self.counters: Dict[str, int] = {}
+    # (stage, start, duration, thread id) for the Chrome trace
+    self.events: List[Tuple[str, float, float, int]] = []
+    # (time, resident set size, allocated CUDA memory) in bytes
+    self.memory_samples: List[Tuple[float, int, int]] = []
+    self.start_time: float = time.perf_counter()
+    self.stop: threading.Event = threading.Event()
+    self.sampler: Optional[threading.Thread] = None
+
+  def configure(self, enabled: bool = True, trace: bool = False, memory_interval: float = 0.5) -> None:
+    self.enabled = enabled
+    self.trace = trace
+    self.memory_interval = memory_interval
+
+  def record(self, stage: str, start: float, duration: float) -> None:
+    with self.lock:
+      if stage not in self.durations:
+        self.durations[stage] = array("d")
+      self.durations[stage].append(duration)
+      if self.trace:
+        self.events.append((stage, start, duration, threading.get_ident()))
+
+  @contextmanager
+  def stage(self, stage: str) -> Iterator[None]:
+    if not self.enabled:
+      yield
+      return
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.record(stage, start, time.perf_counter() - start)
+
+  def timed(self, stage: str) -> Callable:
+    """Decorator recording every call of the function as stage."""
+    def decorator(function: Callable) -> Callable:
+      @functools.wraps(function)
+      def wrapper(*args: Any, **kwargs: Any) -> Any:
+        with self.stage(stage):
+          return function(*args, **kwargs)
+      return wrapper
+    return decorator
+
+  def count(self, counter: str, amount: int = 1) -> None:
+    if self.enabled:
+      with self.lock:
+        self.counters[counter] = self.counters.get(counter, 0) + amount
+
+  def sample_memory(self) -> None:
+    cuda_memory = torch.cuda.memory_allocated() if torch.cuda.is_available() else 0
+    with self.lock:
+      self.memory_samples.append((time.perf_counter(), get_current_rss(), cuda_memory))
+
+  def sample_memory_until_stopped(self) -> None:
+    while not self.stop.wait(self.memory_interval):
+      self.sample_memory()
+
+  def start(self) -> None:
+    """Start a run: clear what was recorded so far and start sampling memory."""
+    with self.lock:
+      self.durations = {}
+      self.counters = {}
+      self.events = []
+      self.memory_samples = []
+      self.start_time = time.perf_counter()
+    if self.enabled and self.sampler is None:
+      self.stop.clear()
+      self.sampler = threading.Thread(target=self.sample_memory_until_stopped, daemon=True)
+      self.sampler.start()
+
+  def finish(self) -> None:
+    if self.sampler is not None:
+      self.stop.set()
+      self.sampler.join()
+      self.sampler = None
+    if self.enabled:
+      self.sample_memory()
+
+  def summary(self) -> Dict[str, Any]:
+    """Per stage call count, total seconds and p50/p95/p99 in milliseconds; frames/sec and peak memory."""
+    wall_time = time.perf_counter() - self.start_time
+    with self.lock:
+      stages = {}
+      for stage, durations in self.durations.items():
+        milliseconds = np.frombuffer(durations, dtype=np.float64) * 1000
+        p50, p95, p99 = np.percentile(milliseconds, [50, 95, 99])
+        stages[stage] = {
+          "calls": len(milliseconds),
+          "total_s": round(float(milliseconds.sum()) / 1000, 4),
+          "p50_ms": round(float(p50), 3),
+          "p95_ms": round(float(p95), 3),
+          "p99_ms": round(float(p99), 3),
+        }
+      counters = dict(self.counters)
+      peak_cuda = max((sample[2] for sample in self.memory_samples), default=0)
+
+    if torch.cuda.is_available():
+      peak_cuda = max(peak_cuda, torch.cuda.max_memory_allocated())
+    return {
+      "wall_time_s": round(wall_time, 3),
+      "frames": counters.get("frames", 0),
+      "frames_per_sec": round(counters.get("frames", 0) / wall_time, 3) if wall_time > 0 else 0.0,
+      "peak_rss_mb": round(get_peak_rss() / 1024 ** 2, 1),
+      "peak_cuda_mb": round(peak_cuda / 1024 ** 2, 1),
+      "stages": dict(sorted(stages.items(), key=lambda item: -item[1]["total_s"])),
+      "counters": counters,
+    }
+
+  def write_summary(self, path: str) -> None:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as summary_file:
+      json.dump(self.summary(), summary_file, indent=2)
+
+  def write_trace(self, path: str) -> None:
+    """Write the stages and memory samples in the Chrome trace event format, for chrome://tracing or Perfetto."""
+    pid = os.getpid()
+    with self.lock:
+      trace_events = [{"name": stage, "ph": "X", "pid": pid, "tid": thread_id,
+                       "ts": (start - self.start_time) * 1e6, "dur": duration * 1e6}
+                      for stage, start, duration, thread_id in self.events]
+      trace_events += [{"name": "memory", "ph": "C", "pid": pid, "ts": (sample_time - self.start_time) * 1e6,
+                        "args": {"rss_mb": rss / 1024 ** 2, "cuda_mb": cuda_memory / 1024 ** 2}}
+                       for sample_time, rss, cuda_memory in self.memory_samples]
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as trace_file:
+      json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, trace_file)
+
+# Shared by the whole pipeline; main configures it and writes the summary at the end of the run
+profiler = Profiler()
@@ -0,0 +1,133 @@
+from torch.utils.data import IterableDataset, get_worker_info
+from typing import Optional, Tuple, Callable, Iterator, List
+import torch
+import cv2
+
+from src.profiler import profiler
+
+class SequentialVideoFrameDataset(IterableDataset):
+  """Samples frames by decoding the video once from start to end instead of seeking to every sample.
+
+  Frames between samples are skipped with grab(), which skips the colour conversion and copy, and only the
+  sampled frames are retrieve()d. Frames are sampled every frame_interval frames, or every time_interval
+  seconds when it is given.
+
+  grab() still has to decode the compressed frame, so when the gap to the next sample is much longer than
+  the video's keyframe interval a seek is cheaper. Gaps longer than seek_threshold frames are seeked over.
+
+  With several DataLoader workers the sampled frames are split into contiguous shards of shard_size frames
+  (one shard per worker by default) that are dealt out to the workers, so every worker opens its own capture
+  and decodes its shards sequentially. Each sample is a (frame_index, frame) pair; the DataLoader yields the
+  workers' batches interleaved, so consumers restore the order from the frame indices.
+  """
+
+  def __init__(
+    self,
+    video_path: str,
+    transform: Optional[Callable] = None,
+    frame_interval: int = 300,
+    target_resolution: Tuple[int, int] = (1920, 1080),
+    time_interval: Optional[float] = None,
+    seek_threshold: Optional[int] = None,
+    shard_size: Optional[int] = None
+  ) -> None:
+    self.video_path: str = video_path
+    self.transform: Optional[Callable] = transform
+    self.frame_interval: int = frame_interval
+    self.target_resolution: Tuple[int, int] = target_resolution
+    self.time_interval: Optional[float] = time_interval
+    self.seek_threshold: Optional[int] = seek_threshold
+    self.shard_size: Optional[int] = shard_size
+    self.cap: Optional[cv2.VideoCapture] = None
+
+    cap = cv2.VideoCapture(video_path)
+    self.total_frames: int = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    self.fps: float = cap.get(cv2.CAP_PROP_FPS)
+    cap.release()
+
+    self.frame_indices: List[int] = self.get_frame_indices()
+
+  def get_frame_indices(self) -> List[int]:
+    if self.time_interval is None:
+      return [idx * self.frame_interval for idx in range(self.total_frames // self.frame_interval)]
+
+    if self.fps <= 0:
+      raise ValueError("Cannot sample by time: the video does not report a frame rate.")
+
+    frame_indices: List[int] = []
+    sample = 0
+    frame_index = 0
+    while frame_index < self.total_frames:
+      if not frame_indices or frame_index != frame_indices[-1]:
+        frame_indices.append(frame_index)
+      sample += 1
+      frame_index = int(round(sample * self.time_interval * self.fps))
+    return frame_indices
+
+  def open(self) -> None:
+    if self.cap is None:
+      self.cap = cv2.VideoCapture(self.video_path)
+
+  def __len__(self) -> int:
+    return len(self.frame_indices)
+
+  def prepare_frame(self, frame) -> torch.Tensor:
+    with profiler.stage("resize"):
+      frame = cv2.resize(frame, self.target_resolution, interpolation=cv2.INTER_LINEAR)
+
+    if self.transform:
+      with profiler.stage("normalize"):
+        frame = self.transform(frame)
+
+    return frame
+
+  def get_shards(self, worker_id: int, num_workers: int) -> List[List[int]]:
+    shard_size = self.shard_size or max(-(-len(self.frame_indices) // num_workers), 1)
+    shards = [self.frame_indices[start:start + shard_size] for start in range(0, len(self.frame_indices), shard_size)]
+    return shards[worker_id::num_workers]
+
+  def read_frames(self, shards: List[List[int]]) -> Iterator[Tuple[int, torch.Tensor]]:
+    """Yield the frames at the given sorted indices, decoding each shard sequentially from its first frame."""
+    self.open()
+    cap = self.cap
+    try:
+      frame_index = -1
+      for shard in shards:
+        for target_index in shard:
+          gap = target_index - frame_index
+          if self.seek_threshold is not None:
+            seek = gap > self.seek_threshold
+          else:
+            # Without a seek threshold, only seek to the start of a shard
+            seek = gap > 1 and target_index == shard[0]
+
+          if seek:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, target_index)
+            frame_index = target_index - 1
+
+          with profiler.stage("decode"):
+            while frame_index < target_index:
+              if not cap.grab():
+                raise ValueError("Failed to read frame from the video.")
+              frame_index += 1
+
+            ret, frame = cap.retrieve()
+          if not ret:
+            raise ValueError("Failed to read frame from the video.")
+
+          yield target_index, self.prepare_frame(frame)
+    finally:
+      cap.release()
+      self.cap = None
+
+  def __iter__(self) -> Iterator[Tuple[int, torch.Tensor]]:
+    worker_info = get_worker_info()
+    if worker_info is None:
+      return self.read_frames([self.frame_indices])
+    return self.read_frames(self.get_shards(worker_info.id, worker_info.num_workers))
+
+  def __getstate__(self) -> dict:
+    # Worker processes open their own capture, see worker_init_fn
+    state = self.__dict__.copy()
+    state["cap"] = None
+    return state
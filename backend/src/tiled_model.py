@@ -0,0 +1,76 @@
+from typing import List, Tuple
+import torch
+import torch.nn
+
+class TiledModel(torch.nn.Module):
+  """Runs a density model on overlapping tiles of each frame and stitches the density maps back together.
+
+  Every tile's density map is weighted with a ramp that falls off across the overlap, and the stitched map
+  is divided by the summed weights. The weights therefore add up to one at every pixel, so overlapping
+  tiles are blended without counting any pixel twice. Tiles from all frames in a batch are pushed through
+  the model tiles_per_batch at a time, which bounds the activation memory by the tile size instead of the
+  frame size.
+
+  tile_size is (width, height) and should be a multiple of what the model downsamples by.
+  """
+
+  def __init__(self, model: torch.nn.Module, tile_size: Tuple[int, int], overlap: int, tiles_per_batch: int) -> None:
+    super().__init__()
+    self.model: torch.nn.Module = model
+    self.tile_size: Tuple[int, int] = tile_size
+    self.overlap: int = overlap
+    self.tiles_per_batch: int = tiles_per_batch
+
+  def get_tile_starts(self, length: int, tile_length: int) -> List[int]:
+    if length <= tile_length:
+      return [0]
+    stride = max(tile_length - self.overlap, 1)
+    starts = list(range(0, length - tile_length, stride))
+    return starts + [length - tile_length]
+
+  def get_ramp(self, start: int, tile_length: int, length: int, overlap: float, device: torch.device) -> torch.Tensor:
+    """Blend weights along one axis, ramping up and down across the overlap except at the frame edges."""
+    positions = torch.arange(tile_length, device=device, dtype=torch.float32) + 0.5
+    ramp = torch.ones(tile_length, device=device)
+    if overlap > 0:
+      if start > 0:
+        ramp = torch.minimum(ramp, positions / overlap)
+      if start + tile_length < length:
+        ramp = torch.minimum(ramp, (tile_length - positions) / overlap)
+    return ramp
+
+  def forward(self, img: torch.Tensor) -> torch.Tensor:
+    batch_size, _, height, width = img.shape
+    tile_width, tile_height = min(self.tile_size[0], width), min(self.tile_size[1], height)
+    tiles = [(y, x) for y in self.get_tile_starts(height, tile_height) for x in self.get_tile_starts(width, tile_width)]
+    # Tiles are ordered frame by frame, tile by tile
+    crops = [(i_img, y, x) for i_img in range(batch_size) for y, x in tiles]
+    channels_last = img.is_contiguous(memory_format=torch.channels_last)
+
+    stitched = None
+    weights = None
+    for chunk_start in range(0, len(crops), self.tiles_per_batch):
+      chunk = crops[chunk_start:chunk_start + self.tiles_per_batch]
+      tile_batch = torch.stack([img[i_img, :, y:y + tile_height, x:x + tile_width] for i_img, y, x in chunk])
+      if channels_last:
+        tile_batch = tile_batch.contiguous(memory_format=torch.channels_last)
+      pred_tiles = self.model(tile_batch)
+
+      # The density map may be smaller than the input; scale the tile positions to match
+      out_tile_height, out_tile_width = pred_tiles.shape[2:]
+      scale_y, scale_x = out_tile_height / tile_height, out_tile_width / tile_width
+      if stitched is None:
+        out_height, out_width = round(height * scale_y), round(width * scale_x)
+        stitched = torch.zeros(batch_size, pred_tiles.shape[1], out_height, out_width,
+                               device=pred_tiles.device, dtype=torch.float32)
+        weights = torch.zeros(out_height, out_width, device=pred_tiles.device)
+
+      for pred_tile, (i_img, y, x) in zip(pred_tiles, chunk):
+        out_y, out_x = round(y * scale_y), round(x * scale_x)
+        weight = (self.get_ramp(out_y, out_tile_height, out_height, self.overlap * scale_y, pred_tile.device)[:, None]
+                  * self.get_ramp(out_x, out_tile_width, out_width, self.overlap * scale_x, pred_tile.device)[None, :])
+        stitched[i_img, :, out_y:out_y + out_tile_height, out_x:out_x + out_tile_width] += pred_tile.float() * weight
+        if i_img == 0:
+          weights[out_y:out_y + out_tile_height, out_x:out_x + out_tile_width] += weight
+
+    return stitched / weights
@@ -1,8 +1,17 @@
-from torch.utils.data import Dataset
-from typing import Optional, Tuple, Callable
+from torch.utils.data import Dataset, get_worker_info
+from typing import Optional, Tuple, Callable, List
 import torch
 import cv2
 
+from src.profiler import profiler
+
+def worker_init_fn(worker_id: int) -> None:
+  """Give the worker its own video capture, capture handles cannot be shared between processes."""
+  worker_info = get_worker_info()
+  # A forked worker inherits the parent's capture if it was already opened, so always open a new one
+  worker_info.dataset.cap = None
+  worker_info.dataset.open()
+
 class VideoFrameDataset(Dataset):
   def __init__(
     self,
@@ -12,32 +21,52 @@ class VideoFrameDataset(Dataset):
     target_resolution: Tuple[int, int] = (1920, 1080)
   ) -> None:
     self.video_path: str = video_path
-    self.cap: cv2.VideoCapture = cv2.VideoCapture(video_path)
+    self.cap: Optional[cv2.VideoCapture] = None
     self.transform: Optional[Callable] = transform
     self.frame_interval: int = frame_interval
     self.target_resolution: Tuple[int, int] = target_resolution
-    self.total_frames: int = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+
+    cap = cv2.VideoCapture(video_path)
+    self.total_frames: int = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    self.fps: float = cap.get(cv2.CAP_PROP_FPS)
+    cap.release()
+
+    self.frame_indices: List[int] = [idx * self.frame_interval for idx in range(self.total_frames // self.frame_interval)]
+
+  def open(self) -> None:
+    if self.cap is None:
+      self.cap = cv2.VideoCapture(self.video_path)
 
   def __len__(self) -> int:
-    return self.total_frames // self.frame_interval
+    return len(self.frame_indices)
 
-  def __getitem__(self, idx: int) -> torch.Tensor:
-    frame_index: int = idx * self.frame_interval
-    self.cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
-    ret: bool
-    frame: np.ndarray
-    ret, frame = self.cap.read()
+  def __getitem__(self, idx: int) -> Tuple[int, torch.Tensor]:
+    self.open()
+    frame_index: int = self.frame_indices[idx]
+    with profiler.stage("decode"):
+      self.cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
+      ret: bool
+      frame: np.ndarray
+      ret, frame = self.cap.read()
 
     if not ret:
       raise ValueError("Failed to read frame from the video.")
 
-    frame = cv2.resize(frame, self.target_resolution, interpolation=cv2.INTER_LINEAR)
+    with profiler.stage("resize"):
+      frame = cv2.resize(frame, self.target_resolution, interpolation=cv2.INTER_LINEAR)
 
     if self.transform:
-      frame = self.transform(frame)
+      with profiler.stage("normalize"):
+        frame = self.transform(frame)
+
+    return frame_index, frame
 
-    return frame.float()
+  def __getstate__(self) -> dict:
+    # Worker processes open their own capture, see worker_init_fn
+    state = self.__dict__.copy()
+    state["cap"] = None
+    return state
 
   def __del__(self) -> None:
-    if self.cap.isOpened():
+    if self.cap is not None and self.cap.isOpened():
       self.cap.release()
@@ -0,0 +1,62 @@
+import threading
+import time
+from typing import Iterator, List, Tuple
+
+import pytest
+import torch
+
+from src.camera import Camera
+from src.camera_scheduler import CameraScheduler
+from src.camera_utils import CameraUtils
+from stub_model import StubDensityModel
+from synthetic_video import write_synthetic_video
+
+LOCAL_COORDINATES = [(797, 293), (287, 653), (1761, 1040), (1734, 411)]
+GLOBAL_COORDINATES = [(0, 0), (0, 80), (100, 80), (100, 0)]
+
+
+class SlowCamera(Camera):
+  """A camera whose decoding takes decode_delay seconds per batch."""
+
+  def __init__(self, *args, decode_delay: float = 0.0, **kwargs) -> None:
+    super().__init__(*args, **kwargs)
+    self.decode_delay: float = decode_delay
+
+  def read_batches(self, dataloader) -> Iterator[Tuple[List[int], torch.Tensor]]:
+    for batch in super().read_batches(dataloader):
+      time.sleep(self.decode_delay)
+      yield batch
+
+
+@pytest.fixture(scope="module")
+def video_path(tmp_path_factory) -> str:
+  return write_synthetic_video(str(tmp_path_factory.mktemp("video") / "clip.mp4"), 100, (320, 180))
+
+
+def make_cameras(video_path: str, directory: str, model: torch.nn.Module, decode_delays: List[float]) -> List[Camera]:
+  camera_utils = CameraUtils(50, directory + "/", 1, None)
+  return [SlowCamera(video_path, LOCAL_COORDINATES, GLOBAL_COORDINATES, model, 5, 2, 1000, camera_utils,
+                     device="cpu", decode_delay=decode_delay)
+          for decode_delay in decode_delays]
+
+
+def run_frames(scheduler: CameraScheduler, timeout: float) -> List[List]:
+  frames = []
+  thread = threading.Thread(target=lambda: frames.extend(scheduler.frames()), daemon=True)
+  thread.start()
+  thread.join(timeout)
+  assert not thread.is_alive(), "the scheduler did not finish"
+  return frames
+
+
+def test_cameras_decoding_at_different_speeds_do_not_deadlock(video_path, tmp_path):
+  model = StubDensityModel().eval()
+  cameras = make_cameras(video_path, str(tmp_path), model, [0.0, 0.3])
+  frames = run_frames(CameraScheduler(cameras, max_in_flight_frames=2, batch_size=2), timeout=30)
+
+  alone = [list(camera.predict_frames()) for camera in make_cameras(video_path, str(tmp_path), model, [0.0, 0.0])]
+  assert len(frames) == len(alone[0])
+  for camera_index, results in enumerate(alone):
+    scheduled = [frame[camera_index] for frame in frames]
+    assert [result.frame_index for result in scheduled] == [result.frame_index for result in results]
+    assert [result.count for result in scheduled] == pytest.approx([result.count for result in results], rel=1e-5)
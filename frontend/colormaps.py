@@ -1,4 +1,6 @@
+import functools
 import cv2
+import numpy as np
 
 colormaps = {
     "Autumn": cv2.COLORMAP_AUTUMN,
@@ -13,4 +15,9 @@ colormaps = {
     "HSV": cv2.COLORMAP_HSV,
     "Pink": cv2.COLORMAP_PINK,
     "Hot": cv2.COLORMAP_HOT
-}
\ No newline at end of file
+}
+
+@functools.lru_cache(maxsize=None)
+def get_colormap_lut(name):
+    """The 256 colours of a colormap as a (256, 1, 3) table, which cv2.applyColorMap takes instead of the colormap."""
+    return cv2.applyColorMap(np.arange(256, dtype=np.uint8).reshape(256, 1), colormaps[name])
\ No newline at end of file
@@ -0,0 +1,67 @@
+from collections import OrderedDict, namedtuple
+import cv2
+import numpy as np
+
+# A polygon rasterized inside its bounding box: the box's top-left corner and size, the single-channel 0/1 mask,
+# its pixel count, and the runs of set pixels of every mask row in frame coordinates
+Region = namedtuple("Region", ["x0", "y0", "width", "height", "mask", "area", "rows", "starts", "ends"])
+
+
+class RegionCounter:
+    """Sums of the pixels inside polygons, for one frame or a whole video at once.
+
+    Polygons are given in coordinates relative to the frame, as the overlay stores them. Each one is
+    rasterized once with cv2.fillPoly into a mask that only covers its bounding box, and the mask and its
+    row runs are cached by the polygon's coordinates. Sums are looked up in summed-area tables, see
+    StatisticsIndex, so they cost the number of mask rows rather than the number of mask pixels.
+    """
+
+    def __init__(self, frame_shape, cache_size=32):
+        self.frame_shape = frame_shape
+        self.cache_size = cache_size
+        self.regions = OrderedDict()
+
+    def get_region(self, relative_positions):
+        key = tuple(relative_positions)
+        if key in self.regions:
+            self.regions.move_to_end(key)
+            return self.regions[key]
+
+        height, width = self.frame_shape
+        polygon = np.array([(int(x * width), int(y * height)) for x, y in relative_positions], np.int32)
+        # fillPoly also sets the pixels on the polygon's right and bottom edges
+        x0, y0 = np.clip(polygon.min(axis=0), 0, (width, height))
+        x1, y1 = np.clip(polygon.max(axis=0) + 1, 0, (width, height))
+        mask = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+        cv2.fillPoly(mask, [polygon - (x0, y0)], 1)
+
+        padded = np.zeros((mask.shape[0], mask.shape[1] + 2), dtype=np.int8)
+        padded[:, 1:-1] = mask
+        edges = np.diff(padded, axis=1)
+        rows, starts = np.nonzero(edges == 1)
+        _, ends = np.nonzero(edges == -1)
+
+        region = Region(int(x0), int(y0), int(x1 - x0), int(y1 - y0), mask, int(np.count_nonzero(mask)),
+                        rows + y0, starts + x0, ends + x0)
+        self.regions[key] = region
+        if len(self.regions) > self.cache_size:
+            self.regions.popitem(last=False)
+        return region
+
+    def sum_tables(self, tables, polygons):
+        """Sums inside every polygon from (frames, height + 1, width + 1) summed-area tables, as (frames, polygons).
+
+        Each row run of a mask is the difference of four table entries, so the runs of all polygons are
+        gathered from all frames at once and added up per polygon with one product.
+        """
+        regions = [self.get_region(polygon) for polygon in polygons]
+        rows = np.concatenate([region.rows for region in regions])
+        starts = np.concatenate([region.starts for region in regions])
+        ends = np.concatenate([region.ends for region in regions])
+        # Which polygon every run belongs to
+        owners = np.zeros((len(rows), len(regions)), dtype=np.int64)
+        owners[np.arange(len(rows)), np.repeat(np.arange(len(regions)), [len(region.rows) for region in regions])] = 1
+
+        runs = (tables[:, rows + 1, ends].astype(np.int64) - tables[:, rows, ends]
+                - tables[:, rows + 1, starts] + tables[:, rows, starts])
+        return runs @ owners
@@ -0,0 +1,117 @@
+import os
+import cv2
+import numpy as np
+from region_counter import RegionCounter
+
+
+class StatisticsIndex:
+    """Per-frame totals and summed-area tables of a heatmap video, so region sums need no decoding.
+
+    Every pixel holds its three channels added up, as update_info sums them. The summed-area table of a frame
+    has one more row and column than the frame; entry (y, x) is the sum of all pixels above and left of it,
+    so the sum of any rectangle is four lookups. The index is saved next to the video and reused while the
+    video's size and modification time are unchanged.
+    """
+
+    def __init__(self, video_path, timestamps, totals, tables, source_stat):
+        self.video_path = video_path
+        # Milliseconds since the start of the video of every frame. CAP_PROP_POS_MSEC is computed in floating point,
+        # e.g. 1199.9999999 for 1200, which would map a position on a frame's timestamp to the frame before
+        self.timestamps = np.round(timestamps, 3)
+        self.totals = totals
+        self.tables = tables
+        self.source_stat = source_stat
+        self.region_counter = RegionCounter(self.frame_shape)
+
+    @staticmethod
+    def get_index_path(video_path):
+        return video_path + ".stats.npz"
+
+    @staticmethod
+    def get_source_stat(video_path):
+        stat = os.stat(video_path)
+        return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+    @classmethod
+    def load(cls, video_path):
+        """The saved index of video_path, None when there is none or the video changed since it was saved."""
+        index_path = cls.get_index_path(video_path)
+        if not os.path.isfile(index_path):
+            return None
+        with np.load(index_path) as data:
+            source_stat = cls.get_source_stat(video_path)
+            if not np.array_equal(data["source_stat"], source_stat):
+                return None
+            return cls(video_path, data["timestamps"], data["totals"], data["tables"], source_stat)
+
+    @classmethod
+    def load_or_build(cls, video_path):
+        index = cls.load(video_path)
+        if index is None:
+            index = cls.build(video_path)
+            index.save()
+        return index
+
+    @classmethod
+    def build(cls, video_path):
+        cap = cv2.VideoCapture(video_path)
+        timestamps = []
+        tables = []
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            # After a read, the position is the timestamp of the frame that was read
+            timestamps.append(cap.get(cv2.CAP_PROP_POS_MSEC))
+            tables.append(cls.summed_area_table(frame))
+        cap.release()
+        return cls.from_tables(video_path, timestamps, tables)
+
+    @classmethod
+    def from_tables(cls, video_path, timestamps, tables):
+        """Index of the frames of video_path with the given timestamps and summed-area tables, in order."""
+        if not tables:
+            raise ValueError(f"Unable to read any frame of {video_path}")
+
+        tables = np.stack(tables)
+        return cls(video_path, np.array(timestamps), tables[:, -1, -1].copy(), tables, cls.get_source_stat(video_path))
+
+    @staticmethod
+    def summed_area_table(frame):
+        pixels = frame.sum(axis=2, dtype=np.int64)
+        # Exact in 32 bits up to 2.8 million pixels of three 8-bit channels
+        dtype = np.int32 if pixels.size * 765 < 2 ** 31 else np.int64
+        table = np.zeros((pixels.shape[0] + 1, pixels.shape[1] + 1), dtype=dtype)
+        np.cumsum(np.cumsum(pixels, axis=0), axis=1, out=table[1:, 1:])
+        return table
+
+    def save(self):
+        try:
+            np.savez(self.get_index_path(self.video_path), timestamps=self.timestamps, totals=self.totals,
+                     tables=self.tables, source_stat=self.source_stat)
+        except OSError as error:
+            print(f"Unable to save the statistics index: {error}")
+
+    @property
+    def frame_shape(self):
+        return self.tables.shape[1] - 1, self.tables.shape[2] - 1
+
+    def get_frame_index(self, time_in_ms):
+        """The last frame shown at time_in_ms."""
+        frame_index = np.searchsorted(self.timestamps, time_in_ms, side="right") - 1
+        return int(np.clip(frame_index, 0, len(self.timestamps) - 1))
+
+    def total(self, frame_index):
+        return int(self.totals[frame_index])
+
+    def rectangle_sum(self, frame_index, x0, y0, x1, y1):
+        """Sum of the pixels in rows y0 to y1 and columns x0 to x1, excluding y1 and x1."""
+        table = self.tables[frame_index]
+        return int(table[y1, x1]) - int(table[y0, x1]) - int(table[y1, x0]) + int(table[y0, x0])
+
+    def region_sums(self, polygons):
+        """Sums inside every polygon of relative coordinates for every frame, as a (frames, polygons) array."""
+        return self.region_counter.sum_tables(self.tables, polygons)
+
+    def region_area(self, polygon):
+        return self.region_counter.get_region(polygon).area
@@ -0,0 +1,65 @@
+import cv2
+import numpy as np
+import pytest
+from region_counter import RegionCounter
+from statistics_index import StatisticsIndex
+
+HEIGHT = 48
+WIDTH = 64
+
+
+def full_frame_sum(frame, relative_positions):
+    """Sum and area of a polygon as update_info computed them, with a full-frame mask."""
+    height, width = frame.shape[:2]
+    polygon = np.array([(int(x * width), int(y * height)) for x, y in relative_positions], np.int32)
+    mask = np.zeros(frame.shape, dtype=np.uint8)
+    cv2.fillPoly(mask, [polygon], (255, 255, 255))
+    return int(cv2.bitwise_and(frame, mask).sum()), int(np.count_nonzero(mask[:, :, 0]))
+
+
+@pytest.fixture
+def frames():
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 256, (5, HEIGHT, WIDTH, 3), dtype=np.uint8)
+
+
+@pytest.fixture
+def tables(frames):
+    return np.stack([StatisticsIndex.summed_area_table(frame) for frame in frames])
+
+
+def random_polygons(count):
+    rng = np.random.default_rng(1)
+    polygons = []
+    for _ in range(count):
+        vertex_count = rng.integers(3, 8)
+        # Partly outside the frame, and on its right and bottom edges
+        positions = np.round(rng.uniform(-0.2, 1.2, (vertex_count, 2)), 2)
+        polygons.append(tuple((float(x), float(y)) for x, y in positions))
+    return polygons
+
+
+EDGE_POLYGONS = [
+    ((0.5, 0.5), (1.0, 0.5), (1.0, 1.0), (0.5, 1.0)),
+    ((0.0, 0.0), (1.0, 0.0), (1.0, 1.0), (0.0, 1.0)),
+    ((0.2, 0.3), (0.21, 0.3), (0.21, 0.31)),
+]
+
+
+@pytest.mark.parametrize("polygon", random_polygons(200) + EDGE_POLYGONS)
+def test_matches_full_frame_masks(frames, tables, polygon):
+    counter = RegionCounter((HEIGHT, WIDTH))
+    sums = counter.sum_tables(tables, [polygon])
+    for frame, frame_sums in zip(frames, sums):
+        assert (int(frame_sums[0]), counter.get_region(polygon).area) == full_frame_sum(frame, polygon)
+
+
+def test_several_polygons_at_once(frames, tables):
+    polygons = random_polygons(20) + EDGE_POLYGONS
+    # A small cache evicts regions while they are gathered
+    counter = RegionCounter((HEIGHT, WIDTH), cache_size=4)
+    sums = counter.sum_tables(tables, polygons)
+    assert sums.shape == (len(frames), len(polygons))
+    for frame, frame_sums in zip(frames, sums):
+        assert [int(frame_sum) for frame_sum in frame_sums] == [full_frame_sum(frame, polygon)[0]
+                                                                for polygon in polygons]
@@ -0,0 +1,34 @@
+import cv2
+import numpy as np
+import pytest
+from statistics_index import StatisticsIndex
+
+FPS = 10
+FRAME_COUNT = 40
+
+
+@pytest.fixture
+def video_path(tmp_path):
+    path = str(tmp_path / "heatmap.avi")
+    out = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"XVID"), FPS, (64, 48))
+    for i in range(FRAME_COUNT):
+        out.write(np.full((48, 64, 3), i * 5, dtype=np.uint8))
+    out.release()
+    return path
+
+
+def test_frame_index_of_exact_frame_times(video_path):
+    index = StatisticsIndex.load_or_build(video_path)
+    assert len(index.timestamps) == FRAME_COUNT
+    for i in range(FRAME_COUNT):
+        assert index.get_frame_index(index.timestamps[i]) == i
+        # The player reports positions in whole milliseconds
+        assert index.get_frame_index(i * 1000 // FPS) == i
+        assert index.get_frame_index(i * 1000 // FPS + 50) == i
+
+
+def test_saved_index_is_reused(video_path):
+    built = StatisticsIndex.load_or_build(video_path)
+    loaded = StatisticsIndex.load_or_build(video_path)
+    assert np.array_equal(loaded.timestamps, built.timestamps)
+    assert np.array_equal(loaded.tables, built.tables)
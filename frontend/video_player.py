@@ -1,5 +1,5 @@
 import sys
-from PySide6.QtWidgets import QApplication, QWidget, QComboBox, QVBoxLayout, QLabel, QHBoxLayout, QPushButton, QSlider, QFileDialog, QTextEdit
+from PySide6.QtWidgets import QApplication, QWidget, QComboBox, QVBoxLayout, QLabel, QHBoxLayout, QPushButton, QSlider, QFileDialog, QTextEdit, QProgressBar
 from PySide6.QtMultimediaWidgets import QVideoWidget
 from PySide6.QtMultimedia import QMediaPlayer
 from PySide6.QtCore import Qt, QUrl, QSize, QPoint
@@ -7,8 +7,11 @@ from PySide6.QtGui import QPainter, QPolygon, QColor, QPen, QPalette, QColor, QI
 import cv2
 import numpy as np  
 import locale
+import os
 import tempfile
-from colormaps import colormaps
+from colormaps import colormaps, get_colormap_lut
+from statistics_index import StatisticsIndex
+from video_preprocessor import VideoPreprocessor
 
 locale.setlocale(locale.LC_ALL, 'da_DK')
 
@@ -22,16 +25,21 @@ class InfoWidget(QWidget):
         layout.addWidget(self.textEdit)
         self.setLayout(layout)
 
-    def update_info(self, pixel_sum_total, density, pixel_sum_masked, density_masked, time_in_ms):
+    def format_time(self, time_in_ms):
         frame_interval = 300
         minutes = int(time_in_ms * frame_interval / 60000)
         seconds = int((time_in_ms * frame_interval % 60000) / 1000)
+        return f"{minutes:02d}:{seconds:02d}"
+
+    def update_info(self, pixel_sum_total, density, pixel_sum_masked, density_masked, time_in_ms, peak_masked=None, peak_time_in_ms=None):
 
         info_text = f"Estimeret personantal i alt: {locale.format_string('%d', pixel_sum_total, grouping=True).replace(',', '.')}\n"
         info_text += f"Estimeret densitet i alt: {locale.format_string('%.3g', density).replace('.', ',')} pr. kvm\n"
         info_text += f"Estimeret personantal i valgt område: {locale.format_string('%d', pixel_sum_masked, grouping=True).replace(',', '.')}\n"
         info_text += f"Estimeret densitet i valgt område: {locale.format_string('%.3g', density_masked).replace('.', ',')} pr. kvm\n"
-        info_text += f"Tid siden start: {minutes:02d}:{seconds:02d}\n"
+        if peak_masked is not None:
+            info_text += f"Højeste personantal i valgt område: {locale.format_string('%d', peak_masked, grouping=True).replace(',', '.')} ({self.format_time(peak_time_in_ms)})\n"
+        info_text += f"Tid siden start: {self.format_time(time_in_ms)}\n"
         self.textEdit.setText(info_text)
 
 
@@ -171,11 +179,21 @@ class VideoPlayer(QWidget):
         self.dropdown_menu = QComboBox()
         self.dropdown_menu.addItems(colormaps.keys()) 
         self.dropdown_menu.setCurrentIndex(2)
+        self.dropdown_menu.currentTextChanged.connect(self.change_colormap)
+
+        self.preprocess_progress = QProgressBar()
+        self.preprocess_progress.hide()
+
+        self.cancel_button = QPushButton("Cancel")
+        self.cancel_button.clicked.connect(self.cancel_preprocessing)
+        self.cancel_button.hide()
 
         # Create a layout for the dropdown and upload button
         upload_layout = QHBoxLayout()
         upload_layout.addWidget(self.dropdown_menu)
         upload_layout.addWidget(self.upload_button)
+        upload_layout.addWidget(self.preprocess_progress)
+        upload_layout.addWidget(self.cancel_button)
 
         self.heatmap_scale_label = QLabel(self)
         self.heatmap_description_label = QLabel("Est. mennesker pr. kvm", self)
@@ -203,59 +221,61 @@ class VideoPlayer(QWidget):
         self.player.setVideoOutput(self.videoWidget)
 
         self.polygon_mask = []
+        self.original_file_path = None
+        self.statistics_index = None
+        # Masked sums of every frame for the polygon they were computed for
+        self.masked_sums_polygon = None
+        self.masked_sums = None
+
+        # Heatmap scale images per colormap, they only change with the colormap
+        self.heatmap_scales = {}
+
+        # Colorized videos per (source path, source size and modification time, colormap name), and statistics
+        # indexes per (source path, source size and modification time)
+        self.processed_videos = {}
+        self.statistics_indexes = {}
+        # Source key of the video that is shown
+        self.shown_source = None
+        self.preprocessor = None
 
     def update_info(self):
-        if self.original_file_path:
-            time_in_ms = self.player.position()
-            alpha = 50
-
-            cap = cv2.VideoCapture(self.original_file_path, 0)
-
-            if not cap.isOpened():
-                print("Error: Unable to open video")
-                return
-
-            cap.set(cv2.CAP_PROP_POS_MSEC, time_in_ms)
-
-            ret, frame = cap.read()
+        if self.statistics_index is None:
+            return
 
-            if not ret:
-                print("Error: Unable to read the frame")
-                cap.release()
-                return
-            
-            height, width = frame.shape[:2]
-            
-            if len(self.overlay.relative_click_positions) < 3:
-                pixel_sum_masked = 0
-                density_masked = 0
-            else:
-                # Get relative click positions and convert them to absolute positions
-                relative_positions = self.overlay.relative_click_positions
-                absolute_positions = [(int(x * width), int(y * height)) for x, y in relative_positions]
+        time_in_ms = self.player.position()
+        alpha = 50
 
-                # Create a mask with the same dimensions as the frame
-                mask = np.zeros(frame.shape, dtype=np.uint8)
+        index = self.statistics_index
+        frame_index = index.get_frame_index(time_in_ms)
+        height, width = index.frame_shape
 
-                # Define a polygon with the absolute positions
-                polygon = np.array(absolute_positions, np.int32)
-                cv2.fillPoly(mask, [polygon], (255, 255, 255))
+        peak_masked = None
+        peak_time_in_ms = None
+        if len(self.overlay.relative_click_positions) < 3:
+            pixel_sum_masked = 0
+            density_masked = 0
+        else:
+            # The sums of the whole video are computed once per polygon, every other update is a lookup
+            polygon = tuple(self.overlay.relative_click_positions)
+            if polygon != self.masked_sums_polygon:
+                self.masked_sums = index.region_sums([polygon])[:, 0] / (3*alpha)
+                self.masked_sums_polygon = polygon
 
-                masked_frame = cv2.bitwise_and(frame, mask)
-                
-                masked_area = mask.sum() / (255 * 3)
+            masked_area = index.region_area(polygon)
 
-                pixel_sum_masked = masked_frame.sum() / (3*alpha)
+            pixel_sum_masked = self.masked_sums[frame_index]
 
-                density_masked = pixel_sum_masked / masked_area
+            density_masked = pixel_sum_masked / masked_area if masked_area else 0
 
-            pixel_sum = frame.sum() / (3*alpha)
+            peak_frame = int(np.argmax(self.masked_sums))
+            peak_masked = self.masked_sums[peak_frame]
+            peak_time_in_ms = index.timestamps[peak_frame]
 
-            density = pixel_sum / (height * width)
+        pixel_sum = index.total(frame_index) / (3*alpha)
 
-            cap.release()
+        density = pixel_sum / (height * width)
 
-            self.infoWidget.update_info(pixel_sum, density, pixel_sum_masked, density_masked, time_in_ms)
+        self.infoWidget.update_info(pixel_sum, density, pixel_sum_masked, density_masked, time_in_ms, peak_masked, peak_time_in_ms)
 
     def showEvent(self, event):
         super().showEvent(event)
@@ -272,6 +292,16 @@ class VideoPlayer(QWidget):
 
     def closeEvent(self, event):
         self.overlay.close()
+        # Jobs replaced by a newer one may still be finishing
+        for preprocessor in self.findChildren(VideoPreprocessor):
+            preprocessor.requestInterruption()
+            preprocessor.wait()
+
+        # The colorized videos are temporary files
+        self.player.setSource(QUrl())
+        for processed_file_path in self.processed_videos.values():
+            if os.path.exists(processed_file_path):
+                os.remove(processed_file_path)
         super().closeEvent(event)  
 
     def updateOverlayGeometry(self):
@@ -285,53 +315,11 @@ class VideoPlayer(QWidget):
         new_position = position / 100 * self.player.duration()
         self.player.setPosition(new_position)
 
-    def preprocess_frame(self, frame, upscale_factor):
-        # Convert frame to grayscale
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-
-        # Apply the selected colormap
-        processed_frame = cv2.applyColorMap(gray, colormaps[self.dropdown_menu.currentText()])
-
-        # Determine the new dimensions
-        new_width = int(processed_frame.shape[1] * upscale_factor)
-        new_height = int(processed_frame.shape[0] * upscale_factor)
-        new_dimensions = (new_width, new_height)
-
-        # Upscale the image
-        upscaled_frame = cv2.resize(processed_frame, new_dimensions, interpolation=cv2.INTER_NEAREST)
-
-        return upscaled_frame
-
-
-    def preprocess_video(self, input_path, output_path, upscale_factor=20):
-        # Open the video file
-        cap = cv2.VideoCapture(input_path)
-
-        # Get properties of the video
-        codec = int(cap.get(cv2.CAP_PROP_FOURCC))  # Codec of the video
-        frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)*upscale_factor)  # Width of the frames
-        frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)*upscale_factor)  # Height of the frames
-        frame_rate = cap.get(cv2.CAP_PROP_FPS)  # Frame rate
-
-        # Define the codec and create VideoWriter object
-        out = cv2.VideoWriter(output_path, codec, frame_rate, (frame_width, frame_height))
-
-        while cap.isOpened():
-            ret, frame = cap.read()
-            if ret:
-                # Apply heatmap to the frame
-                processed_frame = self.preprocess_frame(frame, upscale_factor)
-
-                # Write the processed frame
-                out.write(processed_frame)
-            else:
-                break
-
-        # Release everything
-        cap.release()
-        out.release()
-
     def create_heatmap_scale(self):
+        colormap_name = self.dropdown_menu.currentText()
+        if colormap_name in self.heatmap_scales:
+            return self.heatmap_scales[colormap_name]
+
         # Number of discrete colors and colorbar dimensions
         num_colors = 256
         bar_width = 50
@@ -343,7 +331,7 @@ class VideoPlayer(QWidget):
         gradient = cv2.resize(gradient, (bar_width, bar_height), interpolation=cv2.INTER_LINEAR)
         gradient = (255 * gradient).astype(np.uint8)
 
-        colorbar_img = cv2.applyColorMap(gradient, colormaps[self.dropdown_menu.currentText()])
+        colorbar_img = cv2.applyColorMap(gradient, get_colormap_lut(colormap_name))
 
         # Create a white canvas for the labels
         label_width = 100
@@ -358,6 +346,7 @@ class VideoPlayer(QWidget):
             text = f"{value:.2f}"
             cv2.putText(full_img, text, (bar_width + 10, i + 55), cv2.FONT_HERSHEY_DUPLEX, 0.5, (255, 255, 255), 1, cv2.LINE_AA)
 
+        self.heatmap_scales[colormap_name] = full_img
         return full_img
     
     def convert_cv_qt(self, cv_img):
@@ -369,6 +358,9 @@ class VideoPlayer(QWidget):
         return QPixmap.fromImage(convert_to_Qt_format)
 
 
+    def get_source_key(self):
+        return self.original_file_path, tuple(StatisticsIndex.get_source_stat(self.original_file_path))
+
     def upload_video(self):
         file_dialog = QFileDialog(self)
         file_dialog.setNameFilter("Video Files (*.avi)")
@@ -376,23 +368,92 @@ class VideoPlayer(QWidget):
 
         if file_dialog.exec_() == QFileDialog.Accepted:
             self.original_file_path = file_dialog.selectedFiles()[0]
-
-            # Create a temporary file for the processed video
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.avi') as temp_file:
-                processed_file_path = temp_file.name
-
-            # Process the video
-            self.preprocess_video(self.original_file_path, processed_file_path)
-
-            # Set the processed video as the source
-            self.player.setSource(QUrl.fromLocalFile(processed_file_path))
-            self.player.pause()
+            self.show_video()
+
+    def change_colormap(self):
+        if self.original_file_path is not None:
+            self.show_video()
+
+    def show_video(self):
+        """Show the current video in the selected colormap, colorizing it in the background unless it was before."""
+        self.cancel_preprocessing()
+
+        colormap_name = self.dropdown_menu.currentText()
+        source_key = self.get_source_key()
+        processed_file_path = self.processed_videos.get(source_key + (colormap_name,))
+        if processed_file_path is not None:
+            self.set_processed_video(processed_file_path, source_key, self.statistics_indexes[source_key])
+            return
+
+        # Create a temporary file for the processed video
+        with tempfile.NamedTemporaryFile(delete=False, suffix='.avi') as temp_file:
+            processed_file_path = temp_file.name
+
+        # The index only depends on the source, so it is reused when only the colormap changes
+        statistics_index = self.statistics_indexes.get(source_key)
+
+        # Parented to the player, so a cancelled job can finish after the next one replaced it
+        self.preprocessor = VideoPreprocessor(self.original_file_path, processed_file_path, colormap_name,
+                                              statistics_index, parent=self)
+        self.preprocessor.progress.connect(self.update_preprocess_progress)
+        self.preprocessor.processed.connect(self.preprocessing_done)
+        self.preprocessor.failed.connect(self.preprocessing_failed)
+        self.preprocessor.finished.connect(self.preprocessing_finished)
+        self.preprocessor.finished.connect(self.preprocessor.deleteLater)
+
+        self.preprocess_progress.setRange(0, 0)
+        self.preprocess_progress.show()
+        self.cancel_button.show()
+        self.preprocessor.start()
+
+    def cancel_preprocessing(self):
+        if self.preprocessor is not None and self.preprocessor.isRunning():
+            self.preprocessor.requestInterruption()
+
+    def update_preprocess_progress(self, written, frame_count):
+        if self.sender() is not self.preprocessor:
+            return
+        # A frame count of 0 shows the bar as busy
+        self.preprocess_progress.setRange(0, frame_count)
+        self.preprocess_progress.setValue(written)
+
+    def preprocessing_done(self, input_path, colormap_name, processed_file_path, statistics_index):
+        source_key = (input_path, tuple(statistics_index.source_stat))
+        self.processed_videos[source_key + (colormap_name,)] = processed_file_path
+        self.statistics_indexes[source_key] = statistics_index
+        if input_path != self.original_file_path or colormap_name != self.dropdown_menu.currentText():
+            return
+
+        self.set_processed_video(processed_file_path, source_key, statistics_index)
+
+    def preprocessing_failed(self, message):
+        print(f"Unable to process the video: {message}")
+
+    def preprocessing_finished(self):
+        if self.sender() is self.preprocessor:
+            self.preprocessor = None
+            self.preprocess_progress.hide()
+            self.cancel_button.hide()
+
+    def set_processed_video(self, processed_file_path, source_key, statistics_index):
+        # Keep the position when only the colormap changed
+        position = self.player.position() if source_key == self.shown_source else 0
+        self.shown_source = source_key
+
+        # Region statistics are looked up in the index instead of decoding the video on every interaction
+        if self.statistics_index is not statistics_index:
+            self.statistics_index = statistics_index
+            self.masked_sums_polygon = None
+
+        # Set the processed video as the source
+        self.player.setSource(QUrl.fromLocalFile(processed_file_path))
+        self.player.setPosition(position)
+        self.player.pause()
 
         heatmap_scale_image = self.create_heatmap_scale()
         self.update_info()
         self.heatmap_scale_label.setPixmap(self.convert_cv_qt(heatmap_scale_image))
 
-
     def clear_mask(self):
         self.update_info()
         self.overlay.clear_mask()
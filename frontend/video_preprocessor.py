@@ -0,0 +1,155 @@
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from PySide6.QtCore import QThread, Signal
+import cv2
+from colormaps import get_colormap_lut
+from statistics_index import StatisticsIndex
+
+
+def preprocess_frame(frame, colormap_lut, upscale_factor):
+    # Convert frame to grayscale
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+    # Apply the selected colormap
+    processed_frame = cv2.applyColorMap(gray, colormap_lut)
+
+    # Determine the new dimensions
+    new_width = int(processed_frame.shape[1] * upscale_factor)
+    new_height = int(processed_frame.shape[0] * upscale_factor)
+    new_dimensions = (new_width, new_height)
+
+    # Upscale the image
+    return cv2.resize(processed_frame, new_dimensions, interpolation=cv2.INTER_NEAREST)
+
+
+class VideoPreprocessor(QThread):
+    """Colorizes and upscales a heatmap video into output_path off the GUI thread, and loads its statistics index.
+
+    Decoding, colorizing and encoding run as a pipeline: a decoder thread reads frames and hands them to a pool
+    of colorizing threads, while this thread writes the colorized frames in order as they complete. OpenCV
+    releases the GIL in all three stages, so they use separate cores. At most max_pending frames are decoded
+    ahead of the writer, which bounds the memory of the upscaled frames. When the video has no saved statistics
+    index, the colorizing threads also compute the summed-area tables of the frames, so the index is built
+    in the same pass instead of decoding the video again.
+
+    Progress is reported as (frames written, frames in the video); the frame count is 0 when the container
+    does not store it. requestInterruption() cancels the job, and the partial output is removed.
+    """
+
+    progress = Signal(int, int)
+    # Source path, colormap name, output path and statistics index of a completed job
+    processed = Signal(str, str, str, object)
+    failed = Signal(str)
+
+    def __init__(self, input_path, output_path, colormap_name, statistics_index=None, upscale_factor=20,
+                 workers=None, parent=None):
+        super().__init__(parent)
+        self.input_path = input_path
+        self.output_path = output_path
+        self.colormap_name = colormap_name
+        # An index already loaded for input_path, so switching colormaps does not load it again
+        self.statistics_index = statistics_index
+        self.upscale_factor = upscale_factor
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = 2 * self.workers
+
+        # Set when the writer stops early, so the decoder stops too
+        self.stopped = threading.Event()
+
+    def run(self):
+        try:
+            if self.statistics_index is None:
+                self.statistics_index = StatisticsIndex.load(self.input_path)
+            # A job cancelled before it finished, or while its index was saved, is not handed over, so nothing
+            # else removes its video
+            if not self.preprocess_video() or self.isInterruptionRequested():
+                self.remove_output()
+                return
+            self.processed.emit(self.input_path, self.colormap_name, self.output_path, self.statistics_index)
+        except Exception as error:
+            self.remove_output()
+            self.failed.emit(str(error))
+
+    def remove_output(self):
+        # A job cancelled before its first frame was written has no output
+        if os.path.exists(self.output_path):
+            os.remove(self.output_path)
+
+    def process_frame(self, frame, colormap_lut, build_index):
+        table = StatisticsIndex.summed_area_table(frame) if build_index else None
+        return preprocess_frame(frame, colormap_lut, self.upscale_factor), table
+
+    def decode(self, cap, pool, colormap_lut, frames, timestamps):
+        try:
+            while not (self.stopped.is_set() or self.isInterruptionRequested()):
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                if timestamps is not None:
+                    # After a read, the position is the timestamp of the frame that was read
+                    timestamps.append(cap.get(cv2.CAP_PROP_POS_MSEC))
+                frames.put(pool.submit(self.process_frame, frame, colormap_lut, timestamps is not None))
+        finally:
+            frames.put(None)
+
+    def preprocess_video(self):
+        """Write the colorized video and build the statistics index if it was not loaded, returns False when the
+        job was cancelled."""
+        # Open the video file
+        cap = cv2.VideoCapture(self.input_path)
+        if not cap.isOpened():
+            raise ValueError(f"Unable to open {self.input_path}")
+
+        # Get properties of the video
+        codec = int(cap.get(cv2.CAP_PROP_FOURCC))  # Codec of the video
+        frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)*self.upscale_factor)  # Width of the frames
+        frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)*self.upscale_factor)  # Height of the frames
+        frame_rate = cap.get(cv2.CAP_PROP_FPS)  # Frame rate
+        frame_count = max(int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), 0)
+
+        # Define the codec and create VideoWriter object
+        out = cv2.VideoWriter(self.output_path, codec, frame_rate, (frame_width, frame_height))
+
+        # Futures of the colorized frames in decoding order, None after the last frame
+        frames = queue.Queue(maxsize=self.max_pending)
+        written = 0
+        # Timestamps and summed-area tables of the frames in order, None when the index was loaded
+        timestamps = [] if self.statistics_index is None else None
+        tables = []
+        with ThreadPoolExecutor(self.workers) as pool:
+            decoder = threading.Thread(target=self.decode,
+                                       args=(cap, pool, get_colormap_lut(self.colormap_name), frames, timestamps))
+            decoder.start()
+            try:
+                while not self.isInterruptionRequested():
+                    future = frames.get()
+                    if future is None:
+                        break
+                    processed_frame, table = future.result()
+                    out.write(processed_frame)
+                    if table is not None:
+                        tables.append(table)
+                    written += 1
+                    self.progress.emit(written, max(frame_count, written) if frame_count else 0)
+            finally:
+                # Unblock the decoder if the writer stopped before the last frame
+                self.stopped.set()
+                while decoder.is_alive() or not frames.empty():
+                    try:
+                        frames.get(timeout=0.1)
+                    except queue.Empty:
+                        pass
+                decoder.join()
+
+                # Release everything
+                cap.release()
+                out.release()
+
+        if self.isInterruptionRequested():
+            return False
+        if timestamps is not None:
+            self.statistics_index = StatisticsIndex.from_tables(self.input_path, timestamps, tables)
+            self.statistics_index.save()
+        return True